@@ -0,0 +1,250 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Offline compaction of a datastore, near-duplicate entries are merged into weighted centroids.
+
+Code is repetitive (imports, getters, boilerplate), so many entries have nearly the same key
+and the same target. The entries of every (file, target id) group, split by the (context, target)
+token types of the entries if the datastore stores them, are clustered with leader
+clustering: an entry joins the first cluster whose leader is within --radius of it, otherwise
+it leads a new cluster. Every cluster is written as one entry holding the mean key and the
+number of entries it merged, the count multiplies the kNN weight of the entry at search time.
+
+Groups are taken per file rather than per project, so every centroid still belongs to exactly
+one file and leaving the current file out of the search stays exact. Datastores without file
+meta (run_lm_domain.py) are grouped per target inside chunks of --chunk_size entries.
+
+    python compact_datastore.py --datastore_dir save/datastore --output_dir save/datastore_compact
+
+reports the compression ratio, and the kNN-only top-1 accuracy and the flat search latency of
+both datastores on datastore keys of the largest projects, searched with their file left out.
+The end to end accuracy is measured by running run_lm.py with --datastore_dir on the output.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+
+from datastore import Datastore, DatastoreWriter
+from knn import IndexManager, ProjectIndexCache, knn_sparse
+
+logger = logging.getLogger(__name__)
+
+
+def default_radius(datastore, relative_radius, sample_size=10000, seed=42):
+    """ relative_radius times the median l2 norm of a sample of the keys. """
+    sample = np.random.RandomState(seed).choice(datastore.size, min(sample_size, datastore.size), replace=False)
+    keys = np.asarray(datastore.keys[np.sort(sample)], dtype='float32')
+    return relative_radius * float(np.median(np.sqrt((keys * keys).sum(-1))))
+
+
+def leader_clusters(keys, radius):
+    """ Cluster labels [n] of keys [n, dim], every cluster holds the entries within radius of its leader. """
+    n = len(keys)
+    labels = np.full(n, -1, dtype='int64')
+    norms = (keys * keys).sum(-1)
+    num_clusters = 0
+    for i in range(n):
+        if labels[i] >= 0:
+            continue
+        rest = np.flatnonzero(labels[i:] < 0) + i
+        dists = norms[rest] - 2 * keys[rest] @ keys[i] + norms[i]
+        labels[rest[dists <= radius * radius]] = num_clusters
+        labels[i] = num_clusters
+        num_clusters += 1
+    return labels
+
+
+def compact_entries(keys, vals, counts, radius, max_group=4096, types=None):
+    """
+    Merge the entries keys [n, dim], vals [n], counts [n] that share a target, and the (context,
+    target) token types [n, 2] if given, and lie within radius of a cluster leader. Groups larger
+    than max_group are clustered in blocks, which bounds the cost. Returns the centroid keys, vals,
+    counts and types (None without types), in the order of the first entry of every cluster.
+    """
+    n = len(keys)
+    group_keys = [vals] if types is None else [vals, types[:, 0], types[:, 1]]
+    # lexsort sorts by its last key first and is stable
+    order = np.lexsort(group_keys[::-1])
+    sorted_keys = np.stack([group_key[order] for group_key in group_keys], axis=1)
+    group_starts = np.flatnonzero(np.r_[True, (sorted_keys[1:] != sorted_keys[:-1]).any(-1)])
+    group_ends = np.r_[group_starts[1:], n]
+
+    labels = np.empty(n, dtype='int64')
+    single = group_ends - group_starts == 1
+    labels[order[group_starts[single]]] = np.arange(single.sum())
+    num_clusters = int(single.sum())
+    for group_start, group_end in zip(group_starts[~single].tolist(), group_ends[~single].tolist()):
+        for block_start in range(group_start, group_end, max_group):
+            members = order[block_start: min(block_start + max_group, group_end)]
+            member_labels = leader_clusters(keys[members], radius)
+            labels[members] = member_labels + num_clusters
+            num_clusters += int(member_labels.max()) + 1
+
+    # number the clusters by their first entry, so the compacted entries keep the original order
+    first_entries = np.full(num_clusters, n, dtype='int64')
+    np.minimum.at(first_entries, labels, np.arange(n))
+    ranks = np.empty(num_clusters, dtype='int64')
+    ranks[np.argsort(first_entries)] = np.arange(num_clusters)
+    labels = ranks[labels]
+
+    perm = np.argsort(labels, kind='stable')
+    cluster_starts = np.flatnonzero(np.r_[True, labels[perm][1:] != labels[perm][:-1]])
+    weights = counts.astype('float32')
+    cluster_counts = np.add.reduceat(counts[perm], cluster_starts)
+    centroids = np.add.reduceat(keys[perm] * weights[perm, None], cluster_starts) / cluster_counts[:, None]
+    cluster_types = None if types is None else types[perm][cluster_starts]
+    return centroids.astype('float32'), vals[perm][cluster_starts], cluster_counts, cluster_types
+
+
+def compact_datastore(datastore, output_dir, radius, key_dtype=None, max_group=4096, chunk_size=65536):
+    """ Write the compacted datastore to output_dir, with the key dtype of datastore by default. """
+    writer = DatastoreWriter(output_dir, datastore.dim, key_dtype or datastore.key_dtype, with_counts=True,
+                             with_types=datastore.types is not None)
+    if len(datastore.files) > 0:
+        ranges = datastore.files.tolist()
+    else:
+        ranges = [(-1, -1, start, min(start + chunk_size, datastore.size))
+                  for start in range(0, datastore.size, chunk_size)]
+
+    for proj_id, file_id, start, end in ranges:
+        if end <= start:
+            continue
+        counts = np.ones(end - start, dtype='int64') if datastore.counts is None else \
+            np.asarray(datastore.counts[start: end], dtype='int64')
+        types = None if datastore.types is None else np.asarray(datastore.types[start: end])
+        centroids, vals, counts, types = compact_entries(np.asarray(datastore.keys[start: end], dtype='float32'),
+                                                         np.asarray(datastore.vals[start: end]), counts, radius,
+                                                         max_group, types)
+        new_start, new_end = writer.add(centroids, vals, counts, types=types)
+        if file_id >= 0:
+            writer.add_file(proj_id, file_id, new_start, new_end)
+    writer.close()
+    return Datastore(output_dir)
+
+
+def sample_queries(datastore, num_projects, num_queries, seed=42):
+    """ Positions, projects and files of num_queries random entries of each of the largest projects. """
+    proj_sizes = {proj_id: sum(end - start for start, end in runs) for proj_id, runs in datastore.project_runs.items()}
+    files = datastore.files[np.argsort(datastore.files[:, 2])]
+    rng = np.random.RandomState(seed)
+    positions = []
+    for proj_id in sorted(proj_sizes, key=lambda x: -proj_sizes[x])[:num_projects]:
+        ids = np.concatenate([np.arange(start, end) for start, end in datastore.project_runs[proj_id]])
+        positions.append(np.sort(rng.choice(ids, min(num_queries, len(ids)), replace=False)))
+    positions = np.concatenate(positions + [np.zeros((0,), dtype='int64')])
+    query_files = files[np.searchsorted(files[:, 2], positions, side='right') - 1]
+    return positions, query_files[:, 0], query_files[:, 1]
+
+
+def evaluate(datastore, xq, query_targets, query_projs, query_files, k):
+    """
+    kNN-only top-1 accuracy of the queries xq [n, dim] on datastore, every query searched with its
+    file left out, and the total search time.
+    """
+    index_cache = ProjectIndexCache(datastore, {}, 'cpu', IndexManager())
+    correct = 0
+    search_time = 0.0
+    for proj_id in np.unique(query_projs).tolist():
+        rows = np.flatnonzero(query_projs == proj_id)
+        proj_index = index_cache.get(proj_id)
+        if proj_index.ntotal == 0:
+            continue
+        file_ranges = [index_cache.file_range(proj_index, file_id) for file_id in query_files[rows].tolist()]
+        exclude_starts = torch.tensor([start for start, _ in file_ranges], dtype=torch.long)
+        exclude_ends = torch.tensor([end for _, end in file_ranges], dtype=torch.long)
+
+        start_time = time.time()
+        dists, neighbour_indexes = proj_index.search_ranges(torch.from_numpy(xq[rows]), k, exclude_starts,
+                                                             exclude_ends)
+        search_time += time.time() - start_time
+
+        found = neighbour_indexes >= 0
+        targets = torch.where(found, proj_index.vals[neighbour_indexes.clamp(min=0)], neighbour_indexes)
+        log_counts = None
+        if proj_index.log_counts is not None:
+            log_counts = proj_index.log_counts[neighbour_indexes.clamp(min=0)].masked_fill(~found, 0)
+        knn_ids, knn_probs = knn_sparse(dists, targets, log_counts=log_counts)
+        pred = knn_ids.gather(-1, knn_probs.argmax(-1, keepdim=True)).squeeze(-1)
+        correct += (pred.numpy() == query_targets[rows]).sum()
+        index_cache.drop(proj_id)
+    return correct / max(len(xq), 1), search_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datastore_dir", default=None, type=str, required=True,
+                        help="Datastore saved by run_lm.py")
+    parser.add_argument("--output_dir", default=None, type=str, required=True,
+                        help="Directory of the compacted datastore")
+    parser.add_argument("--radius", default=None, type=float,
+                        help="l2 radius of a cluster, --relative_radius times the median key norm by default")
+    parser.add_argument("--relative_radius", default=0.05, type=float,
+                        help="Cluster radius relative to the median key norm")
+    parser.add_argument("--key_dtype", default=None, type=str, choices=['float32', 'float16', 'sq8'],
+                        help="Key dtype of the compacted datastore, the one of the input by default")
+    parser.add_argument("--max_group", default=4096, type=int,
+                        help="Entries of a (file, target, token types) group are clustered in blocks of this size")
+    parser.add_argument("--chunk_size", default=65536, type=int,
+                        help="Entries clustered together in datastores without file meta")
+    parser.add_argument("--k", default=1024, type=int,
+                        help="Number of neighbours searched by the evaluation")
+    parser.add_argument("--num_projects", default=4, type=int,
+                        help="Number of the largest projects evaluated")
+    parser.add_argument("--num_queries", default=1000, type=int,
+                        help="Number of queries per project, 0 skips the evaluation")
+    parser.add_argument("--output_file", default=None, type=str,
+                        help="Optional json file for the report")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+
+    assert args.output_dir != args.datastore_dir, "the datastore can not be compacted in place"
+    datastore = Datastore(args.datastore_dir)
+    radius = args.radius if args.radius is not None else default_radius(datastore, args.relative_radius)
+    start_time = time.time()
+    compacted = compact_datastore(datastore, args.output_dir, radius, args.key_dtype, args.max_group,
+                                  args.chunk_size)
+    report = {
+        'radius': radius,
+        'size': datastore.size,
+        'compacted_size': compacted.size,
+        'compression': datastore.size / max(compacted.size, 1),
+        'compaction_time': time.time() - start_time,
+    }
+    logger.info(f"compacted {datastore.size} entries into {compacted.size} "
+                f"({report['compression']:.2f}x) with radius {radius:.3f} in {report['compaction_time']:.1f}s")
+
+    if args.num_queries > 0 and len(datastore.files) > 0:
+        positions, query_projs, query_files = sample_queries(datastore, args.num_projects, args.num_queries)
+        xq = np.asarray(datastore.keys[positions], dtype='float32')
+        query_targets = np.asarray(datastore.vals[positions], dtype='int64')
+        acc, search_time = evaluate(datastore, xq, query_targets, query_projs, query_files, args.k)
+        compacted_acc, compacted_search_time = evaluate(compacted, xq, query_targets, query_projs, query_files,
+                                                        args.k)
+        report.update({
+            'num_queries': len(xq),
+            'knn_acc': acc,
+            'compacted_knn_acc': compacted_acc,
+            'acc_change': compacted_acc - acc,
+            'search_speedup': search_time / max(compacted_search_time, 1e-9),
+        })
+        logger.info(f"kNN top-1 acc on {len(xq)} queries: {acc:.4f} -> {compacted_acc:.4f} "
+                    f"({compacted_acc - acc:+.4f}), search speed-up {report['search_speedup']:.2f}x")
+    elif args.num_queries > 0:
+        logger.warning("the datastore has no file meta, queries can not be left out, skipping the evaluation")
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -188,6 +188,61 @@ class finetuneDataset(Dataset):
         return torch.tensor(self.inputs[item])
 
 
+def encode_code_tokens(tokenizer, code, code_type):
+    """ Sub-token ids of a file given as a list of code tokens, with the token type of every sub-token. """
+    code_token_ids = []
+    code_type_ids = []
+    for i, code_token in enumerate(code):
+        if i > 0:
+            code_token = ' ' + code_token  # 补上前缀
+        token_id = tokenizer.encode(code_token)
+        code_token_ids.extend(token_id)
+        code_type_ids.extend([code_type[i]] * len(token_id))
+
+    assert len(code_token_ids) == len(code_type_ids)
+    return code_token_ids, code_type_ids
+
+
+def split_eval_blocks(tokenizer, code_token_ids, code_type_ids, block_size):
+    """
+    Split the sub-tokens of a file into padded (sample, sample_type) blocks of block_size. Full blocks
+    are cut before their last token boundary, so that no token is split between two blocks.
+    """
+    blocks = []
+    i = 0
+    while i < len(code_token_ids):
+        sample = code_token_ids[i: i + block_size]
+        sample_type = code_type_ids[i: i+block_size]
+        if len(sample) == block_size:
+            for j in range(block_size):
+                if tokenizer.convert_ids_to_tokens(sample[block_size - 1 - j])[
+                    0] == '\u0120' or tokenizer.convert_ids_to_tokens(
+                    sample[block_size - 1 - j]).startswith("<NUM_LIT"):
+                    break
+                if sample[block_size - 1 - j] in [tokenizer.bos_token_id, tokenizer.eos_token_id,
+                                                  tokenizer.sep_token_id]:
+                    if sample[block_size - 1 - j] != tokenizer.bos_token_id:
+                        j -= 1
+                    break
+            if j == block_size - 1:
+                print(tokenizer.decode(sample))
+                exit()
+            sample = sample[: block_size - 1 - j]
+            sample_type = sample_type[: block_size - 1 - j]
+            i += len(sample)
+            pad_len = block_size - len(sample)
+            sample += [tokenizer.pad_token_id] * pad_len
+            sample_type += [tokenizer.pad_token_id] * pad_len
+            blocks.append((sample, sample_type))
+        else:
+            pad_len = block_size - len(sample)
+            sample += [tokenizer.pad_token_id] * pad_len
+            sample_type += [tokenizer.pad_token_id] * pad_len
+            blocks.append((sample, sample_type))
+            break
+    return blocks
+
+
 class EvalDataset(Dataset):
     def __init__(self, tokenizer, args, logger, file_type='train', block_size=1024):
         if not os.path.exists(args.output_dir):
@@ -242,65 +297,18 @@ class EvalDataset(Dataset):
                     self.file2sample[idx] = []
 
                 try:
-                    code_token_ids = []
-                    code_type_ids = []
-
-                    for i, code_token in enumerate(code):
-                        if i > 0:
-                            code_token = ' ' + code_token  # 补上前缀
-                        token_id = tokenizer.encode(code_token)
-                        code_token_ids.extend(token_id)
-                        code_type_ids.extend([code_type[i]] * len(token_id))
-
-                    assert len(code_token_ids) == len(code_type_ids)
-
-                    i = 0
-                    while i < len(code_token_ids):
-                        sample = code_token_ids[i: i + block_size]
-                        sample_type = code_type_ids[i: i+block_size]
-                        if len(sample) == block_size:
-                            for j in range(block_size):
-                                if tokenizer.convert_ids_to_tokens(sample[block_size - 1 - j])[
-                                    0] == '\u0120' or tokenizer.convert_ids_to_tokens(
-                                    sample[block_size - 1 - j]).startswith("<NUM_LIT"):
-                                    break
-                                if sample[block_size - 1 - j] in [tokenizer.bos_token_id, tokenizer.eos_token_id,
-                                                                  tokenizer.sep_token_id]:
-                                    if sample[block_size - 1 - j] != tokenizer.bos_token_id:
-                                        j -= 1
-                                    break
-                            if j == block_size - 1:
-                                print(tokenizer.decode(sample))
-                                exit()
-                            sample = sample[: block_size - 1 - j]
-                            sample_type = sample_type[: block_size - 1 - j]
-                            i += len(sample)
-                            pad_len = block_size - len(sample)
-                            sample += [tokenizer.pad_token_id] * pad_len
-                            sample_type += [tokenizer.pad_token_id] * pad_len
-                            input_ids.append(sample)
-                            self.input_types.append(sample_type)
-
-                            cur_index = len(input_ids) - 1
-                            self.sample2proj[cur_index] = proj_index
-                            self.proj2sample[proj_index].append(cur_index)
-
-                            self.file2sample[idx].append(cur_index)
-                            self.sample2file[cur_index] = idx
-                        else:
-                            pad_len = block_size - len(sample)
-                            sample += [tokenizer.pad_token_id] * pad_len
-                            sample_type += [tokenizer.pad_token_id] * pad_len
-                            input_ids.append(sample)
-                            self.input_types.append(sample_type)
-
-                            cur_index = len(input_ids) - 1
-                            self.sample2proj[cur_index] = proj_index
-                            self.proj2sample[proj_index].append(cur_index)
-
-                            self.file2sample[idx].append(cur_index)
-                            self.sample2file[cur_index] = idx
-                            break
+                    code_token_ids, code_type_ids = encode_code_tokens(tokenizer, code, code_type)
+                    for sample, sample_type in split_eval_blocks(tokenizer, code_token_ids, code_type_ids,
+                                                                 block_size):
+                        input_ids.append(sample)
+                        self.input_types.append(sample_type)
+
+                        cur_index = len(input_ids) - 1
+                        self.sample2proj[cur_index] = proj_index
+                        self.proj2sample[proj_index].append(cur_index)
+
+                        self.file2sample[idx].append(cur_index)
+                        self.sample2file[cur_index] = idx
                 except Exception as e:
                     print(e)
                     raise e
@@ -0,0 +1,814 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+On-disk kNN datastore.
+
+A datastore is a directory holding raw arrays that are opened with np.memmap, so that
+loading is near-instant, pages are read lazily and several eval processes share the
+same page cache:
+
+    manifest.json   dim, size and dtypes of the arrays below
+    keys.bin        [size, dim] hidden states, float32 / float16, or uint8 codes of an sq8 datastore
+    quantizer.index trained faiss IndexScalarQuantizer (no entries) that decodes the codes of an sq8 datastore
+    vals.bin        [size] int32 target ids
+    counts.bin      [size] int32 number of original entries merged into every entry, only in compacted datastores
+    types.bin       [size, 2] int32 token types (input_types) of the context token and of the target of every entry
+    files.npy       [num_files, 4] int64 (proj_id, file_id, start, end)
+    projects.npy    [num_runs, 3] int64 (proj_id, start, end)
+    indexes/        trained faiss indexes of the projects, one sub-directory per index spec
+    projections/    reduced keys and their faiss VectorTransform, one sub-directory per projection
+    lm_cache/       queries and LM top-k of the eval pass that built the datastore, see LMCacheWriter
+    progress.json   entries made durable by the last checkpoint of an unfinished build, see DatastoreWriter
+
+A sharded datastore is a directory of num_shards such datastores, shard_000/ ..., with a
+manifest of its own (see ShardedDatastoreWriter).
+
+Offsets are [start, end) positions in keys.bin / vals.bin. A file always covers one
+contiguous range, a project covers one or more contiguous runs. Entries outside of every
+file range are dead, left behind by DatastoreUpdater until compact_dead_entries() drops them.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+MANIFEST_NAME = 'manifest.json'
+PROGRESS_NAME = 'progress.json'
+KEYS_NAME = 'keys.bin'
+VALS_NAME = 'vals.bin'
+COUNTS_NAME = 'counts.bin'
+TYPES_NAME = 'types.bin'
+FILES_NAME = 'files.npy'
+PROJECTS_NAME = 'projects.npy'
+INDEXES_DIR = 'indexes'
+PROJECTIONS_DIR = 'projections'
+LM_CACHE_DIR = 'lm_cache'
+TRANSFORM_NAME = 'transform.vt'
+KEY_QUANTIZER_NAME = 'quantizer.index'
+
+# key dtype of datastores storing per-dimension 8-bit scalar quantized keys
+SQ8_KEY_DTYPE = 'sq8'
+# the sq8 range of every dimension is widened by this fraction of the range seen in the training chunk,
+# keys of later files are clipped less often
+SQ8_RANGE_MARGIN = 0.05
+
+VALUE_DTYPE = 'int32'
+COUNT_DTYPE = 'int32'
+TYPE_DTYPE = 'int32'
+
+
+def datastore_exists(path):
+    # the manifest is written last, so a half written datastore is never picked up
+    return os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def build_project_runs(files):
+    """ Merge consecutive files of the same project into (proj_id, start, end) runs. """
+    runs = []
+    for proj_id, _, start, end in files:
+        if runs and runs[-1][0] == proj_id and runs[-1][2] == start:
+            runs[-1][2] = end
+        else:
+            runs.append([proj_id, start, end])
+    return runs
+
+
+class ChunkedArrayWriter(object):
+    """
+    Appends rows of a fixed shape and dtype to a raw file that can later be opened with np.memmap.
+
+    Rows go through a preallocated buffer of chunk_size rows which is flushed when full,
+    so memory stays bounded no matter how large the file grows. With start, the writer
+    appends after the first start rows of an existing file and drops whatever followed them.
+    """
+
+    def __init__(self, file_name, row_shape, dtype, chunk_size=65536, start=None):
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        if start is None:
+            self.size = 0
+            self._file = open(file_name, 'wb')
+        else:
+            self.size = start
+            self._file = open(file_name, 'r+b')
+            self._file.truncate(start * self.dtype.itemsize * int(np.prod(self.row_shape)))
+            self._file.seek(0, os.SEEK_END)
+        self._buf = np.empty((chunk_size,) + self.row_shape, dtype=self.dtype)
+        self._buf_len = 0
+
+    def add(self, rows):
+        rows = np.asarray(rows).reshape((-1,) + self.row_shape)
+        i = 0
+        while i < rows.shape[0]:
+            n = min(rows.shape[0] - i, self._buf.shape[0] - self._buf_len)
+            self._buf[self._buf_len: self._buf_len + n] = rows[i: i + n]
+            self._buf_len += n
+            i += n
+            if self._buf_len == self._buf.shape[0]:
+                self.flush()
+        self.size += rows.shape[0]
+
+    def flush(self):
+        self._file.write(self._buf[:self._buf_len].tobytes())
+        self._buf_len = 0
+
+    def sync(self):
+        """ Flush the buffer and force the rows written so far to disk. """
+        self.flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class DatastoreWriter(object):
+    """
+    Append-only writer, entries are streamed to disk in the order they are added.
+
+    key_dtype is float32, float16 or sq8. sq8 keys are 8-bit codes of a per-dimension faiss
+    ScalarQuantizer, trained on the first chunk_size keys, which are held back until then.
+    with_counts writes the entry counts of a compacted datastore, see compact_datastore.py.
+    with_types writes the (context, target) token types of every entry, see TypeRouter.
+
+    checkpoint() makes the entries added so far durable and records them in progress.json.
+    A writer created with that progress (see load_progress) resumes a killed build after them,
+    the entries written after the checkpoint are dropped.
+    """
+
+    def __init__(self, path, dim, key_dtype='float32', chunk_size=65536, with_counts=False, with_types=False,
+                 progress=None):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest_file = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        if progress is not None and not _progress_matches(progress, dim, key_dtype, with_counts, with_types):
+            logger.warning("the build progress at %s is of another datastore layout, starting over", path)
+            progress = None
+        if progress is None and os.path.exists(os.path.join(path, PROGRESS_NAME)):
+            os.remove(os.path.join(path, PROGRESS_NAME))
+        # indexes, projections and lm cache of the old entries
+        shutil.rmtree(os.path.join(path, INDEXES_DIR), ignore_errors=True)
+        shutil.rmtree(os.path.join(path, PROJECTIONS_DIR), ignore_errors=True)
+        shutil.rmtree(os.path.join(path, LM_CACHE_DIR), ignore_errors=True)
+        self.path = path
+        self.dim = dim
+        self.key_dtype = key_dtype if key_dtype == SQ8_KEY_DTYPE else np.dtype(key_dtype).name
+        self.files = [] if progress is None else [list(row) for row in progress['files']]
+        self._file_ids = set(row[1] for row in self.files)
+        self.quantizer = None
+        start = None if progress is None else progress['size']
+        if self.key_dtype == SQ8_KEY_DTYPE and start:
+            import faiss
+
+            self.quantizer = faiss.read_index(os.path.join(path, KEY_QUANTIZER_NAME))
+        self._chunk_size = chunk_size
+        self._pending_keys = []  # float32 keys of an sq8 datastore added before its quantizer is trained
+        self._pending_size = 0
+        code_dtype = 'uint8' if self.key_dtype == SQ8_KEY_DTYPE else self.key_dtype
+        self._keys = ChunkedArrayWriter(os.path.join(path, KEYS_NAME), (dim,), code_dtype, chunk_size, start)
+        self._vals = ChunkedArrayWriter(os.path.join(path, VALS_NAME), (), VALUE_DTYPE, chunk_size, start)
+        self._counts = None
+        if with_counts:
+            self._counts = ChunkedArrayWriter(os.path.join(path, COUNTS_NAME), (), COUNT_DTYPE, chunk_size, start)
+        elif os.path.exists(os.path.join(path, COUNTS_NAME)):
+            os.remove(os.path.join(path, COUNTS_NAME))
+        self._types = None
+        if with_types:
+            self._types = ChunkedArrayWriter(os.path.join(path, TYPES_NAME), (2,), TYPE_DTYPE, chunk_size, start)
+        elif os.path.exists(os.path.join(path, TYPES_NAME)):
+            os.remove(os.path.join(path, TYPES_NAME))
+
+    @property
+    def size(self):
+        return self._vals.size
+
+    def add(self, keys, vals, counts=None, types=None):
+        """
+        Append keys [n, dim] and target ids [n], return the [start, end) range they got.
+        counts [n] must be given if and only if the writer was created with_counts, and
+        types [n, 2] if and only if it was created with_types.
+        """
+        keys = np.asarray(keys).reshape(-1, self.dim)
+        vals = np.asarray(vals).reshape(-1)
+        assert keys.shape[0] == vals.shape[0]
+        assert (counts is None) == (self._counts is None)
+        assert (types is None) == (self._types is None)
+        if counts is not None:
+            self._counts.add(counts)
+        if types is not None:
+            self._types.add(np.asarray(types).reshape(-1, 2))
+        start = self.size
+        if self.key_dtype == SQ8_KEY_DTYPE:
+            self._add_quantized(keys)
+        else:
+            self._keys.add(keys)
+        self._vals.add(vals)
+        return start, self.size
+
+    def _add_quantized(self, keys):
+        keys = np.ascontiguousarray(keys, dtype='float32')
+        if self.quantizer is not None:
+            self._keys.add(self.quantizer.sa_encode(keys))
+            return
+        self._pending_keys.append(keys)
+        self._pending_size += keys.shape[0]
+        if self._pending_size >= self._chunk_size:
+            self._train_quantizer()
+
+    def _train_quantizer(self):
+        # faiss is only needed to write and read sq8 datastores
+        import faiss
+
+        keys = np.concatenate(self._pending_keys + [np.zeros((0, self.dim), dtype='float32')])
+        self.quantizer = faiss.IndexScalarQuantizer(self.dim, faiss.ScalarQuantizer.QT_8bit)
+        self.quantizer.sq.rangestat_arg = SQ8_RANGE_MARGIN
+        self.quantizer.train(keys if len(keys) > 0 else np.zeros((1, self.dim), dtype='float32'))
+        faiss.write_index(self.quantizer, os.path.join(self.path, KEY_QUANTIZER_NAME))
+        for start in range(0, len(keys), self._chunk_size):
+            self._keys.add(self.quantizer.sa_encode(keys[start: start + self._chunk_size]))
+        self._pending_keys, self._pending_size = [], 0
+
+    def add_batch(self, hidden_states, targets, mask, proj_meta=None, types=None):
+        """
+        Append the masked positions of a batch with one gather and one device to host copy.
+
+        hidden_states [batch_size, seq_len, dim], targets / mask [batch_size, seq_len] torch tensors,
+        proj_meta [batch_size, 2] (proj_id, file_id) if the entries should be recorded per file,
+        types [batch_size, seq_len, 2] for a writer created with_types.
+        """
+        keys = hidden_states[mask]
+        # cast on the device so that fp16 datastores also halve the copy
+        keys = keys.half() if self.key_dtype == 'float16' else keys.float()
+        start, _ = self.add(keys.cpu().numpy(), targets[mask].cpu().numpy(),
+                            types=None if types is None else types.to(mask.device)[mask].cpu().numpy())
+        if proj_meta is not None:
+            counts = mask.sum(-1).cpu().tolist()
+            for (proj_id, file_id), count in zip(proj_meta.tolist(), counts):
+                self.add_file(proj_id, file_id, start, start + count)
+                start += count
+
+    def add_file(self, proj_id, file_id, start, end):
+        """
+        Record that [start, end) belongs to file_id, ranges of the same file are merged. A file
+        must be added in one contiguous range, leaving it out of the search excludes one range.
+        """
+        if self.files and self.files[-1][1] == file_id and self.files[-1][3] == start:
+            self.files[-1][3] = end
+            return
+        if file_id in self._file_ids:
+            raise ValueError(f"file {file_id} is not contiguous in the datastore, its blocks have to be "
+                             f"added one after the other (sequential sampling, one process)")
+        self._file_ids.add(file_id)
+        self.files.append([proj_id, file_id, start, end])
+
+    def sync(self, samples_done):
+        """
+        Force the entries added so far to disk and return the progress that resumes after them,
+        None while the keys of an sq8 datastore are held back for its quantizer.
+        """
+        if self._pending_size > 0:
+            return None
+        for writer in (self._keys, self._vals, self._counts, self._types):
+            if writer is not None:
+                writer.sync()
+        return {
+            'version': FORMAT_VERSION,
+            'dim': self.dim,
+            'key_dtype': self.key_dtype,
+            'has_counts': self._counts is not None,
+            'has_types': self._types is not None,
+            'size': self.size,
+            'samples_done': samples_done,
+            'files': [list(row) for row in self.files],
+        }
+
+    def checkpoint(self, samples_done, settings=None):
+        """
+        Record the entries added so far, which came from the first samples_done input samples, in
+        progress.json, along with the settings of the build (a json dict) that a resumed build has
+        to share. Returns False if nothing could be committed yet, see sync().
+        """
+        progress = self.sync(samples_done)
+        if progress is None:
+            return False
+        progress['settings'] = settings
+        _save_progress(self.path, progress)
+        return True
+
+    def close(self):
+        if self.key_dtype == SQ8_KEY_DTYPE and self.quantizer is None:
+            self._train_quantizer()
+        for writer in (self._keys, self._vals, self._counts, self._types):
+            if writer is not None:
+                writer.close()
+
+        files = np.array(self.files, dtype='int64').reshape(-1, 4)
+        projects = np.array(build_project_runs(self.files), dtype='int64').reshape(-1, 3)
+        np.save(os.path.join(self.path, FILES_NAME), files)
+        np.save(os.path.join(self.path, PROJECTS_NAME), projects)
+
+        manifest = {
+            'version': FORMAT_VERSION,
+            'dim': self.dim,
+            'size': self.size,
+            'key_dtype': self.key_dtype,
+            'value_dtype': VALUE_DTYPE,
+            'has_counts': self._counts is not None,
+            'has_types': self._types is not None,
+            'num_files': len(files),
+            'num_projects': len(set(projects[:, 0].tolist())),
+        }
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        if os.path.exists(os.path.join(self.path, PROGRESS_NAME)):
+            os.remove(os.path.join(self.path, PROGRESS_NAME))
+        logger.info("datastore saved at %s, %d entries, %d files", self.path, self.size, len(files))
+
+
+def shard_dir(path, shard):
+    return os.path.join(path, f"shard_{shard:03d}")
+
+
+class ShardedDatastoreWriter(object):
+    """
+    Spreads the entries of a datastore without project meta over num_shards datastores, every
+    batch goes whole to the smallest shard. Every shard is a complete datastore that a worker
+    process can open and search on its own. Its progress holds the progress of every shard, see
+    DatastoreWriter.checkpoint.
+    """
+
+    def __init__(self, path, dim, num_shards, key_dtype='float32', chunk_size=65536, with_types=False,
+                 progress=None):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest_file = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        if progress is not None and len(progress.get('shards', [])) != num_shards:
+            logger.warning("the build progress at %s has another number of shards, starting over", path)
+            progress = None
+        if progress is None and os.path.exists(os.path.join(path, PROGRESS_NAME)):
+            os.remove(os.path.join(path, PROGRESS_NAME))
+        self.path = path
+        self.dim = dim
+        self.shards = [DatastoreWriter(shard_dir(path, shard), dim, key_dtype, chunk_size, with_types=with_types,
+                                       progress=None if progress is None else progress['shards'][shard])
+                       for shard in range(num_shards)]
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self.shards)
+
+    def add_batch(self, hidden_states, targets, mask, types=None):
+        """ Append the masked positions of a batch to the smallest shard, see DatastoreWriter.add_batch. """
+        min(self.shards, key=lambda shard: shard.size).add_batch(hidden_states, targets, mask, types=types)
+
+    def checkpoint(self, samples_done, settings=None):
+        """ DatastoreWriter.checkpoint of all shards at once, in one progress.json. """
+        shard_progress = [shard.sync(samples_done) for shard in self.shards]
+        if any(progress is None for progress in shard_progress):
+            return False
+        _save_progress(self.path, {'samples_done': samples_done, 'settings': settings, 'shards': shard_progress})
+        return True
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        manifest = {
+            'version': FORMAT_VERSION,
+            'dim': self.dim,
+            'size': self.size,
+            'num_shards': len(self.shards),
+            'shard_sizes': [shard.size for shard in self.shards],
+        }
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        if os.path.exists(os.path.join(self.path, PROGRESS_NAME)):
+            os.remove(os.path.join(self.path, PROGRESS_NAME))
+        logger.info("sharded datastore saved at %s, %d entries in %d shards", self.path, self.size, len(self.shards))
+
+
+def shard_dirs(path):
+    """ Shard directories of a sharded datastore, None for a plain one. """
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if 'num_shards' not in manifest:
+        return None
+    return [shard_dir(path, shard) for shard in range(manifest['num_shards'])]
+
+
+def _open_memmap(file_name, dtype, shape):
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', shape=shape)
+
+
+class QuantizedKeys(object):
+    """ Array-like view of the sq8 codes [size, dim] that decodes the rows it is indexed with to float32. """
+
+    def __init__(self, codes, quantizer):
+        self.codes = codes
+        self.quantizer = quantizer
+        self.shape = codes.shape
+        self.dtype = np.dtype('float32')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        codes = np.ascontiguousarray(self.codes[item]).reshape(-1, self.shape[1])
+        if codes.shape[0] == 0:
+            return np.zeros((0, self.shape[1]), dtype='float32')
+        return self.quantizer.sa_decode(codes)
+
+
+class Datastore(object):
+    """
+    Read-only view of a datastore directory, keys and vals are memory-mapped.
+
+    keys always reads as float (sq8 codes are decoded on access), codes is the raw uint8 view of
+    keys.bin of float16 and sq8 datastores that compressed indexes are built from, None for float32.
+    counts holds the entry counts of a compacted datastore, None for all others, and types the
+    (context, target) token types of the entries of datastores written with_types.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        assert self.manifest['version'] == FORMAT_VERSION, f"unsupported datastore version in {path}"
+
+        self.dim = self.manifest['dim']
+        self.size = self.manifest['size']
+        self.key_dtype = self.manifest['key_dtype']
+        self.quantizer = None
+        if self.key_dtype == SQ8_KEY_DTYPE:
+            import faiss
+
+            self.quantizer = faiss.read_index(os.path.join(path, KEY_QUANTIZER_NAME))
+            self.codes = _open_memmap(os.path.join(path, KEYS_NAME), 'uint8', (self.size, self.dim))
+            self.keys = QuantizedKeys(self.codes, self.quantizer)
+        else:
+            self.keys = _open_memmap(os.path.join(path, KEYS_NAME), self.key_dtype, (self.size, self.dim))
+            self.codes = self.keys.view('uint8') if self.key_dtype == 'float16' else None
+        self.vals = _open_memmap(os.path.join(path, VALS_NAME), self.manifest['value_dtype'], (self.size,))
+        self.counts = None
+        if self.manifest.get('has_counts', False):
+            self.counts = _open_memmap(os.path.join(path, COUNTS_NAME), COUNT_DTYPE, (self.size,))
+        self.types = None
+        if self.manifest.get('has_types', False):
+            self.types = _open_memmap(os.path.join(path, TYPES_NAME), TYPE_DTYPE, (self.size, 2))
+
+        self.files = np.load(os.path.join(path, FILES_NAME))
+        self.projects = np.load(os.path.join(path, PROJECTS_NAME))
+
+        self.file_ranges = {}  # file_id: (proj_id, start, end)
+        for proj_id, file_id, start, end in self.files.tolist():
+            if file_id in self.file_ranges:
+                raise ValueError(f"file {file_id} has several ranges in {path}, rebuild the datastore")
+            self.file_ranges[file_id] = (proj_id, start, end)
+        self.project_runs = {}  # proj_id: [(start, end)]
+        for proj_id, start, end in self.projects.tolist():
+            self.project_runs.setdefault(proj_id, []).append((start, end))
+
+    def __len__(self):
+        return self.size
+
+    def file_range(self, proj_id, file_id):
+        """ [start, end) of file_id, files that saved no entries get an empty range. """
+        _, start, end = self.file_ranges.get(file_id, (proj_id, 0, 0))
+        return start, end
+
+    def other_file_ranges(self, proj_id, file_id):
+        """ [start, end) ranges of the other files of the same project, the project runs minus file_id. """
+        file_start, file_end = self.file_range(proj_id, file_id)
+        ranges = []
+        for run_start, run_end in self.project_runs.get(proj_id, []):
+            for start, end in ((run_start, min(run_end, file_start)), (max(run_start, file_end), run_end)):
+                if start < end:
+                    ranges.append((start, end))
+        return ranges
+
+
+def _save_npy(file_name, array):
+    # written next to the old file and renamed over it, readers never see a partial file
+    with open(file_name + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def _save_manifest(path, manifest):
+    manifest_file = os.path.join(path, MANIFEST_NAME)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def load_progress(path):
+    """ Progress of the last checkpoint of an unfinished build at path, None if there is none. """
+    progress_file = os.path.join(path, PROGRESS_NAME)
+    if datastore_exists(path) or not os.path.exists(progress_file):
+        return None
+    with open(progress_file) as f:
+        return json.load(f)
+
+
+def _save_progress(path, progress):
+    # renamed over the old progress, a build killed while checkpointing resumes from the previous one
+    progress_file = os.path.join(path, PROGRESS_NAME)
+    with open(progress_file + '.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.replace(progress_file + '.tmp', progress_file)
+
+
+def _progress_matches(progress, dim, key_dtype, with_counts, with_types):
+    key_dtype = key_dtype if key_dtype == SQ8_KEY_DTYPE else np.dtype(key_dtype).name
+    return (progress.get('version') == FORMAT_VERSION and progress['dim'] == dim and
+            progress['key_dtype'] == key_dtype and progress['has_counts'] == with_counts and
+            progress['has_types'] == with_types)
+
+
+def _append_rows(file_name, rows, start):
+    """ Write rows after the first start rows of a raw array file, dropping whatever followed them. """
+    row_bytes = rows.dtype.itemsize * int(np.prod(rows.shape[1:]))
+    with open(file_name, 'r+b' if os.path.exists(file_name) else 'wb') as f:
+        f.truncate(start * row_bytes)
+        f.seek(start * row_bytes)
+        f.write(np.ascontiguousarray(rows).tobytes())
+
+
+class DatastoreUpdater(object):
+    """
+    Replaces, adds and removes whole files of a project datastore in place.
+
+    The entries of a new file version are appended to the arrays and the range of the old one
+    becomes dead: it leaves files.npy, so no project run and no index covers it any more. The
+    manifest is replaced last, so a crash leaves the previous state readable. Processes that
+    opened the datastore before keep reading the old state until they open it again.
+    """
+
+    def __init__(self, path):
+        datastore = Datastore(path)
+        self.path = path
+        self.manifest = dict(datastore.manifest)
+        self.dim = datastore.dim
+        self.key_dtype = datastore.key_dtype
+        self.quantizer = datastore.quantizer
+        self.has_counts = datastore.counts is not None
+        self.has_types = datastore.types is not None
+        self.files = datastore.files.tolist()
+
+    @property
+    def size(self):
+        return self.manifest['size']
+
+    @property
+    def num_dead(self):
+        return self.manifest.get('num_dead', 0)
+
+    def file_range(self, file_id):
+        """ (proj_id, start, end) of file_id, None if it is not in the datastore. """
+        for proj_id, other_file_id, start, end in self.files:
+            if other_file_id == file_id:
+                return proj_id, start, end
+        return None
+
+    def replace_file(self, proj_id, file_id, keys, vals, types=None):
+        """
+        Make keys [n, dim] / vals [n] the entries of file_id, a file that is not in the datastore
+        yet is added to proj_id. types [n, 2] are required if the datastore stores types.
+        Returns the [start, end) range of the old entries, empty for a new file, and the range of
+        the new ones.
+        """
+        assert types is not None or not self.has_types, "the datastore stores the token types of its entries"
+        old_range = self._drop_file(file_id, proj_id)
+        start, end = self._append(keys, vals, types)
+        if end > start:
+            self.files.append([proj_id, file_id, start, end])
+        self._commit()
+        return old_range, (start, end)
+
+    def remove_file(self, file_id):
+        """ Drop the entries of file_id, returns the [start, end) range they had. """
+        old_range = self._drop_file(file_id)
+        self._commit()
+        return old_range
+
+    def _drop_file(self, file_id, proj_id=None):
+        old = self.file_range(file_id)
+        if old is None:
+            return 0, 0
+        old_proj_id, start, end = old
+        assert proj_id is None or proj_id == old_proj_id, f"file {file_id} belongs to project {old_proj_id}"
+        self.files = [row for row in self.files if row[1] != file_id]
+        self.manifest['num_dead'] = self.num_dead + end - start
+        return start, end
+
+    def _append(self, keys, vals, types=None):
+        keys = np.ascontiguousarray(keys, dtype='float32').reshape(-1, self.dim)
+        vals = np.asarray(vals).reshape(-1)
+        assert keys.shape[0] == vals.shape[0]
+        start = self.size
+        if self.key_dtype == SQ8_KEY_DTYPE:
+            codes = self.quantizer.sa_encode(keys)
+        else:
+            codes = keys.astype(self.key_dtype)
+        _append_rows(os.path.join(self.path, KEYS_NAME), codes, start)
+        _append_rows(os.path.join(self.path, VALS_NAME), vals.astype(VALUE_DTYPE), start)
+        if self.has_counts:
+            _append_rows(os.path.join(self.path, COUNTS_NAME), np.ones(len(vals), dtype=COUNT_DTYPE), start)
+        if self.has_types:
+            _append_rows(os.path.join(self.path, TYPES_NAME), np.asarray(types, dtype=TYPE_DTYPE).reshape(-1, 2),
+                         start)
+        self.manifest['size'] = start + len(vals)
+        return start, self.size
+
+    def _commit(self):
+        files = np.array(self.files, dtype='int64').reshape(-1, 4)
+        projects = np.array(build_project_runs(self.files), dtype='int64').reshape(-1, 3)
+        _save_npy(os.path.join(self.path, FILES_NAME), files)
+        _save_npy(os.path.join(self.path, PROJECTS_NAME), projects)
+        self.manifest['num_files'] = len(files)
+        self.manifest['num_projects'] = len(set(projects[:, 0].tolist()))
+        _save_manifest(self.path, self.manifest)
+
+
+def compact_dead_entries(path, output_path, chunk_size=65536):
+    """
+    Copy the live entries of the datastore at path to output_path, without the dead ones and with
+    the files of every project next to each other, so that every project is a single run.
+    Keys are copied as stored. Returns the old position of every entry of the new datastore.
+    """
+    datastore = Datastore(path)
+    os.makedirs(output_path)
+    stored_keys = datastore.codes if datastore.key_dtype == SQ8_KEY_DTYPE else datastore.keys
+    arrays = [(KEYS_NAME, stored_keys), (VALS_NAME, datastore.vals)]
+    if datastore.counts is not None:
+        arrays.append((COUNTS_NAME, datastore.counts))
+    if datastore.types is not None:
+        arrays.append((TYPES_NAME, datastore.types))
+    writers = [(ChunkedArrayWriter(os.path.join(output_path, name), array.shape[1:], array.dtype, chunk_size), array)
+               for name, array in arrays]
+
+    files = []
+    old_positions = []
+    for proj_id, file_id, start, end in sorted(datastore.files.tolist(), key=lambda x: (x[0], x[2])):
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            for writer, array in writers:
+                writer.add(array[chunk_start: chunk_end])
+        new_start = files[-1][3] if files else 0
+        files.append([proj_id, file_id, new_start, new_start + end - start])
+        old_positions.append(np.arange(start, end, dtype='int64'))
+    for writer, _ in writers:
+        writer.close()
+
+    if datastore.quantizer is not None:
+        shutil.copyfile(os.path.join(path, KEY_QUANTIZER_NAME), os.path.join(output_path, KEY_QUANTIZER_NAME))
+    files = np.array(files, dtype='int64').reshape(-1, 4)
+    projects = np.array(build_project_runs(files.tolist()), dtype='int64').reshape(-1, 3)
+    np.save(os.path.join(output_path, FILES_NAME), files)
+    np.save(os.path.join(output_path, PROJECTS_NAME), projects)
+    old_positions = np.concatenate(old_positions + [np.zeros((0,), dtype='int64')])
+    manifest = dict(datastore.manifest, size=len(old_positions), num_dead=0, num_files=len(files))
+    _save_manifest(output_path, manifest)
+    logger.info(f"compacted {datastore.size} entries of {path} into {len(old_positions)} at {output_path}")
+    return old_positions
+
+
+def swap_datastore(new_path, path):
+    """ Move the datastore at new_path to path, in place of the old one. """
+    old_path = path.rstrip('/') + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    os.rename(path, old_path)
+    os.rename(new_path, path)
+    # open memmaps of the old files stay valid after the removal
+    shutil.rmtree(old_path)
+
+
+LM_QUERIES_NAME = 'queries.bin'
+LM_IDS_NAME = 'lm_ids.bin'
+LM_PROBS_NAME = 'lm_probs.bin'
+LM_SAMPLES_NAME = 'samples.npy'
+
+
+class LMCacheWriter(object):
+    """
+    Keeps what the kNN phase needs from the datastore pass, so it can run without a model forward:
+    the query hidden state and the LM top-k (ids, fp16 probs) of every non-pad eval position, and
+    the [start, end) range of every eval sample.
+
+    When every query is also a datastore key (no --only_id filtering) the queries are not written
+    again and LMCache reads them from the datastore keys.
+
+    It lives in the LM_CACHE_DIR of the datastore it was built with, whose manifest it records
+    along with the number of eval samples, see lm_cache_matches.
+    """
+
+    def __init__(self, path, dim, topk, vocab_size, share_keys, key_dtype='float32', chunk_size=65536):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest_file = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        self.path = path
+        self.dim = dim
+        self.topk = topk
+        self.vocab_size = vocab_size
+        self.share_keys = share_keys
+        self.key_dtype = np.dtype(key_dtype)
+        self.samples = []
+        self._queries = None
+        if not share_keys:
+            self._queries = ChunkedArrayWriter(os.path.join(path, LM_QUERIES_NAME), (dim,), self.key_dtype, chunk_size)
+        self._ids = ChunkedArrayWriter(os.path.join(path, LM_IDS_NAME), (topk,), 'int32', chunk_size)
+        self._probs = ChunkedArrayWriter(os.path.join(path, LM_PROBS_NAME), (topk,), 'float16', chunk_size)
+
+    @property
+    def size(self):
+        return self._ids.size
+
+    def add_batch(self, hidden_states, lm_scores, mask):
+        """
+        hidden_states [batch_size, seq_len, dim], lm_scores [batch_size, seq_len, vocab_size] logits
+        and mask [batch_size, seq_len] of the positions that are queried later.
+        """
+        lm_probs, lm_ids = lm_scores[mask].float().softmax(dim=-1).topk(self.topk, dim=-1)
+        start = self.size
+        if self._queries is not None:
+            keys = hidden_states[mask]
+            keys = keys.half() if self.key_dtype == np.float16 else keys.float()
+            self._queries.add(keys.cpu().numpy())
+        self._ids.add(lm_ids.int().cpu().numpy())
+        self._probs.add(lm_probs.half().cpu().numpy())
+        for count in mask.sum(-1).cpu().tolist():
+            self.samples.append((start, start + count))
+            start += count
+
+    def close(self, datastore):
+        """ Write the manifest, datastore is the closed datastore of the same pass. """
+        for writer in (self._queries, self._ids, self._probs):
+            if writer is not None:
+                writer.close()
+        np.save(os.path.join(self.path, LM_SAMPLES_NAME), np.array(self.samples, dtype='int64').reshape(-1, 2))
+        manifest = {
+            'version': FORMAT_VERSION,
+            'dim': self.dim,
+            'size': self.size,
+            'num_samples': len(self.samples),
+            'topk': self.topk,
+            'vocab_size': self.vocab_size,
+            'share_keys': self.share_keys,
+            'key_dtype': self.key_dtype.name,
+            'datastore': datastore.manifest,
+        }
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        logger.info("lm cache saved at %s, %d queries, %d samples", self.path, self.size, len(self.samples))
+
+
+def lm_cache_matches(path, datastore, num_samples):
+    """ Whether the lm cache at path was saved by the pass that built datastore, over num_samples eval samples. """
+    if not datastore_exists(path):
+        return False
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    return manifest.get('datastore') == datastore.manifest and manifest.get('num_samples') == num_samples
+
+
+class LMCache(object):
+    """ Read-only view of an LMCacheWriter directory. """
+
+    def __init__(self, path, datastore=None):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        self.dim = self.manifest['dim']
+        self.size = self.manifest['size']
+        self.topk = self.manifest['topk']
+        self.vocab_size = self.manifest['vocab_size']
+        if self.manifest['share_keys']:
+            assert datastore is not None and len(datastore) == self.size, \
+                "the lm cache shares its queries with a datastore of a different size"
+            self.queries = datastore.keys
+        else:
+            self.queries = _open_memmap(os.path.join(path, LM_QUERIES_NAME), self.manifest['key_dtype'],
+                                        (self.size, self.dim))
+        self.lm_ids = _open_memmap(os.path.join(path, LM_IDS_NAME), 'int32', (self.size, self.topk))
+        self.lm_probs = _open_memmap(os.path.join(path, LM_PROBS_NAME), 'float16', (self.size, self.topk))
+        self.samples = np.load(os.path.join(path, LM_SAMPLES_NAME))
+
+    def __len__(self):
+        return len(self.samples)
@@ -0,0 +1,241 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Pipelined eval loop: model forward, kNN search and detokenization of consecutive batches overlap.
+
+Every stage runs in its own thread and hands its output to the next one through a bounded
+queue, so while batch i is searched, batch i+1 goes through the model and batch i-1 is
+detokenized. The model forward and the faiss search release the GIL, the detokenization is
+pure python, so the stages mostly run in parallel:
+
+    pipeline = Pipeline([('forward', forward), ('search', search), ('detokenize', detokenize)], depth=1)
+    for all_pred, all_gt in pipeline.run(eval_dataloader):
+        ...
+    pipeline.log(logger)
+
+The outputs come in the order of the inputs. depth=0 runs the stages one after another in the
+calling thread, which is the plain eval loop. Grad mode is thread local, stages that run the
+model have to enter torch.no_grad() themselves.
+"""
+
+import queue
+import threading
+import time
+
+SPECIAL_GTS = ["<s>", "</s>", "<EOL>", "<pad>"]
+
+_DONE = object()
+
+
+class _Failure(object):
+    """ Exception of a stage, passed down the pipeline and raised by Pipeline.run. """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class StageStats(object):
+    """ Number of items and busy time of a stage, and the time it waited for its input. """
+
+    def __init__(self, name):
+        self.name = name
+        self.num_items = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    def call(self, fn, item):
+        start = time.time()
+        output = fn(item)
+        self.busy_time += time.time() - start
+        self.num_items += 1
+        return output
+
+    @property
+    def throughput(self):
+        """ Items per second the stage processes on its own. """
+        return self.num_items / max(self.busy_time, 1e-9)
+
+
+def _put(q, item, stop):
+    """ Put item in q unless the pipeline is stopped, False if it was. """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class Pipeline(object):
+    """ Stages (name, fn) applied in order to every item, in one thread per stage with queues of depth items. """
+
+    def __init__(self, stages, depth=1):
+        self.stages = list(stages)
+        self.depth = depth
+        self.stats = [StageStats(name) for name, _ in self.stages]
+        self.wall_time = 0.0
+
+    def _feed(self, items, output_queue, stop):
+        try:
+            for item in items:
+                if not _put(output_queue, item, stop):
+                    return
+        except Exception as e:
+            _put(output_queue, _Failure(e), stop)
+            return
+        _put(output_queue, _DONE, stop)
+
+    def _serve(self, fn, stats, input_queue, output_queue, stop):
+        while not stop.is_set():
+            wait_start = time.time()
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            stats.wait_time += time.time() - wait_start
+            if item is _DONE or isinstance(item, _Failure):
+                _put(output_queue, item, stop)
+                return
+            try:
+                output = stats.call(fn, item)
+            except Exception as e:
+                _put(output_queue, _Failure(e), stop)
+                return
+            if not _put(output_queue, output, stop):
+                return
+
+    def run(self, items):
+        """ Generator of the outputs of the last stage, in the order of items. """
+        start = time.time()
+        if self.depth <= 0:
+            for item in items:
+                for (_, fn), stats in zip(self.stages, self.stats):
+                    item = stats.call(fn, item)
+                yield item
+            self.wall_time += time.time() - start
+            return
+
+        queues = [queue.Queue(self.depth) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop), daemon=True)]
+        for i, ((name, fn), stats) in enumerate(zip(self.stages, self.stats)):
+            threads.append(threading.Thread(target=self._serve, name=f"pipeline-{name}", daemon=True,
+                                            args=(fn, stats, queues[i], queues[i + 1], stop)))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                output = queues[-1].get()
+                if output is _DONE:
+                    break
+                if isinstance(output, _Failure):
+                    raise output.exception
+                yield output
+        finally:
+            # an abandoned generator or a failed stage stops the threads blocked on a full queue
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall_time += time.time() - start
+
+    def log(self, logger):
+        for stats in self.stats:
+            logger.info(f"stage {stats.name}: {stats.num_items} batches, busy {stats.busy_time:.1f}s "
+                        f"({stats.throughput:.2f} batches/s), waited {stats.wait_time:.1f}s for input")
+        # the sum of the busy times is what the stages take one after another
+        busy_time = sum(stats.busy_time for stats in self.stats)
+        num_items = self.stats[-1].num_items if self.stats else 0
+        logger.info(f"pipeline: {num_items} batches in {self.wall_time:.1f}s "
+                    f"({num_items / max(self.wall_time, 1e-9):.2f} batches/s), "
+                    f"{busy_time / max(self.wall_time, 1e-9):.2f}x the sequential stage time")
+
+
+def decode_ids(tokenizer, idxs):
+    """ Code string of the token ids idxs, with a space before every word start and around special tokens. """
+    codes = ""
+    for idx in idxs:
+        to_add = tokenizer.convert_ids_to_tokens(idx)
+        if to_add[0] == '\u0120':
+            if not codes.endswith(" "):
+                codes += " " + to_add[1:]
+            else:
+                codes += to_add[1:]
+        elif (
+            idx in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id] or
+            to_add.startswith("<NUM_LIT")
+        ):
+            codes += " " + to_add + " "
+        else:
+            codes += to_add
+    return codes.strip(" ")
+
+
+def decode_batch(tokenizer, pred_ids, inputs):
+    """
+    Predicted and ground truth tokens of a batch, the sub-tokens of pred_ids [batch_size, seq_len]
+    (the prediction of position i is the one of i-1) and inputs are merged into whole tokens.
+    """
+    special_ids = [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id]
+    all_pred = []
+    all_gt = []
+    prev_pred = None
+    for pred, gt in zip(pred_ids, inputs):
+        pred = pred.cpu().tolist()
+        gt = gt.cpu().tolist()
+
+        for i, y in enumerate(gt):
+            if i == 0:
+                if y in special_ids:
+                    now_gt = [y]
+                    now_pred = [0] if prev_pred is None else [prev_pred]
+                    all_pred.append(decode_ids(tokenizer, now_pred).strip().split()[0])
+                    all_gt.append(decode_ids(tokenizer, now_gt).strip())
+                    now_gt = []
+                    now_pred = []
+                else:
+                    now_gt = [y]
+                    now_pred = [0] if prev_pred is None else [prev_pred]
+            else:
+                if tokenizer.convert_ids_to_tokens(y)[0] == '\u0120':
+                    if len(now_gt) > 0:
+                        try:
+                            all_pred.append(decode_ids(tokenizer, now_pred).strip().split()[0])
+                        except IndexError:
+                            all_pred.append("<SPACE>")
+                        all_gt.append(decode_ids(tokenizer, now_gt).strip())
+                        now_gt = []
+                        now_pred = []
+                if y in special_ids or tokenizer.convert_ids_to_tokens(y).startswith("<NUM_LIT"):
+                    if len(now_gt) > 0:
+                        try:
+                            all_pred.append(decode_ids(tokenizer, now_pred).strip().split()[0])
+                        except IndexError:
+                            all_pred.append("<SPACE>")
+                        all_gt.append(decode_ids(tokenizer, now_gt).strip())
+                    now_gt = [y]
+                    now_pred = [pred[i - 1]]
+                    try:
+                        all_pred.append(decode_ids(tokenizer, now_pred).strip().split()[0])
+                    except IndexError:
+                        all_pred.append("<SPACE>")
+                    all_gt.append(decode_ids(tokenizer, now_gt).strip())
+                    now_gt = []
+                    now_pred = []
+                    continue
+                now_gt.append(y)
+                now_pred.append(pred[i - 1])
+    assert len(all_pred) == len(all_gt)
+    return all_pred, all_gt
+
+
+def count_correct(all_pred, all_gt):
+    """ Number of tokens of all_gt that are not special tokens, and how many of them all_pred got right. """
+    total = 0
+    correct = 0
+    for x, y in zip(all_pred, all_gt):
+        if y not in SPECIAL_GTS:
+            total += 1
+            if x == y:
+                correct += 1
+    return total, correct
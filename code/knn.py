@@ -0,0 +1,1833 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Nearest neighbour retrieval over the on-disk datastore.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+# lets faiss indexes search torch tensors in place, on the cpu and on the gpu
+import faiss.contrib.torch_utils  # noqa: F401
+import numpy as np
+import torch
+
+from datastore import (ChunkedArrayWriter, Datastore, FORMAT_VERSION, INDEXES_DIR, KEYS_NAME, MANIFEST_NAME,
+                       PROJECTIONS_DIR, SQ8_KEY_DTYPE, TRANSFORM_NAME, _append_rows, _open_memmap, _save_manifest)
+
+logger = logging.getLogger(__name__)
+
+# faiss gpu indexes can not return more neighbours than this in one search
+GPU_MAX_K = 2048
+
+FLAT_SPEC = 'Flat'
+# exact search in pure torch, see TorchFlatIndex
+TORCH_FLAT_SPEC = 'TorchFlat'
+# elements of the [num_queries, tile_size] distance block TorchFlatIndex aims for
+TORCH_TILE_ELEMENTS = 1 << 24
+# elements of the [pairs, dim] key block gathered per step of the full precision re-ranking
+RERANK_ELEMENTS = 1 << 24
+# faiss warns below 39 training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+class CopyStats(object):
+    """
+    Bytes copied and tensors allocated by the retrieval path, logged at the end of an eval. The
+    counters are updated under a lock, projects are searched in parallel threads.
+    """
+
+    def __init__(self):
+        self.num_queries = 0
+        self.num_copies = 0
+        self.bytes_copied = 0
+        self.num_allocations = 0
+        self.bytes_allocated = 0
+        self._lock = threading.Lock()
+
+    def to(self, tensor, device, dtype=None):
+        """ tensor.to(device, dtype) as a contiguous tensor, counting the bytes if that needed a copy. """
+        moved = tensor.to(device=device, dtype=dtype or tensor.dtype).contiguous()
+        if moved.data_ptr() != tensor.data_ptr() or moved.device != tensor.device:
+            with self._lock:
+                self.num_copies += 1
+                self.bytes_copied += moved.numel() * moved.element_size()
+        return moved
+
+    def allocated(self, *tensors):
+        num_bytes = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+        with self._lock:
+            self.num_allocations += len(tensors)
+            self.bytes_allocated += num_bytes
+
+    def searched(self, num_queries):
+        with self._lock:
+            self.num_queries += num_queries
+
+    def log(self, logger):
+        num_queries = max(self.num_queries, 1)
+        logger.info(f"retrieval copies: {self.num_copies} ({self.bytes_copied / 2 ** 20:.1f} MB, "
+                    f"{self.bytes_copied / num_queries:.0f} B/query), allocations: {self.num_allocations} "
+                    f"({self.bytes_allocated / 2 ** 20:.1f} MB, {self.bytes_allocated / num_queries:.0f} B/query) "
+                    f"for {self.num_queries} queries")
+
+
+copy_stats = CopyStats()
+
+
+def min_train_size(index):
+    """ Number of training points an untrained index needs, 0 if it needs no training. """
+    if index.is_trained:
+        return 0
+    num_centroids = 1
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        num_centroids = max(num_centroids, ivf.nlist)
+        ivf = faiss.downcast_index(ivf)
+        if hasattr(ivf, 'pq'):
+            num_centroids = max(num_centroids, ivf.pq.ksub)
+    except RuntimeError:
+        pass
+    return MIN_POINTS_PER_CENTROID * num_centroids
+
+
+def build_index(keys, index_spec=FLAT_SPEC, train_size=65536, seed=42, ids=None):
+    """
+    Build a faiss index from an index_factory spec ("Flat", "IVF1024,Flat", "IVF1024,PQ64",
+    "HNSW32", ...) over keys [n, dim] float32. Indexes that need training are trained on a
+    random sample of at most train_size keys, projects with too few keys for the spec get an
+    exact flat index. With ids [n] int64 the index is wrapped in an IndexIDMap that returns
+    them instead of the positions in keys. Returns the index and the spec it was built with.
+    """
+    dim = keys.shape[1]
+    index = faiss.index_factory(dim, index_spec)
+    needed = min_train_size(index)
+    if needed > len(keys):
+        index_spec = FLAT_SPEC
+        index = faiss.IndexFlatL2(dim)
+    elif needed > 0:
+        sample_size = min(len(keys), max(train_size, needed))
+        sample = np.random.RandomState(seed).choice(len(keys), sample_size, replace=False)
+        index.train(keys[np.sort(sample)])
+    if ids is not None:
+        index = faiss.IndexIDMap(index)
+        index.add_with_ids(keys, ids)
+    else:
+        index.add(keys)
+    return index, index_spec
+
+
+def run_ids(runs):
+    """ Datastore positions [n] int64 of the entries of the runs [(start, end)], in run order. """
+    return np.concatenate([np.arange(start, end, dtype='int64') for start, end in runs] +
+                          [np.zeros((0,), dtype='int64')])
+
+
+def position_runs(positions):
+    """ Sorted datastore positions as the [(start, end)] runs of consecutive positions. """
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = positions[np.r_[0, breaks]]
+    ends = positions[np.r_[breaks - 1, len(positions) - 1]] + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def stored_codes_index(datastore, runs):
+    """
+    Exact IndexScalarQuantizer over the runs of a float16 or sq8 datastore. The codes of keys.bin
+    are copied into the index as they are, so the index is as small as the keys on disk and the
+    distances are computed on the codes.
+    """
+    if datastore.key_dtype == SQ8_KEY_DTYPE:
+        index = faiss.clone_index(datastore.quantizer)
+    else:
+        index = faiss.IndexScalarQuantizer(datastore.dim, faiss.ScalarQuantizer.QT_fp16)
+    codes = np.concatenate([datastore.codes[start: end] for start, end in runs] +
+                           [np.zeros((0, index.code_size), dtype='uint8')])
+    faiss.copy_array_to_vector(codes.ravel(), index.codes)
+    index.ntotal = codes.shape[0]
+    return index
+
+
+def set_index_params(index, index_spec, index_params):
+    """ Apply runtime search parameters such as "nprobe=16" or "efSearch=128" to a non flat index. """
+    if index_params and index_spec != FLAT_SPEC:
+        faiss.ParameterSpace().set_index_parameters(index, index_params)
+
+
+def _spec_name(spec):
+    return re.sub(r'[^A-Za-z0-9]+', '_', spec)
+
+
+def index_spec_dir(datastore_path, index_spec, projection_spec=''):
+    """ Directory of the persisted indexes of one spec, e.g. datastore/indexes/IVF1024_Flat or PCA128_IVF1024_Flat. """
+    name = _spec_name(index_spec) if not projection_spec else _spec_name(projection_spec) + '_' + _spec_name(index_spec)
+    return os.path.join(datastore_path, INDEXES_DIR, name)
+
+
+def write_index_spec_manifest(spec_dir, index_spec, projection_spec):
+    """ Record the specs of an index spec directory, its name alone is ambiguous. """
+    manifest_file = os.path.join(spec_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        os.makedirs(spec_dir, exist_ok=True)
+        with open(manifest_file, 'w') as f:
+            json.dump({'version': FORMAT_VERSION, 'index_spec': index_spec, 'projection_spec': projection_spec}, f,
+                      indent=2)
+
+
+def save_index(index, index_file):
+    faiss.write_index(index, index_file + '.tmp')
+    os.replace(index_file + '.tmp', index_file)
+
+
+def index_nbytes(index):
+    """ Memory held by a cpu faiss index or a TorchFlatIndex, as budgeted by ProjectIndexCache. """
+    if isinstance(index, TorchFlatIndex):
+        return sum(tensor.numel() * tensor.element_size() for tensor in (index.keys, index.key_norms))
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return index_nbytes(index.index) + 8 * index.ntotal
+    if isinstance(index, faiss.IndexIVF):
+        num_entries = sum(index.invlists.list_size(i) for i in range(index.nlist))
+        return num_entries * (index.code_size + 8) + index_nbytes(index.quantizer)
+    if isinstance(index, faiss.IndexFlat):
+        return 4 * index.ntotal * index.d
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return index.ntotal * index.code_size
+    return faiss.serialize_index(index).nbytes
+
+
+def selector_search(index, xq, k, selector):
+    """
+    Search of a cpu faiss index restricted to the ids a faiss IDSelector accepts, with the runtime
+    parameters set on the index. xq [n, dim] is a contiguous float32 numpy array. Returns distance
+    and id tensors [n, k], missing neighbours have distance inf and id -1.
+    """
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(base, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = base.nprobe
+    elif isinstance(base, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = base.hnsw.efSearch
+    else:
+        params = faiss.SearchParameters()
+    params.sel = selector
+    dists = np.empty((len(xq), k), dtype='float32')
+    ids = np.empty((len(xq), k), dtype='int64')
+    # the search wrapper of faiss.contrib.torch_utils drops the parameters, search_c takes them
+    index.search_c(len(xq), faiss.swig_ptr(xq), k, faiss.swig_ptr(dists), faiss.swig_ptr(ids), params)
+    dists[ids < 0] = np.inf
+    return torch.from_numpy(dists), torch.from_numpy(ids)
+
+
+def projection_dir(datastore_path, projection_spec):
+    return os.path.join(datastore_path, PROJECTIONS_DIR, _spec_name(projection_spec))
+
+
+def build_key_projection(datastore, projection_spec, sample_size=65536, chunk_size=65536, seed=42):
+    """
+    Fit a faiss VectorTransform spec ("PCA128", "OPQ16_128", "PCAR64", ...) on a random sample of the
+    datastore keys and save it with all keys projected, under datastore/projections/<spec>/.
+    """
+    path = projection_dir(datastore.path, projection_spec)
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            if json.load(f)['size'] == datastore.size:
+                return path
+        logger.warning(f"projection {projection_spec} does not cover all keys of {datastore.path}, fitting it again")
+        # the indexes over the old projected keys go with them
+        for spec_dir, manifest in _saved_dirs(datastore.path, INDEXES_DIR):
+            if manifest is None or manifest['projection_spec'] == projection_spec:
+                shutil.rmtree(spec_dir)
+    os.makedirs(path, exist_ok=True)
+    # the factory builds the transform as the first stage of an IndexPreTransform, which owns it
+    pre_transform = faiss.downcast_index(faiss.index_factory(datastore.dim, projection_spec + ',Flat'))
+    transform = faiss.downcast_VectorTransform(pre_transform.chain.at(0))
+
+    sample = np.random.RandomState(seed).choice(datastore.size, min(sample_size, datastore.size), replace=False)
+    transform.train(np.ascontiguousarray(datastore.keys[np.sort(sample)], dtype='float32'))
+    writer = ChunkedArrayWriter(os.path.join(path, KEYS_NAME), (transform.d_out,), 'float32', chunk_size)
+    for start in range(0, datastore.size, chunk_size):
+        writer.add(transform.apply(np.ascontiguousarray(datastore.keys[start: start + chunk_size], dtype='float32')))
+    writer.close()
+    faiss.write_VectorTransform(transform, os.path.join(path, TRANSFORM_NAME))
+
+    manifest = {
+        'version': FORMAT_VERSION,
+        'spec': projection_spec,
+        'dim': transform.d_out,
+        'size': datastore.size,
+        'sample_size': len(sample),
+    }
+    with open(os.path.join(path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logger.info(f"projection {projection_spec} of {datastore.size} keys saved at {path}")
+    return path
+
+
+class KeyProjection(object):
+    """
+    Linear projection y = x A^T + b of the datastore keys, with the projected keys memory-mapped.
+    Queries are projected in torch on their own device with the same matrix.
+    """
+
+    def __init__(self, path, device):
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        self.spec = self.manifest['spec']
+        self.dim = self.manifest['dim']
+        self.keys = _open_memmap(os.path.join(path, KEYS_NAME), 'float32', (self.manifest['size'], self.dim))
+        transform = faiss.downcast_VectorTransform(faiss.read_VectorTransform(os.path.join(path, TRANSFORM_NAME)))
+        A = faiss.vector_to_array(transform.A).reshape(transform.d_out, transform.d_in)
+        b = faiss.vector_to_array(transform.b) if transform.have_bias else np.zeros(transform.d_out)
+        self.A = torch.from_numpy(A.astype('float32')).to(device)
+        self.b = torch.from_numpy(b.astype('float32')).to(device)
+
+    def apply(self, x):
+        return torch.addmm(self.b.to(x.device), x.float(), self.A.to(x.device).t())
+
+
+def open_key_projection(datastore, projection_spec, device, sample_size=65536):
+    """ KeyProjection of projection_spec, fitted and saved first if needed, None without a spec. """
+    if not projection_spec:
+        return None
+    return KeyProjection(build_key_projection(datastore, projection_spec, sample_size), device)
+
+
+def _saved_dirs(datastore_path, dir_name):
+    """ (path, manifest) of the sub-directories of datastore/<dir_name>, manifest is None if it has none. """
+    parent = os.path.join(datastore_path, dir_name)
+    dirs = []
+    for name in sorted(os.listdir(parent)) if os.path.isdir(parent) else []:
+        manifest = None
+        if os.path.exists(os.path.join(parent, name, MANIFEST_NAME)):
+            with open(os.path.join(parent, name, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        dirs.append((os.path.join(parent, name), manifest))
+    return dirs
+
+
+def append_projected_keys(datastore, start, end, chunk_size=65536):
+    """
+    Project the keys [start, end) just appended to datastore into every saved KeyProjection.
+    Projections that do not end at start are out of date and removed, they are fitted again on use.
+    """
+    for path, manifest in _saved_dirs(datastore.path, PROJECTIONS_DIR):
+        if manifest is None or manifest['size'] != start:
+            shutil.rmtree(path)
+            continue
+        transform = faiss.read_VectorTransform(os.path.join(path, TRANSFORM_NAME))
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            keys = np.ascontiguousarray(datastore.keys[chunk_start: chunk_end], dtype='float32')
+            _append_rows(os.path.join(path, KEYS_NAME), transform.apply(keys), chunk_start)
+        _save_manifest(path, dict(manifest, size=end))
+
+
+def update_persisted_indexes(datastore, proj_id, removed_range, added_range):
+    """
+    Replace the entries removed_range of proj_id by the entries added_range (datastore positions)
+    in its persisted indexes, with remove_ids and add_with_ids. Run append_projected_keys first.
+    Indexes that can not be updated in place are removed and rebuilt on first use, and so is the
+    index over the whole datastore.
+    """
+    for spec_dir, manifest in _saved_dirs(datastore.path, INDEXES_DIR):
+        # the type partitions of the project and of the whole datastore are rebuilt on first use
+        for name in os.listdir(spec_dir):
+            if name == 'all.index' or name.startswith(f"{proj_id}_type") or name.startswith('all_type'):
+                os.remove(os.path.join(spec_dir, name))
+        index_file = os.path.join(spec_dir, f"{proj_id}.index")
+        if not os.path.exists(index_file):
+            continue
+        index = faiss.read_index(index_file)
+        projection_spec = manifest['projection_spec'] if manifest is not None else ''
+        keys = datastore.keys if not projection_spec else \
+            KeyProjection(projection_dir(datastore.path, projection_spec), 'cpu').keys
+        try:
+            assert manifest is not None and isinstance(index, faiss.IndexIDMap)
+            start, end = removed_range
+            if end > start:
+                index.remove_ids(faiss.IDSelectorRange(start, end))
+            start, end = added_range
+            if end > start:
+                index.add_with_ids(np.ascontiguousarray(keys[start: end], dtype='float32'),
+                                   np.arange(start, end, dtype='int64'))
+        except (AssertionError, RuntimeError):
+            # saved before ids were used, or the index type does not support removal
+            os.remove(index_file)
+            continue
+        save_index(index, index_file)
+
+
+def remap_persisted(datastore_path, output_path, old_positions, chunk_size=65536):
+    """
+    Carry the projections and the persisted indexes of a datastore over to its compacted copy at
+    output_path, whose entry i is entry old_positions[i] of the datastore (see compact_dead_entries).
+    The ids of the indexes are remapped without rebuilding them. What can not be carried over
+    is left out and rebuilt on first use.
+    """
+    new_ids = np.full(Datastore(datastore_path).size, -1, dtype='int64')
+    new_ids[old_positions] = np.arange(len(old_positions))
+
+    for path, manifest in _saved_dirs(datastore_path, PROJECTIONS_DIR):
+        if manifest is None or manifest['size'] != len(new_ids):
+            continue
+        keys = _open_memmap(os.path.join(path, KEYS_NAME), 'float32', (manifest['size'], manifest['dim']))
+        new_path = os.path.join(output_path, PROJECTIONS_DIR, os.path.basename(path))
+        os.makedirs(new_path)
+        shutil.copyfile(os.path.join(path, TRANSFORM_NAME), os.path.join(new_path, TRANSFORM_NAME))
+        writer = ChunkedArrayWriter(os.path.join(new_path, KEYS_NAME), (manifest['dim'],), 'float32', chunk_size)
+        for start in range(0, len(old_positions), chunk_size):
+            writer.add(keys[old_positions[start: start + chunk_size]])
+        writer.close()
+        _save_manifest(new_path, dict(manifest, size=len(old_positions)))
+
+    for spec_dir, manifest in _saved_dirs(datastore_path, INDEXES_DIR):
+        if manifest is None:
+            continue
+        new_spec_dir = os.path.join(output_path, INDEXES_DIR, os.path.basename(spec_dir))
+        write_index_spec_manifest(new_spec_dir, manifest['index_spec'], manifest['projection_spec'])
+        for name in os.listdir(spec_dir):
+            if not name.endswith('.index') or name == 'all.index':
+                continue
+            index = faiss.read_index(os.path.join(spec_dir, name))
+            if not isinstance(index, faiss.IndexIDMap):
+                continue
+            ids = new_ids[faiss.vector_to_array(index.id_map)]
+            if (ids < 0).any():
+                continue
+            faiss.copy_array_to_vector(ids, index.id_map)
+            save_index(index, os.path.join(new_spec_dir, name))
+
+
+def keep_outside_ranges(local_ids, exclude_starts, exclude_ends, k, columns):
+    """
+    The first k neighbours of every query i (row of local_ids [n, c]) whose local id is not in
+    [exclude_starts[i], exclude_ends[i]), missing neighbours (id -1) are dropped as well. columns
+    are (tensor [n, c], fill value) pairs of the neighbours, they are returned as [n, k] tensors
+    with the dropped slots at the end holding the fill value, along with the kept count [n] of every query.
+    """
+    exclude_starts = copy_stats.to(exclude_starts, local_ids.device)[:, None]
+    exclude_ends = copy_stats.to(exclude_ends, local_ids.device)[:, None]
+    keep = (local_ids >= 0) & ((local_ids < exclude_starts) | (local_ids >= exclude_ends))
+    # kept neighbours move to the front in distance order, the rest to a dropped column k
+    slots = keep.long().cumsum(1) - 1
+    slots = torch.where(keep & (slots < k), slots, torch.full_like(slots, k))
+    kept = [torch.full((len(local_ids), k + 1), fill, dtype=column.dtype, device=column.device).scatter_(
+        1, slots.to(column.device), column)[:, :k] for column, fill in columns]
+    return kept, keep.sum(1)
+
+
+class TorchFlatIndex(object):
+    """
+    Exact l2 index in pure torch, the faiss-free backend of TORCH_FLAT_SPEC.
+
+    Searches stream over the keys in tiles: the distances ||q||^2 - 2 q.k + ||k||^2 of a tile
+    come from one GEMM and are merged into a running top-k, so a search needs
+    O(num_queries * (k + tile_size)) memory whatever the number of keys. Excluded ranges are
+    masked inside the tiles, no over-fetch is needed.
+    """
+
+    def __init__(self, keys, tile_size=None):
+        self.keys = keys  # [ntotal, dim] float32 tensor
+        self.key_norms = (keys * keys).sum(-1)
+        self.tile_size = tile_size
+
+    @property
+    def ntotal(self):
+        return self.keys.size(0)
+
+    def reconstruct_n(self, n0, ni):
+        return self.keys[n0: n0 + ni]
+
+    def _tile_size(self, num_queries):
+        if self.tile_size is not None:
+            return self.tile_size
+        return int(min(max(TORCH_TILE_ELEMENTS // max(num_queries, 1), 1024), 1 << 20))
+
+    def search(self, xq, k):
+        return self.search_ranges(xq, k)
+
+    def search_ranges(self, xq, k, exclude_starts=None, exclude_ends=None):
+        """ k nearest neighbours of xq [n, dim] whose id is not in [exclude_starts[i], exclude_ends[i]). """
+        xq = xq.to(self.keys.device, torch.float32)
+        k = min(k, self.ntotal)
+        best_dists = torch.full((len(xq), k), float('inf'), device=xq.device)
+        best_ids = torch.full((len(xq), k), -1, dtype=torch.long, device=xq.device)
+        if exclude_starts is not None:
+            exclude_starts = exclude_starts.to(xq.device)[:, None]
+            exclude_ends = exclude_ends.to(xq.device)[:, None]
+        query_norms = (xq * xq).sum(-1, keepdim=True)
+
+        tile_size = self._tile_size(len(xq))
+        for start in range(0, self.ntotal, tile_size):
+            end = min(start + tile_size, self.ntotal)
+            dists = torch.addmm(query_norms + self.key_norms[None, start: end], xq, self.keys[start: end].t(),
+                                alpha=-2).clamp_(min=0)
+            ids = torch.arange(start, end, device=xq.device)
+            if exclude_starts is not None:
+                dists.masked_fill_((ids >= exclude_starts) & (ids < exclude_ends), float('inf'))
+            best_dists, positions = torch.cat([best_dists, dists], dim=1).topk(k, dim=1, largest=False)
+            best_ids = torch.cat([best_ids, ids.expand(len(xq), -1)], dim=1).gather(1, positions)
+        best_ids.masked_fill_(torch.isinf(best_dists), -1)
+        return best_dists, best_ids
+
+
+class ProjectIndex(object):
+    """
+    Index over all datastore entries of one project.
+
+    The entries of the project runs are concatenated, so local id i is the i-th entry of
+    the project and every file is still one contiguous local range. An id_mapped index returns
+    datastore positions (see build_index), they are turned into local ids after the search.
+    """
+
+    def __init__(self, proj_id, index, runs, vals, max_k=None, query_device='cpu', projection=None,
+                 full_keys=None, rerank_k=0, log_counts=None, id_mapped=False, keys=None, index_nbytes=0):
+        self.proj_id = proj_id
+        self.index = index
+        self.id_mapped = id_mapped
+        self.runs = runs
+        self.offsets = np.cumsum([0] + [end - start for start, end in runs]).tolist()
+        self.vals = vals  # [ntotal] LongTensor of target ids, resident on the eval device
+        # [ntotal] log of the entry counts of a compacted datastore, next to vals
+        self.log_counts = log_counts
+        self.max_k = max_k
+        self.query_device = torch.device(query_device)  # where the index reads queries from
+        # the index holds projected keys, rerank_k candidates are re-ranked on the full keys if given
+        self.projection = projection
+        self.full_keys = full_keys
+        self.rerank_k = rerank_k
+        # the (projected) keys the index holds, read by key_distances
+        self.keys = keys
+        self.index_nbytes = index_nbytes
+
+    @property
+    def nbytes(self):
+        """ Memory of the index, its vals and its log counts. """
+        tensors = [self.vals] + ([self.log_counts] if self.log_counts is not None else [])
+        return self.index_nbytes + sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    @property
+    def ntotal(self):
+        return self.offsets[-1]
+
+    def local_range(self, start, end):
+        """ Map a global [start, end) range of the datastore to local ids of this index. """
+        if start == end:
+            return 0, 0
+        for (run_start, run_end), offset in zip(self.runs, self.offsets):
+            if run_start <= start and end <= run_end:
+                return offset + start - run_start, offset + end - run_start
+        raise ValueError(f"range [{start}, {end}) is not in project {self.proj_id}")
+
+    def covering_range(self, start, end):
+        """
+        Local [start, end) of the entries inside a global [start, end) of the datastore, which may
+        span several runs. Only meaningful for runs sorted by start, such as the runs of a partition.
+        """
+        if start == end:
+            return 0, 0
+        run_starts = np.array([run_start for run_start, _ in self.runs], dtype='int64')
+        run_sizes = np.diff(self.offsets)
+        return tuple(int(np.clip(position - run_starts, 0, run_sizes).sum()) for position in (start, end))
+
+    def search(self, xq, k, exclude_start, exclude_end):
+        """ search_neighbours of queries that all leave out the local ids [exclude_start, exclude_end). """
+        k = min(k, self.ntotal - (exclude_end - exclude_start))
+        exclude_starts = torch.full((len(xq),), exclude_start, dtype=torch.long)
+        exclude_ends = torch.full((len(xq),), exclude_end, dtype=torch.long)
+        return self.search_neighbours(xq, k, exclude_starts, exclude_ends)
+
+    def global_ids(self, local_ids):
+        """ Datastore positions of local ids (LongTensor). """
+        offsets = torch.tensor(self.offsets, device=local_ids.device)
+        run_starts = torch.tensor([start for start, _ in self.runs] + [0], device=local_ids.device)
+        runs = torch.searchsorted(offsets[1:], local_ids, right=True)
+        return run_starts[runs] + local_ids - offsets[runs]
+
+    def local_ids(self, global_ids):
+        """ Local ids of datastore positions (LongTensor) of this project, -1 stays -1. """
+        order = np.argsort([start for start, _ in self.runs])
+        run_starts = torch.tensor([self.runs[i][0] for i in order] + [0], device=global_ids.device)
+        offsets = torch.tensor([self.offsets[i] for i in order] + [0], device=global_ids.device)
+        runs = (torch.searchsorted(run_starts[:-1], global_ids, right=True) - 1).clamp(min=0)
+        return torch.where(global_ids >= 0, offsets[runs] + global_ids - run_starts[runs], global_ids)
+
+    def search_ranges(self, xq, k, exclude_starts, exclude_ends):
+        """
+        Search the k nearest neighbours of every query i whose local id is not in
+        [exclude_starts[i], exclude_ends[i]). Missing neighbours have distance inf and id -1.
+        Queries of a projected index are projected first, and re-ranked with the full keys
+        if the index has them.
+        """
+        if self.projection is None:
+            return self._search_ranges(xq, k, exclude_starts, exclude_ends)
+        projected = self.projection.apply(xq)
+        if self.full_keys is None:
+            return self._search_ranges(projected, k, exclude_starts, exclude_ends)
+        _, candidates = self._search_ranges(projected, max(k, self.rerank_k), exclude_starts, exclude_ends)
+        return self._rerank(xq, candidates, min(k, self.ntotal))
+
+    def search_neighbours(self, xq, k, exclude_starts, exclude_ends, with_ids=False):
+        """
+        search_ranges with the neighbours given as target ids, and the log entry counts of the
+        neighbours for compacted datastores (None otherwise), on the device of vals. with_ids
+        adds the local ids of the neighbours.
+        """
+        l2_dis, neighbour_indexes = self.search_ranges(xq, k, exclude_starts, exclude_ends)
+        neighbour_indexes = copy_stats.to(neighbour_indexes, self.vals.device)
+        found = neighbour_indexes >= 0
+        targets = torch.where(found, self.vals[neighbour_indexes.clamp(min=0)], neighbour_indexes)
+        log_counts = None
+        if self.log_counts is not None:
+            log_counts = self.log_counts[neighbour_indexes.clamp(min=0)].masked_fill(~found, 0)
+        if with_ids:
+            return l2_dis, targets, log_counts, neighbour_indexes
+        return l2_dis, targets, log_counts
+
+    def key_distances(self, xq, local_ids):
+        """
+        Squared l2 distances [n, c] of the queries xq [n, dim] to the entries local_ids [n, c],
+        inf for id -1, measured like search_ranges does: on the full keys when the index
+        re-ranks, on the projected keys of a projected index.
+        """
+        if self.full_keys is not None:
+            return self._key_distances(xq, local_ids, self.full_keys)
+        if self.projection is not None:
+            return self._key_distances(self.projection.apply(xq), local_ids, self.keys)
+        return self._key_distances(xq, local_ids, self.keys)
+
+    def _key_distances(self, xq, candidates, keys):
+        xq = xq.float()
+        candidates = candidates.to(xq.device)
+        num_candidates = candidates.size(1)
+        dists = torch.full(candidates.size(), float('inf'), device=xq.device)
+        rows_per_step = max(1, RERANK_ELEMENTS // max(num_candidates * xq.size(1), 1))
+        for start in range(0, len(xq), rows_per_step):
+            rows = candidates[start: start + rows_per_step]
+            valid = rows >= 0
+            global_ids = self.global_ids(rows[valid]).cpu()
+            unique_ids, inverse = torch.unique(global_ids, return_inverse=True)
+            step_keys = torch.from_numpy(np.ascontiguousarray(keys[unique_ids.numpy()], dtype='float32'))
+            step_keys = copy_stats.to(step_keys, xq.device)
+            queries = xq[start: start + rows_per_step].unsqueeze(1).expand(-1, num_candidates, -1)[valid]
+            step_dists = torch.full(rows.size(), float('inf'), device=xq.device)
+            step_dists[valid] = ((queries - step_keys[inverse.to(xq.device)]) ** 2).sum(-1)
+            dists[start: start + rows_per_step] = step_dists
+        return dists
+
+    def _rerank(self, xq, candidates, k):
+        """ Keep the k candidates [n, c] whose full keys are nearest to xq, with their exact distances. """
+        dists = self._key_distances(xq, candidates, self.full_keys)
+        candidates = candidates.to(dists.device)
+        dists, positions = dists.topk(k, dim=1, largest=False)
+        neighbour_indexes = candidates.gather(1, positions).masked_fill(torch.isinf(dists), -1)
+        return dists, neighbour_indexes
+
+    def _search_ranges(self, xq, k, exclude_starts, exclude_ends):
+        """
+        search_ranges on the keys of the index itself. xq [n, dim] is a float tensor, it is handed to faiss without a copy when it is already
+        contiguous float32 on the device of the index. Returns distance and id tensors [n, k]
+        on that device.
+
+        The index is searched for k + the longest excluded range neighbours, which always
+        leaves enough of them outside the excluded range of every query.
+        """
+        if isinstance(self.index, TorchFlatIndex):
+            return self.index.search_ranges(xq, k, exclude_starts, exclude_ends)
+        k = min(k, self.ntotal)
+        fetch = min(k + int((exclude_ends - exclude_starts).max().item()) if len(xq) > 0 else k, self.ntotal)
+        if self.max_k is not None and fetch > self.max_k:
+            return self._search_per_range(xq, k, exclude_starts, exclude_ends)
+
+        xq = copy_stats.to(xq, self.query_device, torch.float32)
+        l2_dis, neighbour_indexes = self.index.search(xq, fetch)
+        if self.id_mapped:
+            neighbour_indexes = self.local_ids(neighbour_indexes)
+        (out_dists, out_indexes), _ = keep_outside_ranges(neighbour_indexes, exclude_starts, exclude_ends, k,
+                                                          [(l2_dis, float('inf')), (neighbour_indexes, -1)])
+        copy_stats.allocated(l2_dis, neighbour_indexes, out_dists, out_indexes)
+        copy_stats.searched(len(xq))
+        return out_dists, out_indexes
+
+    def _search_per_range(self, xq, k, exclude_starts, exclude_ends):
+        l2_dis = torch.full((len(xq), k), float('inf'), device=self.query_device)
+        neighbour_indexes = torch.full((len(xq), k), -1, dtype=torch.long, device=self.query_device)
+        ranges = torch.stack([exclude_starts, exclude_ends], dim=1)
+        for exclude_start, exclude_end in torch.unique(ranges, dim=0).tolist():
+            rows = ((exclude_starts == exclude_start) & (exclude_ends == exclude_end)).nonzero().view(-1)
+            range_k = min(k, self.ntotal - (exclude_end - exclude_start))
+            if range_k + exclude_end - exclude_start > self.max_k:
+                range_l2, range_indexes = self._search_without(xq[rows.to(xq.device)], range_k, exclude_start,
+                                                               exclude_end)
+            else:
+                range_l2, range_indexes = self._search_ranges(xq[rows.to(xq.device)], range_k, exclude_starts[rows],
+                                                              exclude_ends[rows])
+            rows = rows.to(self.query_device)
+            l2_dis[rows, :range_k] = range_l2.to(self.query_device)
+            neighbour_indexes[rows, :range_k] = range_indexes.to(self.query_device)
+        return l2_dis, neighbour_indexes
+
+    def _search_without(self, xq, k, exclude_start, exclude_end):
+        # the over-fetch does not fit in one search, fall back to a temporary flat index
+        parts = [self.index.reconstruct_n(0, exclude_start),
+                 self.index.reconstruct_n(exclude_end, self.ntotal - exclude_end)]
+        keys = torch.cat([torch.as_tensor(part).cpu() for part in parts]).numpy()
+        index = faiss.IndexFlatL2(keys.shape[1])
+        index.add(keys)
+        l2_dis, neighbour_indexes = index.search(copy_stats.to(xq, 'cpu', torch.float32), k)
+        neighbour_indexes = torch.where(neighbour_indexes >= exclude_start,
+                                        neighbour_indexes + exclude_end - exclude_start, neighbour_indexes)
+        return l2_dis, neighbour_indexes
+
+
+class SharedProjectIndex(ProjectIndex):
+    """
+    View of one project on a shared cpu index over the whole datastore (see SharedIndexCache).
+    Local ids are the ones of a ProjectIndex over the same runs. The shared index returns datastore
+    positions, its searches are restricted to the runs of the project minus the excluded range by a
+    faiss IDSelector, so nothing is over-fetched.
+    """
+
+    def __init__(self, proj_id, index, runs, vals, **kwargs):
+        super(SharedProjectIndex, self).__init__(proj_id, index, runs, vals, **kwargs)
+        self.id_mapped = True
+        # faiss does not own the selectors, the one of the project lives as long as the view
+        self.run_positions = run_ids(runs)
+        if len(runs) == 1:
+            self.selector = faiss.IDSelectorRange(*runs[0])
+        else:
+            self.selector = faiss.IDSelectorBatch(len(self.run_positions), faiss.swig_ptr(self.run_positions))
+
+    def _search_ranges(self, xq, k, exclude_starts, exclude_ends):
+        k = min(k, self.ntotal)
+        xq = copy_stats.to(xq, 'cpu', torch.float32)
+        l2_dis = torch.full((len(xq), k), float('inf'))
+        neighbour_indexes = torch.full((len(xq), k), -1, dtype=torch.long)
+        ranges = torch.stack([exclude_starts, exclude_ends], dim=1).cpu()
+        for exclude_start, exclude_end in torch.unique(ranges, dim=0).tolist():
+            rows = ((ranges[:, 0] == exclude_start) & (ranges[:, 1] == exclude_end)).nonzero().view(-1)
+            selector = self.selector
+            if exclude_end > exclude_start:
+                # the positions of a local range lie between those of its first and last id, and no
+                # other entry of the project does
+                first, last = self.global_ids(torch.tensor([exclude_start, exclude_end - 1])).tolist()
+                excluded = faiss.IDSelectorRange(first, last + 1)
+                not_excluded = faiss.IDSelectorNot(excluded)
+                selector = faiss.IDSelectorAnd(self.selector, not_excluded)
+            range_l2, range_indexes = selector_search(self.index, np.ascontiguousarray(xq[rows].numpy()), k,
+                                                      selector)
+            l2_dis[rows] = range_l2
+            neighbour_indexes[rows] = self.local_ids(range_indexes)
+        copy_stats.searched(len(xq))
+        return l2_dis, neighbour_indexes
+
+
+class IndexManager(object):
+    """
+    Owns the faiss resources of a run and is shared by everything that builds or searches indexes.
+
+    Indexes are searched on the cpu by default. With device >= 0 they are moved to that gpu and
+    share one StandardGpuResources, index types without gpu support stay on the cpu.
+    num_threads > 0 sets the number of OpenMP threads of the cpu searches.
+    """
+
+    def __init__(self, device=-1, num_threads=0):
+        if device >= 0 and (not hasattr(faiss, 'StandardGpuResources') or faiss.get_num_gpus() <= device):
+            logger.warning(f"faiss gpu {device} is not available, indexes are searched on the cpu")
+            device = -1
+        self.device = device
+        self.res = faiss.StandardGpuResources() if device >= 0 else None
+        if self.res is not None:
+            # the first gpu index allocates the scratch memory of the resources, which would
+            # otherwise be measured as part of it by place_measured
+            faiss.index_cpu_to_gpu(self.res, device, faiss.IndexFlatL2(1))
+        if num_threads > 0:
+            faiss.omp_set_num_threads(num_threads)
+        logger.info(f"faiss indexes on {'gpu %d' % device if device >= 0 else 'cpu'}, "
+                    f"{faiss.omp_get_max_threads()} cpu threads")
+
+    @property
+    def on_gpu(self):
+        return self.res is not None
+
+    def query_device(self, max_k):
+        """ torch device the queries of an index placed with max_k are read from. """
+        return torch.device('cuda', self.device) if max_k is not None else torch.device('cpu')
+
+    def place(self, index):
+        """ Move a cpu index to the device of the run. Returns the index and its max k per search. """
+        if self.res is None:
+            return index, None
+        try:
+            return faiss.index_cpu_to_gpu(self.res, self.device, index), GPU_MAX_K
+        except RuntimeError:
+            return index, None
+
+    def place_measured(self, index):
+        """
+        place, with the memory the index takes where it is searched: the gpu memory its copy
+        allocated, or index_nbytes of an index left on the cpu.
+        """
+        if self.res is None:
+            return index, None, index_nbytes(index)
+        free = torch.cuda.mem_get_info(self.device)[0]
+        placed, max_k = self.place(index)
+        if max_k is None:
+            return placed, None, index_nbytes(placed)
+        torch.cuda.synchronize(self.device)
+        return placed, max_k, max(free - torch.cuda.mem_get_info(self.device)[0], 0)
+
+
+class ProjectIndexCache(object):
+    """
+    Builds the index of a project the first time it is queried and reuses it for every
+    other sequence of the project. sample2proj tells how many samples each project has,
+    the index is dropped once release() has been called for all of them.
+
+    With max_bytes the cached indexes (and type partitions) are also kept under that many bytes
+    (see ProjectIndex.nbytes) between batches: trim(), called by the searches before every batch,
+    evicts the least recently used ones, which are rebuilt or read back from disk if queried again.
+    Nothing is evicted while a batch is searched, its searches still hold the indexes they got, so
+    a batch that needs more than max_bytes goes beyond it until the next trim (see peak_bytes).
+    """
+
+    def __init__(self, datastore, sample2proj, device, index_manager, index_spec=FLAT_SPEC, index_params='',
+                 train_size=65536, projection=None, rerank_k=0, max_bytes=None):
+        self.datastore = datastore
+        self.device = device
+        self.index_manager = index_manager
+        self.index_spec = index_spec
+        self.index_params = index_params
+        self.train_size = train_size
+        # indexes are built on the keys of a KeyProjection if given
+        self.projection = projection
+        self.rerank_k = rerank_k
+        self.keys = datastore.keys if projection is None else projection.keys
+        self.key_dim = datastore.dim if projection is None else projection.dim
+        self.remaining = Counter(sample2proj.values())
+        # proj_id: project index, (proj_id, target type): partition of the project, least recently used first
+        self.indexes = OrderedDict()
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.peak_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def get(self, proj_id):
+        return self._cached(proj_id, lambda: self.build(proj_id))
+
+    def _cached(self, key, build):
+        if key in self.indexes:
+            self.num_hits += 1
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        self.num_misses += 1
+        index = build()
+        self.indexes[key] = index
+        self.num_bytes += index.nbytes
+        self.peak_bytes = max(self.peak_bytes, self.num_bytes)
+        return index
+
+    def trim(self):
+        """ Evict the least recently used indexes until the cache fits max_bytes. """
+        while self.max_bytes is not None and self.num_bytes > self.max_bytes and len(self.indexes) > 0:
+            self.drop(next(iter(self.indexes)))
+            self.num_evictions += 1
+
+    def drop(self, key):
+        """ Remove the index of key (a proj_id or a (proj_id, target type) partition) from the cache. """
+        index = self.indexes.pop(key, None)
+        if index is not None:
+            self.num_bytes -= index.nbytes
+
+    def build(self, proj_id):
+        return self.build_runs(proj_id, *self.runs(proj_id))
+
+    def runs(self, proj_id):
+        """ Datastore runs of proj_id, and the name its persisted indexes are saved under. """
+        return self.datastore.project_runs.get(proj_id, []), str(proj_id)
+
+    def get_partition(self, proj_id, target_type):
+        """ Index over the entries of proj_id whose target has target_type, built on first use. """
+        return self._cached((proj_id, target_type), lambda: self.build_partition(proj_id, target_type))
+
+    def build_partition(self, proj_id, target_type):
+        runs, name = self.runs(proj_id)
+        positions = run_ids(runs)
+        target_types = np.concatenate([self.datastore.types[start: end, 1] for start, end in runs] +
+                                      [np.zeros((0,), dtype='int32')])
+        return self.build_runs(proj_id, position_runs(positions[target_types == target_type]),
+                               f"{name}_type{target_type}")
+
+    def partition_file_range(self, partition, file_id):
+        """ Local [start, end) of file_id inside a partition of its project. """
+        return partition.covering_range(*self.datastore.file_range(partition.proj_id, file_id))
+
+    def build_runs(self, proj_id, runs, name):
+        """ Index over the datastore runs [(start, end)], persisted as <name>.index if the spec is trained. """
+        vals = self.run_vals(runs)
+
+        if self.index_spec == TORCH_FLAT_SPEC:
+            index = TorchFlatIndex(torch.from_numpy(self.project_keys(runs)).to(self.device))
+            return self._project_index(proj_id, index, runs, vals, None, self.device, index_nbytes(index))
+
+        if self.index_spec == FLAT_SPEC:
+            # compressed keys are searched as stored on the cpu, the gpu flat index takes float keys
+            if self.projection is None and self.datastore.codes is not None and not self.index_manager.on_gpu:
+                index = stored_codes_index(self.datastore, runs)
+            else:
+                index = faiss.IndexFlatL2(self.key_dim)
+                index.add(self.project_keys(runs))
+            index, max_k, nbytes = self.index_manager.place_measured(index)
+            return self._project_index(proj_id, index, runs, vals, max_k, self.index_manager.query_device(max_k),
+                                       nbytes)
+
+        # trained indexes are kept on disk next to the datastore, with the datastore positions as ids
+        # so that files can be replaced in them (see update_persisted_indexes)
+        projection_spec = self.projection.spec if self.projection is not None else ''
+        spec_dir = index_spec_dir(self.datastore.path, self.index_spec, projection_spec)
+        index_file = os.path.join(spec_dir, f"{name}.index")
+        index = faiss.read_index(index_file) if os.path.exists(index_file) else None
+        if index is not None and isinstance(index, faiss.IndexIDMap) and index.ntotal == len(vals):
+            index_spec = FLAT_SPEC if isinstance(faiss.downcast_index(index.index), faiss.IndexFlat) else \
+                self.index_spec
+        else:
+            index, index_spec = build_index(self.project_keys(runs), self.index_spec, self.train_size,
+                                            ids=run_ids(runs))
+            write_index_spec_manifest(spec_dir, self.index_spec, projection_spec)
+            save_index(index, index_file)
+        set_index_params(index, index_spec, self.index_params)
+        index, max_k, nbytes = self.index_manager.place_measured(index)
+        return self._project_index(proj_id, index, runs, vals, max_k, self.index_manager.query_device(max_k),
+                                   nbytes, id_mapped=True)
+
+    def run_vals(self, runs):
+        """ Target ids of the datastore runs, concatenated on the device. """
+        vals = np.concatenate([self.datastore.vals[start: end] for start, end in runs] +
+                              [np.zeros((0,))]).astype('int64')
+        return torch.from_numpy(vals).to(self.device)
+
+    def _project_index(self, proj_id, index, runs, vals, max_k, query_device, nbytes=0, id_mapped=False,
+                       index_class=ProjectIndex):
+        full_keys = self.datastore.keys if self.projection is not None and self.rerank_k > 0 else None
+        log_counts = None
+        if self.datastore.counts is not None:
+            log_counts = np.concatenate([self.datastore.counts[start: end] for start, end in runs] +
+                                        [np.zeros((0,))]).astype('float32')
+            log_counts = torch.from_numpy(np.log(np.maximum(log_counts, 1))).to(self.device)
+        return index_class(proj_id, index, runs, vals, max_k=max_k, query_device=query_device,
+                           projection=self.projection, full_keys=full_keys, rerank_k=self.rerank_k,
+                           log_counts=log_counts, id_mapped=id_mapped, keys=self.keys, index_nbytes=nbytes)
+
+    def project_keys(self, runs):
+        """ float32 keys of the runs, a single float32 run is added to faiss straight from the memmap. """
+        keys = [self.keys[start: end] for start, end in runs]
+        if len(keys) == 1:
+            return np.ascontiguousarray(keys[0], dtype='float32')
+        return np.concatenate(keys + [np.zeros((0, self.key_dim), dtype='float32')]).astype('float32', copy=False)
+
+    def file_range(self, proj_index, file_id):
+        """ Local [start, end) of file_id inside the index of its project. """
+        return proj_index.local_range(*self.datastore.file_range(proj_index.proj_id, file_id))
+
+    def release(self, proj_id):
+        """ Called once per finished sample, evicts the project index after its last sample. """
+        self.remaining[proj_id] -= 1
+        if self.remaining[proj_id] <= 0:
+            for key in [key for key in self.indexes
+                        if key == proj_id or isinstance(key, tuple) and key[0] == proj_id]:
+                self.drop(key)
+
+    def log(self, logger):
+        lookups = max(self.num_hits + self.num_misses, 1)
+        budget = f"{self.max_bytes / 2 ** 30:.2f}GB" if self.max_bytes is not None else "unlimited"
+        logger.info(f"index cache: {self.num_hits} hits, {self.num_misses} misses "
+                    f"(hit rate {self.num_hits / lookups:.3f}), {self.num_evictions} evictions, "
+                    f"peak {self.peak_bytes / 2 ** 30:.2f}GB of a {budget} budget")
+
+
+class GlobalIndexCache(ProjectIndexCache):
+    """
+    One index over the whole datastore, for datastores without project meta such as the domain
+    datastore of run_lm_domain.py. Nothing is left out of the search.
+    """
+
+    def __init__(self, datastore, device, index_manager, **kwargs):
+        super(GlobalIndexCache, self).__init__(datastore, {}, device, index_manager, **kwargs)
+
+    def get(self, proj_id):
+        return super(GlobalIndexCache, self).get(-1)
+
+    def runs(self, proj_id):
+        return [(0, self.datastore.size)], 'all'
+
+    def file_range(self, proj_index, file_id):
+        return 0, 0
+
+    def partition_file_range(self, partition, file_id):
+        return 0, 0
+
+    def release(self, proj_id):
+        pass
+
+
+class SharedIndexCache(ProjectIndexCache):
+    """
+    One index over the keys of all projects instead of one index per project, which saves the
+    per-index overhead and gives trained specs enough keys for their centroids even for tiny
+    projects. Projects (and their type partitions) are SharedProjectIndex views on it, their
+    searches keep to the project and leave the current file out through faiss ID selectors.
+
+    The shared index is persisted as all.index, like the one of GlobalIndexCache, and is never
+    evicted. It stays on the cpu, faiss gpu indexes do not take ID selectors. With a trained spec
+    the probed lists of a small project hold few of its entries, knn_bench.py --layouts measures
+    what that costs against per-project indexes.
+    """
+
+    def __init__(self, datastore, sample2proj, device, index_manager, **kwargs):
+        assert not index_manager.on_gpu, "the shared index is searched with faiss ID selectors, on the cpu only"
+        assert kwargs.get('index_spec', FLAT_SPEC) != TORCH_FLAT_SPEC, "the shared index needs a faiss index spec"
+        super(SharedIndexCache, self).__init__(datastore, sample2proj, device, index_manager, **kwargs)
+        self.shared = None
+
+    def shared_index(self):
+        if self.shared is None:
+            self.shared = super(SharedIndexCache, self).build_runs(-1, [(0, self.datastore.size)], 'all')
+            self.num_bytes += self.shared.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.num_bytes)
+            logger.info(f"shared index over {self.shared.ntotal} entries, {self.shared.nbytes / 2 ** 20:.1f}MB")
+        return self.shared
+
+    def build_runs(self, proj_id, runs, name):
+        """ View of the shared index restricted to the datastore runs, nothing is built per project. """
+        return self._project_index(proj_id, self.shared_index().index, runs, self.run_vals(runs), None, 'cpu',
+                                   index_class=SharedProjectIndex)
+
+
+class RetrievalGate(object):
+    """
+    Skips the kNN search of positions where the LM is already sure of the next token: LM entropy
+    below entropy_threshold, LM max probability above prob_threshold, or current token of one of
+    skip_types (the input_types of EvalDataset). Skipped positions are predicted by the LM alone.
+
+    Counts the skipped queries, the search time and the sub-token accuracy of the skipped and
+    searched positions. An auditing gate searches the skipped positions anyway, so that the gated
+    and the ungated accuracy are measured on the same positions, its search time is not the gated one.
+    """
+
+    def __init__(self, entropy_threshold=None, prob_threshold=None, skip_types=(), audit=False):
+        self.entropy_threshold = entropy_threshold
+        self.prob_threshold = prob_threshold
+        self.skip_types = list(skip_types)
+        self.audit = audit
+        self.num_queries = 0
+        self.num_skipped = 0
+        self.skipped_correct = 0
+        self.searched_correct = 0
+        self.ungated_correct = 0
+        self.ungated_skipped_correct = 0
+        self.search_time = 0.0
+
+    @property
+    def enabled(self):
+        return self.entropy_threshold is not None or self.prob_threshold is not None or len(self.skip_types) > 0
+
+    def __call__(self, lm_probs, input_types, query_mask):
+        """ The positions of query_mask [batch_size, seq_len] that are searched. """
+        search_mask = query_mask.clone()
+        if self.entropy_threshold is not None:
+            entropy = -(lm_probs * lm_probs.clamp(min=1e-12).log()).sum(-1)
+            search_mask &= entropy >= self.entropy_threshold
+        if self.prob_threshold is not None:
+            search_mask &= lm_probs.max(-1)[0] <= self.prob_threshold
+        if len(self.skip_types) > 0:
+            input_types = input_types.to(query_mask.device)
+            for token_type in self.skip_types:
+                search_mask &= input_types != token_type
+        self.num_queries += query_mask.sum().item()
+        self.num_skipped += (query_mask & ~search_mask).sum().item()
+        return search_mask
+
+    def searched(self, query_mask, search_mask):
+        """ The positions the index is searched for, all queries of an auditing gate. """
+        return query_mask if self.audit else search_mask
+
+    def apply(self, pred_ids, lm_pred_ids, search_mask):
+        """
+        Gated predictions, the LM ones at skipped positions, and the ungated kNN-LM predictions of
+        an auditing gate (None otherwise). pred_ids are predicted with the positions searched().
+        """
+        if not self.audit:
+            return pred_ids, None
+        return torch.where(search_mask, pred_ids, lm_pred_ids), pred_ids
+
+    def update(self, pred_ids, inputs, query_mask, search_mask, ungated_pred_ids=None):
+        correct = (pred_ids[:, :-1] == inputs[:, 1:]) & query_mask[:, :-1]
+        self.searched_correct += (correct & search_mask[:, :-1]).sum().item()
+        self.skipped_correct += (correct & ~search_mask[:, :-1]).sum().item()
+        if ungated_pred_ids is not None:
+            ungated_correct = (ungated_pred_ids[:, :-1] == inputs[:, 1:]) & query_mask[:, :-1]
+            self.ungated_correct += ungated_correct.sum().item()
+            self.ungated_skipped_correct += (ungated_correct & ~search_mask[:, :-1]).sum().item()
+
+    def log(self, logger):
+        num_searched = self.num_queries - self.num_skipped
+        logger.info(f"retrieval gate skipped {self.num_skipped} of {self.num_queries} queries "
+                    f"({self.num_skipped / max(self.num_queries, 1):.2%})")
+        logger.info(f"sub-token acc of the LM on skipped positions: {self.skipped_correct / max(self.num_skipped, 1):.4f}, "
+                    f"of kNN-LM on searched positions: {self.searched_correct / max(num_searched, 1):.4f}")
+        # the search cost grows linearly with the number of queries of a flat index
+        logger.info(f"search time {self.search_time:.1f}s, estimated search speed-up "
+                    f"{self.num_queries / max(num_searched, 1):.2f}x")
+        if self.audit:
+            gated_acc = (self.searched_correct + self.skipped_correct) / max(self.num_queries, 1)
+            ungated_acc = self.ungated_correct / max(self.num_queries, 1)
+            logger.info(f"sub-token acc on the same {self.num_queries} queries: gated {gated_acc:.4f}, "
+                        f"ungated {ungated_acc:.4f} ({gated_acc - ungated_acc:+.4f}), of kNN-LM on the skipped "
+                        f"positions {self.ungated_skipped_correct / max(self.num_skipped, 1):.4f}")
+
+
+class RetrievalCache(object):
+    """
+    LRU cache of neighbour lists in front of the indexes, for the repeated contexts of code (the
+    same call sequences, getters, boilerplate) whose hidden states are nearly the same.
+
+    The signature of a query is a locality sensitive hash of its hidden state, the signs of num_bits
+    random projections. An entry is keyed on (proj_id, signature) and holds the k + margin nearest
+    neighbours of the query in the whole project, with their local ids, so that queries of any file
+    of the project share it: the file of the reading query is dropped from the list when it is read.
+    A query with a cached signature reuses the list if it is within tolerance of the cached query,
+    relative to its l2 norm, and at least k of its neighbours lie outside the file of the query,
+    otherwise it is searched and replaces the entry.
+
+    A fraction audit_rate of the hits is searched anyway, the agreement of the nearest neighbour
+    target of the cached and of the searched list measures what the cache costs in accuracy.
+    """
+
+    def __init__(self, capacity, tolerance=0.05, num_bits=32, audit_rate=0.0, margin=32, seed=42):
+        assert 0 < num_bits < 64, "signatures are packed into int64"
+        self.capacity = capacity
+        self.tolerance = tolerance
+        self.num_bits = num_bits
+        self.audit_rate = audit_rate
+        self.margin = margin
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.planes = {}  # device -> [dim, num_bits] projections and the values of the bits
+        self.entries = OrderedDict()  # (proj_id, signature) -> slot, least recently used first
+        # [capacity, ...] cpu tensors, allocated by the first insert
+        self.queries = None
+        self.dists = None
+        self.targets = None
+        self.log_counts = None
+        self.ids = None  # None for indexes that leave nothing out and give no local ids
+
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.num_rejected = 0
+        self.num_short = 0
+        self.num_evicted = 0
+        self.num_audited = 0
+        self.audit_agreed = 0
+        self.lookup_time = 0.0
+        self.num_searched = 0
+        self.search_time = 0.0
+
+    def signatures(self, xq):
+        """ Signatures (python ints) of the queries xq [n, dim]. """
+        if xq.device not in self.planes:
+            planes = np.random.RandomState(self.seed).randn(xq.size(-1), self.num_bits).astype('float32')
+            self.planes[xq.device] = (torch.from_numpy(planes).to(xq.device),
+                                      (2 ** torch.arange(self.num_bits, dtype=torch.long)).to(xq.device))
+        planes, bit_values = self.planes[xq.device]
+        return ((xq.float() @ planes > 0).long() * bit_values).sum(-1).tolist()
+
+    def lookup(self, xq, proj_id, exclude_start, exclude_end, k):
+        """
+        Cache lookup of the queries xq [n, dim] of one sequence, which leave out the local ids
+        [exclude_start, exclude_end) of their file. Returns their signatures, the hits [n] (cpu),
+        the queries [n] to search: the misses and the audited hits, and the cached dists, targets
+        and log counts (None if the cache holds none) [num_hits, k] of the hits, their file left out.
+        """
+        start = time.time()
+        signatures = self.signatures(xq)
+        slots = torch.tensor([self.entries.get((proj_id, signature), -1) for signature in signatures],
+                             dtype=torch.long)
+        hits = slots >= 0
+        cached = (None, None, None)
+        if hits.any():
+            candidates = hits.nonzero().squeeze(-1)
+            xq_candidates = xq[candidates.to(xq.device)].detach().float().cpu()
+            errors = ((xq_candidates - self.queries[slots[candidates]]) ** 2).sum(-1)
+            close = errors <= self.tolerance ** 2 * (xq_candidates ** 2).sum(-1)
+            hits[candidates[~close]] = False
+            self.num_rejected += int((~close).sum())
+
+            cached, enough = self.fetch(slots[hits], exclude_start, exclude_end, k)
+            hits[hits.nonzero().squeeze(-1)[~enough]] = False
+            cached = tuple(None if column is None else column[enough] for column in cached)
+            self.num_short += int((~enough).sum())
+            for i in hits.nonzero().squeeze(-1).tolist():
+                self.entries.move_to_end((proj_id, signatures[i]))
+        searched = ~hits
+        if self.audit_rate > 0:
+            searched |= hits & torch.from_numpy(self.rng.rand(len(hits)) < self.audit_rate)
+        self.num_lookups += len(hits)
+        self.num_hits += int(hits.sum())
+        self.lookup_time += time.time() - start
+        return signatures, hits, searched, cached
+
+    def fetch(self, slots, exclude_start, exclude_end, k):
+        """
+        Top-k of the cached lists of slots [n] without the local ids [exclude_start, exclude_end),
+        and whether they are exact [n]: k neighbours are left, or the list holds the whole project.
+        """
+        dists, targets = self.dists[slots], self.targets[slots]
+        log_counts = None if self.log_counts is None else self.log_counts[slots]
+        complete = torch.isinf(dists[:, -1])
+        if self.ids is None:
+            kept = (~torch.isinf(dists)).sum(1)
+            dists, targets = dists[:, :k], targets[:, :k]
+            log_counts = None if log_counts is None else log_counts[:, :k]
+            return (dists, targets, log_counts), (kept >= k) | complete
+        columns = [(dists, float('inf')), (targets, -1)] + ([] if log_counts is None else [(log_counts, 0)])
+        kept_columns, kept = keep_outside_ranges(self.ids[slots], torch.full((len(slots),), exclude_start),
+                                                 torch.full((len(slots),), exclude_end), k, columns)
+        log_counts = None if log_counts is None else kept_columns[2]
+        return (kept_columns[0], kept_columns[1], log_counts), (kept >= k) | complete
+
+    def insert(self, signatures, xq, proj_id, dists, targets, log_counts=None, ids=None):
+        """
+        Cache the neighbour lists dists, targets, local ids [n, k + margin] in the project of the
+        queries xq [n, dim], LRU entries are evicted.
+        """
+        if len(signatures) == 0:
+            return
+        if self.queries is None:
+            self.queries = torch.zeros((self.capacity, xq.size(-1)))
+            self.dists = torch.zeros((self.capacity, dists.size(-1)))
+            self.targets = torch.zeros((self.capacity, targets.size(-1)), dtype=torch.int32)
+            if ids is not None:
+                self.ids = torch.zeros((self.capacity, ids.size(-1)), dtype=torch.long)
+        if log_counts is not None and self.log_counts is None:
+            # entries cached before hold one datastore entry each, log(1) = 0
+            self.log_counts = torch.zeros((self.capacity, log_counts.size(-1)))
+
+        slots = []
+        for signature in signatures:
+            key = (proj_id, signature)
+            slot = self.entries.get(key)
+            if slot is not None:
+                self.entries.move_to_end(key)
+            elif len(self.entries) < self.capacity:
+                slot = len(self.entries)
+            else:
+                _, slot = self.entries.popitem(last=False)
+                self.num_evicted += 1
+            self.entries[key] = slot
+            slots.append(slot)
+        slots = torch.tensor(slots, dtype=torch.long)
+        self.queries[slots] = xq.detach().float().cpu()
+        self.dists[slots] = dists.float().cpu()
+        self.targets[slots] = targets.cpu().int()
+        if self.ids is not None:
+            self.ids[slots] = ids.cpu()
+        if self.log_counts is not None:
+            self.log_counts[slots] = 0 if log_counts is None else log_counts.float().cpu()
+
+    def audit(self, cached_targets, searched_targets):
+        """ Compare the nearest neighbour targets of audited hits, cached vs searched. """
+        self.num_audited += len(cached_targets)
+        self.audit_agreed += int((cached_targets[:, 0].cpu() == searched_targets[:, 0].cpu()).sum())
+
+    def record_search(self, num_queries, seconds):
+        self.num_searched += num_queries
+        self.search_time += seconds
+
+    def log(self, logger):
+        search_time_per_query = self.search_time / max(self.num_searched, 1)
+        logger.info(f"retrieval cache: {self.num_hits} hits of {self.num_lookups} lookups "
+                    f"({self.num_hits / max(self.num_lookups, 1):.2%}), {self.num_rejected} signature matches "
+                    f"beyond the tolerance, {self.num_short} with fewer than k neighbours outside the file, "
+                    f"{len(self.entries)} entries, {self.num_evicted} evicted")
+        # the saved time is estimated with the mean search time of the queries that were searched
+        logger.info(f"retrieval cache saved about {self.num_hits * search_time_per_query:.1f}s of search "
+                    f"for {self.lookup_time:.1f}s of lookups")
+        if self.num_audited > 0:
+            logger.info(f"nearest neighbour target of {self.num_audited} audited hits: "
+                        f"{self.audit_agreed / self.num_audited:.4f} agreement with the search")
+
+
+class PointerRetrieval(object):
+    """
+    RetoMaton style retrieval that follows the neighbours of the previous position instead of
+    searching at every position.
+
+    The files are contiguous runs of the datastore, so the entry after a neighbour usually is a
+    neighbour of the next position too. The neighbours of a position whose target is the token
+    that actually came next are advanced by one entry, the others are dropped, and the survivors
+    are the neighbours of the next position, with their distances computed from their keys. The
+    index is only searched when fewer than min_pointers survive. Pointers never enter the left out
+    file and never cross the end of a run of the project.
+
+    Counts the searched queries, the search and pointer time and the sub-token accuracy of the
+    positions that followed pointers and of the searched ones.
+    """
+
+    def __init__(self, min_pointers=16):
+        self.min_pointers = min_pointers
+        self.num_queries = 0
+        self.num_searched = 0
+        self.search_time = 0.0
+        self.pointer_time = 0.0
+        self.followed_correct = 0
+        self.searched_correct = 0
+
+    def _advance(self, proj_index, pointers, tokens, exclude_starts, exclude_ends):
+        """ The entries after the pointers [n, c] whose target is tokens [n], -1 for the dropped ones. """
+        run_starts = torch.tensor(proj_index.offsets, device=pointers.device)
+        alive = (pointers >= 0) & (proj_index.vals[pointers.clamp(min=0)] == tokens[:, None])
+        advanced = pointers + 1
+        alive &= ~torch.isin(advanced, run_starts)
+        alive &= (advanced < exclude_starts[:, None]) | (advanced >= exclude_ends[:, None])
+        return advanced.masked_fill(~alive, -1)
+
+    def search_batch(self, index_cache, hidden_states, inputs, proj_meta, k, query_mask=None):
+        """
+        search_batch of a batch with pointer following along its positions. inputs [batch_size,
+        seq_len] are the tokens that came next. Returns the dists, targets and log counts of
+        search_batch, and the mask [batch_size, seq_len] of the queries that followed pointers.
+        """
+        index_cache.trim()
+        device = hidden_states.device
+        batch_size, seq_len, _ = hidden_states.size()
+        if query_mask is None:
+            query_mask = torch.ones((batch_size, seq_len), dtype=torch.bool, device=device)
+        dists = torch.full((batch_size, seq_len, k), float('inf'), device=device)
+        targets = torch.full((batch_size, seq_len, k), -1, dtype=torch.long, device=device)
+        log_counts = None
+        followed = torch.zeros((batch_size, seq_len), dtype=torch.bool, device=device)
+
+        proj_rows = {}
+        for b, (proj_id, file_id) in enumerate(proj_meta.tolist()):
+            proj_rows.setdefault(proj_id, []).append((b, file_id))
+
+        for proj_id, rows in proj_rows.items():
+            proj_index = index_cache.get(proj_id)
+            if proj_index.ntotal == 0:
+                continue
+            if proj_index.log_counts is not None and log_counts is None:
+                log_counts = torch.zeros((batch_size, seq_len, k), device=device)
+            vals_device = proj_index.vals.device
+            file_ranges = [index_cache.file_range(proj_index, file_id) for _, file_id in rows]
+            exclude_starts = torch.tensor([start for start, _ in file_ranges], dtype=torch.long)
+            exclude_ends = torch.tensor([end for _, end in file_ranges], dtype=torch.long)
+            row_ids = torch.tensor([b for b, _ in rows], dtype=torch.long, device=device)
+            row_inputs = inputs[row_ids].to(vals_device)
+            row_mask = query_mask[row_ids].to(vals_device)
+            row_exclude_starts, row_exclude_ends = exclude_starts.to(vals_device), exclude_ends.to(vals_device)
+            # local ids of the neighbours of the previous position of every row
+            pointers = torch.full((len(rows), k), -1, dtype=torch.long, device=vals_device)
+
+            for t in range(seq_len):
+                start_time = time.time()
+                if t > 0:
+                    pointers = self._advance(proj_index, pointers, row_inputs[:, t], row_exclude_starts,
+                                             row_exclude_ends)
+                mask = row_mask[:, t]
+                follow = mask & ((pointers >= 0).sum(-1) >= self.min_pointers)
+                search = mask & ~follow
+                if follow.any():
+                    follow_rows = follow.nonzero().squeeze(-1)
+                    follow_ids = pointers[follow_rows]
+                    out_rows = row_ids[follow_rows.to(device)]
+                    dists[out_rows, t] = copy_stats.to(proj_index.key_distances(hidden_states[out_rows, t],
+                                                                                follow_ids), device)
+                    self._fill(proj_index, targets, log_counts, out_rows, t, follow_ids)
+                    followed[out_rows, t] = True
+                self.pointer_time += time.time() - start_time
+
+                if search.any():
+                    start_time = time.time()
+                    search_rows = search.nonzero().squeeze(-1)
+                    out_rows = row_ids[search_rows.to(device)]
+                    search_rows_cpu = search_rows.cpu()
+                    l2_dis, neighbour_indexes = proj_index.search_ranges(hidden_states[out_rows, t], k,
+                                                                         exclude_starts[search_rows_cpu],
+                                                                         exclude_ends[search_rows_cpu])
+                    found = neighbour_indexes.size(1)
+                    neighbour_indexes = copy_stats.to(neighbour_indexes, vals_device)
+                    dists[out_rows, t, :found] = copy_stats.to(l2_dis, device)
+                    self._fill(proj_index, targets, log_counts, out_rows, t, neighbour_indexes)
+                    pointers[search_rows] = -1
+                    pointers[search_rows, :found] = neighbour_indexes
+                    self.search_time += time.time() - start_time
+                    self.num_searched += len(search_rows)
+                self.num_queries += int(mask.sum())
+        return dists, targets, log_counts, followed
+
+    def _fill(self, proj_index, targets, log_counts, out_rows, t, neighbour_indexes):
+        found = neighbour_indexes >= 0
+        device = targets.device
+        row_targets = torch.where(found, proj_index.vals[neighbour_indexes.clamp(min=0)], neighbour_indexes)
+        targets[out_rows, t, :neighbour_indexes.size(1)] = copy_stats.to(row_targets, device)
+        if proj_index.log_counts is not None:
+            row_log_counts = proj_index.log_counts[neighbour_indexes.clamp(min=0)].masked_fill(~found, 0)
+            log_counts[out_rows, t, :neighbour_indexes.size(1)] = copy_stats.to(row_log_counts, device)
+
+    def update(self, pred_ids, inputs, query_mask, followed):
+        correct = (pred_ids[:, :-1] == inputs[:, 1:]) & query_mask[:, :-1]
+        self.followed_correct += (correct & followed[:, :-1]).sum().item()
+        self.searched_correct += (correct & ~followed[:, :-1]).sum().item()
+
+    def log(self, logger):
+        num_followed = self.num_queries - self.num_searched
+        logger.info(f"pointer retrieval searched {self.num_searched} of {self.num_queries} queries "
+                    f"(search rate {self.num_searched / max(self.num_queries, 1):.2%})")
+        logger.info(f"sub-token acc of kNN-LM on positions that followed pointers: "
+                    f"{self.followed_correct / max(num_followed, 1):.4f}, "
+                    f"on searched positions: {self.searched_correct / max(self.num_searched, 1):.4f}")
+        # what searching every query would have taken, at the mean search time of the searched ones
+        full_search_time = self.search_time / max(self.num_searched, 1) * self.num_queries
+        logger.info(f"search time {self.search_time:.1f}s, pointer time {self.pointer_time:.1f}s, estimated "
+                    f"retrieval speed-up {full_search_time / max(self.search_time + self.pointer_time, 1e-9):.2f}x")
+
+
+class TypeRouter(object):
+    """
+    Routing policy of the type partitioned search (see search_partitioned): a query only searches
+    the partitions of the target types that follow its context type in the datastore.
+
+    The context type of a query is the token type (input_types) of its current token. For every
+    context type, the most frequent target types of the datastore entries with that context are
+    routed to until they cover coverage of them, e.g. the identifier partition after '.' or '('.
+    Context types the datastore has not seen search every partition. Positions that should not
+    be searched at all are skipped by the RetrievalGate (--gate_skip_types).
+
+    Counts the queries, the entries they searched against the size of their whole project, and
+    the search time.
+    """
+
+    def __init__(self, datastore, coverage=0.95, chunk_size=1 << 22):
+        assert datastore.types is not None, "the datastore stores no token types, build it again"
+        pair_counts = Counter()
+        for start in range(0, datastore.size, chunk_size):
+            pairs, counts = np.unique(np.asarray(datastore.types[start: start + chunk_size]), axis=0,
+                                      return_counts=True)
+            pair_counts.update({tuple(pair): count for pair, count in zip(pairs.tolist(), counts.tolist())})
+        self.target_types = sorted({target_type for _, target_type in pair_counts})
+        self.routes = {}  # context type: target types
+        for context_type in sorted({context_type for context_type, _ in pair_counts}):
+            counts = sorted(((count, target_type) for (other_type, target_type), count in pair_counts.items()
+                             if other_type == context_type), reverse=True)
+            total = sum(count for count, _ in counts)
+            covered = 0
+            self.routes[context_type] = []
+            for count, target_type in counts:
+                if covered >= coverage * total:
+                    break
+                self.routes[context_type].append(target_type)
+                covered += count
+        self.route_table = {context_type: np.isin(self.target_types, route)
+                            for context_type, route in self.routes.items()}
+
+        self.num_queries = 0
+        self.num_searched = 0
+        self.num_entries = 0
+        self.search_time = 0.0
+
+    def route_mask(self, context_types):
+        """ [n, len(target_types)] bool mask of the partitions every context type [n] (numpy) is routed to. """
+        if len(context_types) == 0:
+            return np.zeros((0, len(self.target_types)), dtype=bool)
+        routed_to_all = np.ones(len(self.target_types), dtype=bool)
+        return np.stack([self.route_table.get(context_type, routed_to_all) for context_type in context_types.tolist()])
+
+    def log(self, logger):
+        for context_type, route in self.routes.items():
+            logger.info(f"context type {context_type} is routed to target types {route}")
+        logger.info(f"type partitions: {self.num_queries} queries searched "
+                    f"{self.num_searched / max(self.num_entries, 1):.2%} of the entries of their projects, "
+                    f"search time {self.search_time:.1f}s")
+
+
+class TypeAccuracy(object):
+    """
+    Sub-token accuracy of kNN-LM and of the LM alone, per token type of the target and per token
+    type of the context. Context types where the kNN search does not help are the candidates for
+    --gate_skip_types.
+    """
+
+    def __init__(self):
+        self.total = {'target': Counter(), 'context': Counter()}
+        self.correct = {'target': Counter(), 'context': Counter()}
+        self.lm_correct = {'target': Counter(), 'context': Counter()}
+
+    def update(self, pred_ids, lm_ids, inputs, input_types, query_mask):
+        mask = query_mask[:, :-1]
+        correct = (pred_ids[:, :-1] == inputs[:, 1:])[mask]
+        lm_correct = (lm_ids[:, :-1] == inputs[:, 1:])[mask]
+        input_types = input_types.to(mask.device)
+        for kind, types in (('target', input_types[:, 1:][mask]), ('context', input_types[:, :-1][mask])):
+            for token_type in torch.unique(types).tolist():
+                selected = types == token_type
+                self.total[kind][token_type] += int(selected.sum())
+                self.correct[kind][token_type] += int((correct & selected).sum())
+                self.lm_correct[kind][token_type] += int((lm_correct & selected).sum())
+
+    def log(self, logger):
+        for kind in ('target', 'context'):
+            for token_type in sorted(self.total[kind]):
+                total = self.total[kind][token_type]
+                acc = self.correct[kind][token_type] / total
+                lm_acc = self.lm_correct[kind][token_type] / total
+                logger.info(f"{kind} type {token_type}: {total} sub-tokens, kNN-LM acc {acc:.4f}, "
+                            f"LM acc {lm_acc:.4f} ({acc - lm_acc:+.4f})")
+        no_gain = [token_type for token_type in sorted(self.total['context'])
+                   if self.correct['context'][token_type] <= self.lm_correct['context'][token_type]]
+        logger.info(f"context types the kNN search does not help: {no_gain}")
+
+
+def search_batch(index_cache, hidden_states, proj_meta, k, query_mask=None, num_threads=1, retrieval_cache=None,
+                 omp_threads=None):
+    """
+    Neighbours of every position of a batch, leaving out the file of each sequence.
+
+    The positions are grouped by project and every project is searched once for all its queries,
+    in num_threads parallel threads for cpu indexes (faiss releases the GIL while searching). Each
+    of them runs its faiss searches on omp_threads OpenMP threads, by default the faiss threads
+    divided among them, so that the threads do not oversubscribe the cores.
+    hidden_states [batch_size, seq_len, dim], proj_meta [batch_size, 2] (proj_id, file_id) and
+    query_mask [batch_size, seq_len] of the positions to search, all positions by default.
+    Returns squared l2 distances and target ids [batch_size, seq_len, k] on the device of
+    hidden_states, missing neighbours have distance inf and target -1, and the log entry counts
+    of the neighbours [batch_size, seq_len, k] for compacted datastores, None otherwise.
+    With a RetrievalCache, the queries it holds a close enough neighbour list for are not searched,
+    and the others are searched for the k + margin neighbours of their project it caches.
+    """
+    index_cache.trim()
+    device = hidden_states.device
+    batch_size, seq_len, _ = hidden_states.size()
+    if query_mask is None:
+        query_mask = torch.ones((batch_size, seq_len), dtype=torch.bool, device=device)
+    dists = torch.full((batch_size, seq_len, k), float('inf'), device=device)
+    targets = torch.full((batch_size, seq_len, k), -1, dtype=torch.long, device=device)
+
+    proj_rows = {}
+    for b, (proj_id, file_id) in enumerate(proj_meta.tolist()):
+        proj_rows.setdefault(proj_id, []).append((b, file_id))
+
+    # [num_queries, dim], stays on the device until an index needs it elsewhere
+    xq_all = hidden_states[query_mask]
+    counts = query_mask.sum(-1).tolist()
+    row_offsets = np.cumsum([0] + counts).tolist()
+
+    groups = []
+    group_proj_ids = []
+    lookups = []  # (first query id, hits, searched, cached lists of the hits) of every sequence with hits
+    query_signatures = {}  # query id -> signature, of the searched queries whose lists are cached
+    for proj_id, rows in proj_rows.items():
+        proj_index = index_cache.get(proj_id)
+        query_ids, exclude_starts, exclude_ends = [], [], []
+        for b, file_id in rows:
+            exclude_start, exclude_end = index_cache.file_range(proj_index, file_id)
+            row_query_ids = list(range(row_offsets[b], row_offsets[b + 1]))
+            if retrieval_cache is not None and counts[b] > 0 and proj_index.ntotal > 0:
+                signatures, hits, searched, cached = retrieval_cache.lookup(
+                    xq_all[row_offsets[b]: row_offsets[b + 1]], proj_id, exclude_start, exclude_end, k)
+                if hits.any():
+                    lookups.append((row_offsets[b], hits, searched, cached))
+                for i in (searched & ~hits).nonzero().squeeze(-1).tolist():
+                    query_signatures[row_offsets[b] + i] = signatures[i]
+                row_query_ids = (searched.nonzero().squeeze(-1) + row_offsets[b]).tolist()
+            query_ids.extend(row_query_ids)
+            exclude_starts.extend([exclude_start] * len(row_query_ids))
+            exclude_ends.extend([exclude_end] * len(row_query_ids))
+        if len(query_ids) > 0 and proj_index.ntotal > 0:
+            groups.append((proj_index, torch.tensor(query_ids, dtype=torch.long, device=device),
+                           torch.tensor(exclude_starts, dtype=torch.long), torch.tensor(exclude_ends, dtype=torch.long)))
+            group_proj_ids.append(proj_id)
+
+    def search_group(group):
+        proj_index, query_ids, exclude_starts, exclude_ends = group
+        if retrieval_cache is None:
+            return proj_index.search_neighbours(xq_all[query_ids], k, exclude_starts, exclude_ends), None
+        # the lists to cache leave nothing out, the over-fetch by the longest excluded range leaves
+        # cache_k neighbours outside the file of every query
+        cache_k = k + retrieval_cache.margin
+        fetch = min(cache_k + int((exclude_ends - exclude_starts).max().item()), proj_index.ntotal)
+        if getattr(proj_index, 'max_k', None) is not None and fetch > proj_index.max_k:
+            return proj_index.search_neighbours(xq_all[query_ids], k, exclude_starts, exclude_ends), None
+        no_exclusion = torch.zeros(len(query_ids), dtype=torch.long)
+        l2_dis, group_targets, group_log_counts, local_ids = proj_index.search_neighbours(
+            xq_all[query_ids], fetch, no_exclusion, no_exclusion, with_ids=True)
+        columns = [(l2_dis, float('inf')), (group_targets, -1)]
+        if group_log_counts is not None:
+            columns.append((group_log_counts, 0))
+        with_ids = local_ids is not None
+        if not with_ids:
+            # the index leaves nothing out and has no local ids (see knn_shards.ShardedIndex), 0 marks
+            # the neighbours it found
+            local_ids = group_targets.clamp(max=0)
+        found, _ = keep_outside_ranges(local_ids, exclude_starts, exclude_ends, k, columns)
+        cache_lists, _ = keep_outside_ranges(local_ids, no_exclusion, no_exclusion, cache_k,
+                                             columns + ([(local_ids, -1)] if with_ids else []))
+        if group_log_counts is None:
+            found.append(None)
+            cache_lists.insert(2, None)
+        if not with_ids:
+            cache_lists.append(None)
+        return tuple(found), cache_lists
+
+    # gpu resources are not thread safe, gpu indexes are searched one after the other
+    on_cpu = all(proj_index.query_device.type == 'cpu' for proj_index, _, _, _ in groups)
+    search_start = time.time()
+    if num_threads > 1 and len(groups) > 1 and on_cpu:
+        if omp_threads is None:
+            omp_threads = max(1, faiss.omp_get_max_threads() // num_threads)
+        # the OpenMP thread count is per thread, every worker sets its own
+        with ThreadPoolExecutor(max_workers=num_threads, initializer=faiss.omp_set_num_threads,
+                                initargs=(omp_threads,)) as executor:
+            results = list(executor.map(search_group, groups))
+    else:
+        results = [search_group(group) for group in groups]
+    if retrieval_cache is not None:
+        retrieval_cache.record_search(sum(len(query_ids) for _, query_ids, _, _ in groups),
+                                      time.time() - search_start)
+
+    flat_dists = torch.full((len(xq_all), k), float('inf'), device=device)
+    flat_targets = torch.full((len(xq_all), k), -1, dtype=torch.long, device=device)
+    with_counts = any(group_log_counts is not None for (_, _, group_log_counts), _ in results) or \
+        any(cached_log_counts is not None for _, _, _, (_, _, cached_log_counts) in lookups)
+    flat_log_counts = torch.zeros((len(xq_all), k), device=device) if with_counts else None
+    for (_, query_ids, _, _), ((l2_dis, group_targets, group_log_counts), _) in zip(groups, results):
+        found = l2_dis.size(1)
+        flat_dists[query_ids, :found] = copy_stats.to(l2_dis, device)
+        flat_targets[query_ids, :found] = copy_stats.to(group_targets, device)
+        if group_log_counts is not None:
+            flat_log_counts[query_ids, :found] = copy_stats.to(group_log_counts, device)
+    # the hits were read by their lookups, the inserts cannot evict a list still to be used
+    for proj_id, (_, query_ids, _, _), (_, cache_lists) in zip(group_proj_ids, groups, results):
+        if cache_lists is None:
+            continue
+        new = torch.tensor([query_id in query_signatures for query_id in query_ids.tolist()], dtype=torch.bool)
+        cache_dists, cache_targets, cache_log_counts, cache_ids = \
+            [None if column is None else column[new.to(column.device)] for column in cache_lists]
+        retrieval_cache.insert([query_signatures[query_id] for query_id in query_ids[new.to(device)].tolist()],
+                               xq_all[query_ids[new.to(device)]], proj_id, cache_dists, cache_targets,
+                               cache_log_counts, cache_ids)
+    for offset, hits, searched, (cached_dists, cached_targets, cached_log_counts) in lookups:
+        row_query_ids = torch.arange(offset, offset + len(hits), device=device)
+        hit_query_ids = row_query_ids[hits.to(device)]
+        audited = searched[hits]
+        retrieval_cache.audit(cached_targets[audited], flat_targets[hit_query_ids[audited.to(device)]])
+        flat_dists[hit_query_ids] = copy_stats.to(cached_dists, device)
+        flat_targets[hit_query_ids] = copy_stats.to(cached_targets, device, torch.long)
+        if cached_log_counts is not None:
+            flat_log_counts[hit_query_ids] = copy_stats.to(cached_log_counts, device)
+    dists[query_mask] = flat_dists
+    targets[query_mask] = flat_targets
+    copy_stats.allocated(dists, targets, flat_dists, flat_targets)
+    log_counts = None
+    if with_counts:
+        log_counts = torch.zeros((batch_size, seq_len, k), device=device)
+        log_counts[query_mask] = flat_log_counts
+    return dists, targets, log_counts
+
+
+def search_partitioned(index_cache, router, hidden_states, input_types, proj_meta, k, query_mask=None):
+    """
+    search_batch over the type partitions of the projects (see ProjectIndexCache.get_partition),
+    every query searches the partitions router routes its context type (input_types [batch_size,
+    seq_len]) to, and their neighbours are merged into its top-k.
+    """
+    index_cache.trim()
+    device = hidden_states.device
+    batch_size, seq_len, _ = hidden_states.size()
+    if query_mask is None:
+        query_mask = torch.ones((batch_size, seq_len), dtype=torch.bool, device=device)
+    xq_all = hidden_states[query_mask]
+    routes = torch.from_numpy(router.route_mask(input_types.to(query_mask.device)[query_mask].cpu().numpy()))
+    counts = query_mask.sum(-1).tolist()
+    row_offsets = np.cumsum([0] + counts).tolist()
+
+    flat_dists = torch.full((len(xq_all), k), float('inf'), device=device)
+    flat_targets = torch.full((len(xq_all), k), -1, dtype=torch.long, device=device)
+    flat_log_counts = None
+    proj_rows = {}
+    for b, (proj_id, file_id) in enumerate(proj_meta.tolist()):
+        proj_rows.setdefault(proj_id, []).append((b, file_id))
+
+    search_start = time.time()
+    for proj_id, rows in proj_rows.items():
+        proj_size = sum(end - start for start, end in index_cache.runs(proj_id)[0])
+        router.num_queries += sum(counts[b] for b, _ in rows)
+        router.num_entries += proj_size * sum(counts[b] for b, _ in rows)
+        for column, target_type in enumerate(router.target_types):
+            partition = index_cache.get_partition(proj_id, target_type)
+            if partition.ntotal == 0:
+                continue
+            query_ids, exclude_starts, exclude_ends = [], [], []
+            for b, file_id in rows:
+                row_query_ids = (routes[row_offsets[b]: row_offsets[b + 1], column].nonzero().squeeze(-1) +
+                                 row_offsets[b]).tolist()
+                exclude_start, exclude_end = index_cache.partition_file_range(partition, file_id)
+                query_ids.extend(row_query_ids)
+                exclude_starts.extend([exclude_start] * len(row_query_ids))
+                exclude_ends.extend([exclude_end] * len(row_query_ids))
+            if len(query_ids) == 0:
+                continue
+            query_ids = torch.tensor(query_ids, dtype=torch.long, device=device)
+            l2_dis, targets, log_counts = partition.search_neighbours(
+                xq_all[query_ids], k, torch.tensor(exclude_starts, dtype=torch.long),
+                torch.tensor(exclude_ends, dtype=torch.long))
+            router.num_searched += partition.ntotal * len(query_ids)
+
+            # merge with the neighbours found in the other partitions
+            merged_dists, positions = torch.cat([flat_dists[query_ids], copy_stats.to(l2_dis, device)], dim=1).topk(
+                k, dim=1, largest=False)
+            flat_dists[query_ids] = merged_dists
+            flat_targets[query_ids] = torch.cat([flat_targets[query_ids], copy_stats.to(targets, device)],
+                                                dim=1).gather(1, positions)
+            if log_counts is not None and flat_log_counts is None:
+                flat_log_counts = torch.zeros((len(xq_all), k), device=device)
+            if flat_log_counts is not None:
+                partition_log_counts = torch.zeros_like(l2_dis, device=device) if log_counts is None else \
+                    copy_stats.to(log_counts, device)
+                flat_log_counts[query_ids] = torch.cat([flat_log_counts[query_ids], partition_log_counts],
+                                                       dim=1).gather(1, positions)
+    router.search_time += time.time() - search_start
+
+    dists = torch.full((batch_size, seq_len, k), float('inf'), device=device)
+    targets = torch.full((batch_size, seq_len, k), -1, dtype=torch.long, device=device)
+    dists[query_mask] = flat_dists
+    targets[query_mask] = flat_targets
+    log_counts = None
+    if flat_log_counts is not None:
+        log_counts = torch.zeros((batch_size, seq_len, k), device=device)
+        log_counts[query_mask] = flat_log_counts
+    return dists, targets, log_counts
+
+
+def search_queries(index_cache, xq, proj_id, file_id, k, device):
+    """
+    Neighbours of the queries xq [n, dim] (tensor or array) of one sequence, leaving out its file.
+    Returns squared l2 distances, target ids and log entry counts [n, k] on device, like search_batch.
+    """
+    index_cache.trim()
+    xq = torch.as_tensor(xq)
+    dists = torch.full((len(xq), k), float('inf'), device=device)
+    targets = torch.full((len(xq), k), -1, dtype=torch.long, device=device)
+    log_counts = torch.zeros((len(xq), k), device=device) if index_cache.datastore.counts is not None else None
+    proj_index = index_cache.get(proj_id)
+    exclude_start, exclude_end = index_cache.file_range(proj_index, file_id)
+    if len(xq) > 0 and proj_index.ntotal > exclude_end - exclude_start:
+        l2_dis, found_targets, found_log_counts = proj_index.search(xq, k, exclude_start, exclude_end)
+        dists[:, :l2_dis.size(1)] = copy_stats.to(l2_dis, device)
+        targets[:, :l2_dis.size(1)] = copy_stats.to(found_targets, device)
+        if log_counts is not None:
+            log_counts[:, :l2_dis.size(1)] = copy_stats.to(found_log_counts, device)
+    copy_stats.allocated(dists, targets)
+    return dists, targets, log_counts
+
+
+def knn_weights(dists, targets, temperature=1.0, log_counts=None):
+    """
+    softmax(-distance / temperature) over the neighbours, missing neighbours get weight 0.
+    The weight of a compacted entry is multiplied by its count, log_counts is added to the logits.
+    """
+    logits = -dists.sqrt() / temperature
+    if log_counts is not None:
+        logits = logits + log_counts
+    return torch.softmax(logits, dim=-1).masked_fill(targets < 0, 0)
+
+
+def null_neighbour_weights(dists, targets, log_counts=None):
+    """
+    softmax(-distance) with an extra neighbour at distance 0 in front. Its weight is returned
+    as alpha, the LM weight of the interpolation, and is 1 when no neighbour was found.
+    log_counts weights compacted entries like knn_weights, the null neighbour counts once.
+    """
+    logits = -dists.sqrt()
+    if log_counts is not None:
+        logits = logits + log_counts
+    logits = torch.cat([torch.zeros_like(logits[..., :1]), logits], dim=-1)
+    logits = torch.softmax(logits, dim=-1)
+    return logits[..., 0], logits[..., 1:].masked_fill(targets < 0, 0)
+
+
+def aggregate_sparse(ids, weights):
+    """
+    Sum the weights of equal ids along the last dimension. Returns the unique ids, padded with -1,
+    and their summed weights, padded with 0, in tensors of the input shape. Entries with id < 0
+    are missing and must have weight 0.
+    """
+    sorted_ids, order = ids.sort(dim=-1)
+    sorted_weights = weights.gather(-1, order)
+    new_id = torch.ones_like(sorted_ids, dtype=torch.bool)
+    new_id[..., 1:] = sorted_ids[..., 1:] != sorted_ids[..., :-1]
+    slots = new_id.long().cumsum(-1) - 1
+    unique_weights = torch.zeros_like(sorted_weights).scatter_add_(-1, slots, sorted_weights)
+    unique_ids = torch.full_like(sorted_ids, -1).scatter_(-1, slots, sorted_ids)
+    return unique_ids, unique_weights
+
+
+def knn_sparse(dists, targets, temperature=1.0, log_counts=None):
+    """ Sparse kNN distribution, candidate target ids and their probabilities [..., k]. """
+    return aggregate_sparse(targets, knn_weights(dists, targets, temperature, log_counts))
+
+
+def _expand_coef(coef):
+    # per position coefficients [...] broadcast over the candidates
+    return coef.unsqueeze(-1) if torch.is_tensor(coef) else coef
+
+
+def interpolate_argmax(lm_probs, knn_ids, knn_probs, lm_coef, knn_coef):
+    """
+    argmax of lm_coef * p_lm + knn_coef * p_knn without building the dense kNN distribution.
+
+    lm_probs [..., vocab_size], the sparse kNN distribution knn_ids / knn_probs [..., k] and the
+    coefficients are floats or per position tensors [...]. A token outside the kNN candidates
+    scores at most lm_coef * p_lm of the LM best token, so the argmax is either that token or
+    one of the candidates.
+    """
+    lm_coef, knn_coef = _expand_coef(lm_coef), _expand_coef(knn_coef)
+    lm_best_probs, lm_best = lm_probs.max(-1, keepdim=True)
+    valid = knn_ids >= 0
+    candidate_scores = lm_coef * lm_probs.gather(-1, knn_ids.clamp(min=0)) + knn_coef * knn_probs
+    candidate_scores = candidate_scores.masked_fill(~valid, -1)
+    best_scores, best = candidate_scores.max(-1, keepdim=True)
+    lm_best_scores = lm_coef * lm_best_probs + \
+        knn_coef * (knn_probs * (knn_ids == lm_best)).sum(-1, keepdim=True)
+    pred_ids = torch.where(best_scores > lm_best_scores, knn_ids.gather(-1, best), lm_best)
+    return pred_ids.squeeze(-1)
+
+
+def interpolate_log_prob(lm_probs, knn_ids, knn_probs, lm_coef, knn_coef, target_ids):
+    """ log(lm_coef * p_lm + knn_coef * p_knn) of target_ids [...]. """
+    lm_coef, knn_coef = _expand_coef(lm_coef), _expand_coef(knn_coef)
+    target_ids = target_ids.unsqueeze(-1)
+    probs = lm_coef * lm_probs.gather(-1, target_ids) + \
+        knn_coef * (knn_probs * (knn_ids == target_ids)).sum(-1, keepdim=True)
+    return probs.squeeze(-1).log()
+
+
+def sparse_sum_argmax(ids, probs):
+    """ argmax of a distribution given as (ids, probs) [..., n] whose ids may repeat. """
+    unique_ids, unique_probs = aggregate_sparse(ids, probs)
+    return unique_ids.gather(-1, unique_probs.argmax(-1, keepdim=True)).squeeze(-1)
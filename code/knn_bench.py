@@ -0,0 +1,288 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Recall / latency / memory benchmark of index specs against exact search, on cpu faiss.
+
+Queries are datastore keys of the largest projects, searched with their own file left out
+like in eval_acc:
+
+    python knn_bench.py --datastore_dir save/datastore --specs IVF1024,Flat:nprobe=16 \
+        IVF1024,PQ64:nprobe=16 HNSW32:efSearch=128
+
+A spec is a faiss index_factory string, optionally followed by ':' and its runtime parameters,
+or TorchFlat for the pure torch exact search. SQfp16 and SQ8 measure the exact search on
+scalar quantized keys, as in float16 / sq8 datastores. --projections PCA64 PCA128 runs every spec on
+reduced keys too, --rerank_k adds a run that re-ranks the candidates with the full keys.
+
+--layouts compares, for every faiss spec, one index per project against one shared index over all
+projects searched through ID selectors (run_lm.py --shared_index). Its memory and build time cover
+the indexes of all projects.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import time
+
+import faiss
+import numpy as np
+import torch
+
+from datastore import Datastore
+from knn import (FLAT_SPEC, TORCH_FLAT_SPEC, ProjectIndex, SharedProjectIndex, TorchFlatIndex, build_index,
+                 index_nbytes, open_key_projection, run_ids, set_index_params)
+
+logger = logging.getLogger(__name__)
+
+
+def project_queries(datastore, proj_id, runs, num_queries, seed=42):
+    """ Local ids of num_queries random entries of a project and the local range of their file. """
+    proj_index = ProjectIndex(proj_id, None, runs, None)
+    file_ranges = [proj_index.local_range(start, end)
+                   for file_proj_id, _, start, end in datastore.files.tolist() if file_proj_id == proj_id and end > start]
+    file_starts = np.array([start for start, _ in file_ranges], dtype='int64')
+    file_ends = np.array([end for _, end in file_ranges], dtype='int64')
+    order = np.argsort(file_starts)
+    file_starts, file_ends = file_starts[order], file_ends[order]
+
+    query_ids = np.sort(np.random.RandomState(seed).choice(proj_index.ntotal, min(num_queries, proj_index.ntotal),
+                                                            replace=False))
+    query_files = np.searchsorted(file_starts, query_ids, side='right') - 1
+    return query_ids, file_starts[query_files], file_ends[query_files]
+
+
+def recall(neighbour_indexes, exact_indexes):
+    """ Mean fraction of the exact neighbours of every query that were found. """
+    recalls = []
+    for found, exact in zip(neighbour_indexes, exact_indexes):
+        exact = exact[exact >= 0]
+        if len(exact) > 0:
+            recalls.append(len(np.intersect1d(found, exact)) / len(exact))
+    return recalls
+
+
+def nn_target_agreement(neighbour_targets, exact_targets):
+    """ Fraction of queries whose nearest neighbour has the target of the exact nearest neighbour. """
+    valid = exact_targets[:, 0] >= 0
+    return (neighbour_targets[valid, 0] == exact_targets[valid, 0]).tolist()
+
+
+def benchmark(datastore, specs, k, num_projects, num_queries, train_size, projections=(), rerank_k=0,
+              projection_sample_size=65536):
+    """
+    Every spec is benchmarked on the full keys and on the keys of every projection, projected
+    indexes also with re-ranking of rerank_k candidates on the full keys if rerank_k > 0.
+    """
+    proj_sizes = {proj_id: sum(end - start for start, end in runs) for proj_id, runs in datastore.project_runs.items()}
+    proj_ids = sorted(proj_sizes, key=lambda x: -proj_sizes[x])[:num_projects]
+
+    settings = []  # (name, projection, rerank_k, index_spec, index_params)
+    for projection_spec in [''] + list(projections):
+        projection = open_key_projection(datastore, projection_spec, 'cpu', projection_sample_size)
+        for spec in specs:
+            index_spec, _, index_params = spec.partition(':')
+            name = spec if projection is None else f"{projection_spec}/{spec}"
+            settings.append((name, projection, 0, index_spec, index_params))
+            if projection is not None and rerank_k > 0:
+                settings.append((f"{name}/rerank{rerank_k}", projection, rerank_k, index_spec, index_params))
+
+    results = {name: {'recalls': [], 'agreements': [], 'search_time': 0.0, 'build_time': 0.0, 'num_queries': 0,
+                      'memory': 0, 'flat_fallbacks': 0} for name, _, _, _, _ in settings}
+    for proj_id in proj_ids:
+        runs = datastore.project_runs[proj_id]
+        keys = np.concatenate([datastore.keys[start: end] for start, end in runs]).astype('float32')
+        vals = torch.from_numpy(np.concatenate([datastore.vals[start: end] for start, end in runs]).astype('int64'))
+        query_ids, exclude_starts, exclude_ends = project_queries(datastore, proj_id, runs, num_queries)
+        xq = torch.from_numpy(keys[query_ids])
+        exclude_starts, exclude_ends = torch.from_numpy(exclude_starts), torch.from_numpy(exclude_ends)
+
+        exact_index, _ = build_index(keys, FLAT_SPEC)
+        _, exact_indexes = ProjectIndex(proj_id, exact_index, runs, vals).search_ranges(xq, k, exclude_starts,
+                                                                                        exclude_ends)
+        exact_targets = torch.where(exact_indexes >= 0, vals[exact_indexes.clamp(min=0)], exact_indexes)
+        logger.info(f"project {proj_id}: {len(keys)} keys, {len(xq)} queries")
+
+        for name, projection, setting_rerank_k, index_spec, index_params in settings:
+            index_keys = keys if projection is None else \
+                np.concatenate([projection.keys[start: end] for start, end in runs]).astype('float32')
+            start_time = time.time()
+            if index_spec == TORCH_FLAT_SPEC:
+                index, built_spec = TorchFlatIndex(torch.from_numpy(index_keys)), index_spec
+            else:
+                index, built_spec = build_index(index_keys, index_spec, train_size)
+                set_index_params(index, built_spec, index_params)
+            results[name]['build_time'] += time.time() - start_time
+            results[name]['flat_fallbacks'] += built_spec != index_spec
+
+            proj_index = ProjectIndex(proj_id, index, runs, vals, projection=projection, rerank_k=setting_rerank_k,
+                                      full_keys=datastore.keys if setting_rerank_k > 0 else None)
+            start_time = time.time()
+            _, neighbour_indexes = proj_index.search_ranges(xq, k, exclude_starts, exclude_ends)
+            results[name]['search_time'] += time.time() - start_time
+            results[name]['num_queries'] += len(xq)
+            results[name]['recalls'].extend(recall(neighbour_indexes.numpy(), exact_indexes.numpy()))
+            neighbour_targets = torch.where(neighbour_indexes >= 0, vals[neighbour_indexes.clamp(min=0)],
+                                            neighbour_indexes)
+            results[name]['agreements'].extend(nn_target_agreement(neighbour_targets, exact_targets))
+            if isinstance(index, TorchFlatIndex):
+                results[name]['memory'] += index_keys.nbytes + index.key_norms.numel() * index.key_norms.element_size()
+            else:
+                results[name]['memory'] += faiss.serialize_index(index).nbytes
+
+    report = []
+    for name, _, _, _, _ in settings:
+        result = results[name]
+        report.append({
+            'spec': name,
+            'recall': float(np.mean(result['recalls'])) if result['recalls'] else 0.0,
+            'nn_target_agreement': float(np.mean(result['agreements'])) if result['agreements'] else 0.0,
+            'latency_ms': 1000 * result['search_time'] / max(result['num_queries'], 1),
+            'build_time': result['build_time'],
+            'memory_mb': result['memory'] / 2 ** 20,
+            'flat_fallbacks': result['flat_fallbacks'],
+        })
+    return report
+
+
+def benchmark_layouts(datastore, specs, k, num_projects, num_queries, train_size):
+    """
+    Per-project indexes against one shared index over all projects (see SharedIndexCache) for
+    every faiss spec. Recall and latency are measured on the queries of the num_projects largest
+    projects, memory and build time over the indexes of all projects.
+    """
+    proj_sizes = {proj_id: sum(end - start for start, end in runs) for proj_id, runs in datastore.project_runs.items()}
+    queried = set(sorted(proj_sizes, key=lambda x: -proj_sizes[x])[:num_projects])
+
+    queries = {}  # proj_id: (xq, exclude_starts, exclude_ends, vals, exact neighbour ids, exact targets)
+    for proj_id in sorted(queried):
+        runs = datastore.project_runs[proj_id]
+        keys = np.concatenate([datastore.keys[start: end] for start, end in runs]).astype('float32')
+        vals = torch.from_numpy(np.concatenate([datastore.vals[start: end] for start, end in runs]).astype('int64'))
+        query_ids, exclude_starts, exclude_ends = project_queries(datastore, proj_id, runs, num_queries)
+        xq = torch.from_numpy(keys[query_ids])
+        exclude_starts, exclude_ends = torch.from_numpy(exclude_starts), torch.from_numpy(exclude_ends)
+        exact_index, _ = build_index(keys, FLAT_SPEC)
+        _, exact_indexes = ProjectIndex(proj_id, exact_index, runs, vals).search_ranges(xq, k, exclude_starts,
+                                                                                        exclude_ends)
+        exact_targets = torch.where(exact_indexes >= 0, vals[exact_indexes.clamp(min=0)], exact_indexes)
+        queries[proj_id] = (xq, exclude_starts, exclude_ends, vals, exact_indexes, exact_targets)
+
+    all_runs = [(0, datastore.size)]
+    report = []
+    for spec in specs:
+        index_spec, _, index_params = spec.partition(':')
+        for layout in ['per_project', 'shared']:
+            result = {'recalls': [], 'agreements': [], 'search_time': 0.0, 'build_time': 0.0, 'num_queries': 0,
+                      'memory': 0, 'num_indexes': 0, 'flat_fallbacks': 0}
+            shared = None
+            if layout == 'shared':
+                start_time = time.time()
+                shared, built_spec = build_index(np.ascontiguousarray(datastore.keys[:], dtype='float32'),
+                                                 index_spec, train_size, ids=run_ids(all_runs))
+                set_index_params(shared, built_spec, index_params)
+                result['build_time'] += time.time() - start_time
+                result['memory'] += index_nbytes(shared)
+                result['num_indexes'] += 1
+                result['flat_fallbacks'] += built_spec != index_spec
+
+            for proj_id, runs in datastore.project_runs.items():
+                if shared is not None:
+                    if proj_id not in queried:
+                        continue
+                    proj_index = SharedProjectIndex(proj_id, shared, runs, queries[proj_id][3])
+                else:
+                    keys = np.concatenate([datastore.keys[start: end] for start, end in runs] +
+                                          [np.zeros((0, datastore.dim))]).astype('float32')
+                    if len(keys) == 0:
+                        continue
+                    start_time = time.time()
+                    index, built_spec = build_index(keys, index_spec, train_size)
+                    set_index_params(index, built_spec, index_params)
+                    result['build_time'] += time.time() - start_time
+                    result['memory'] += index_nbytes(index)
+                    result['num_indexes'] += 1
+                    result['flat_fallbacks'] += built_spec != index_spec
+                    if proj_id not in queried:
+                        continue
+                    proj_index = ProjectIndex(proj_id, index, runs, queries[proj_id][3])
+
+                xq, exclude_starts, exclude_ends, vals, exact_indexes, exact_targets = queries[proj_id]
+                start_time = time.time()
+                _, neighbour_indexes = proj_index.search_ranges(xq, k, exclude_starts, exclude_ends)
+                result['search_time'] += time.time() - start_time
+                result['num_queries'] += len(xq)
+                result['recalls'].extend(recall(neighbour_indexes.numpy(), exact_indexes.numpy()))
+                neighbour_targets = torch.where(neighbour_indexes >= 0, vals[neighbour_indexes.clamp(min=0)],
+                                                neighbour_indexes)
+                result['agreements'].extend(nn_target_agreement(neighbour_targets, exact_targets))
+
+            report.append({
+                'spec': f"{layout}/{spec}",
+                'recall': float(np.mean(result['recalls'])) if result['recalls'] else 0.0,
+                'nn_target_agreement': float(np.mean(result['agreements'])) if result['agreements'] else 0.0,
+                'latency_ms': 1000 * result['search_time'] / max(result['num_queries'], 1),
+                'build_time': result['build_time'],
+                'memory_mb': result['memory'] / 2 ** 20,
+                'num_indexes': result['num_indexes'],
+                'flat_fallbacks': result['flat_fallbacks'],
+            })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datastore_dir", default=None, type=str, required=True,
+                        help="Datastore saved by run_lm.py")
+    parser.add_argument("--specs", default=[FLAT_SPEC], type=str, nargs='+',
+                        help="Index specs, faiss index_factory strings optionally followed by :runtime_params")
+    parser.add_argument("--projections", default=[], type=str, nargs='*',
+                        help="Key projections (faiss VectorTransform specs such as PCA128) every spec is also run on")
+    parser.add_argument("--projection_sample_size", default=65536, type=int,
+                        help="Number of keys a key projection is fitted on")
+    parser.add_argument("--rerank_k", default=0, type=int,
+                        help="Also run projected indexes with this many candidates re-ranked on the full keys")
+    parser.add_argument("--layouts", action='store_true',
+                        help="Compare per-project indexes with one shared index over all projects instead")
+    parser.add_argument("--k", default=1024, type=int,
+                        help="Number of neighbours searched")
+    parser.add_argument("--num_projects", default=4, type=int,
+                        help="Number of the largest projects benchmarked")
+    parser.add_argument("--num_queries", default=1000, type=int,
+                        help="Number of queries per project")
+    parser.add_argument("--train_size", default=65536, type=int,
+                        help="Maximum number of keys an index is trained on")
+    parser.add_argument("--threads", default=0, type=int,
+                        help="Number of faiss threads, all cores by default")
+    parser.add_argument("--output_file", default=None, type=str,
+                        help="Optional json file for the benchmark results")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+
+    if args.threads > 0:
+        faiss.omp_set_num_threads(args.threads)
+        torch.set_num_threads(args.threads)
+
+    datastore = Datastore(args.datastore_dir)
+    if args.layouts:
+        report = benchmark_layouts(datastore, [spec for spec in args.specs if spec != TORCH_FLAT_SPEC], args.k,
+                                   args.num_projects, args.num_queries, args.train_size)
+    else:
+        report = benchmark(datastore, args.specs, args.k, args.num_projects, args.num_queries, args.train_size,
+                           args.projections, args.rerank_k, args.projection_sample_size)
+    for result in report:
+        logger.info("%-40s recall@%d: %.4f  nn target agreement: %.4f  latency: %.3f ms/query  build: %.1fs  "
+                    "memory: %.1f MB  flat fallbacks: %d", result['spec'], args.k, result['recall'],
+                    result['nn_target_agreement'], result['latency_ms'], result['build_time'], result['memory_mb'],
+                    result['flat_fallbacks'])
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Scatter-gather search over a sharded datastore (see ShardedDatastoreWriter).
+
+Every shard is opened and indexed by its own worker process, so no process holds more than one
+shard. The coordinator sends every query batch to all workers at once, they search their shard
+in parallel, and the per-shard top-k lists are merged into the global top-k:
+
+    index_cache = ShardedIndexCache(shard_dirs(path), index_spec='IVF1024,Flat', index_params='nprobe=16')
+    dists, targets, log_counts = search_batch(index_cache, hidden_states, proj_meta, k)
+    index_cache.close()
+
+Queries and results go through pipes as numpy arrays. The workers search on the cpu with
+num_threads faiss threads each.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import multiprocessing
+
+import numpy as np
+import torch
+
+from datastore import Datastore
+from knn import GlobalIndexCache, IndexManager, open_key_projection
+
+logger = logging.getLogger(__name__)
+
+
+def serve_shard(path, conn, index_kwargs, projection_spec='', projection_sample_size=65536, num_threads=0):
+    """
+    Worker loop: index the shard at path, send its size once ready, then answer (xq, k) requests
+    with the (dists, targets, log_counts) numpy arrays of its top-k until it receives None.
+    """
+    try:
+        datastore = Datastore(path)
+        projection = open_key_projection(datastore, projection_spec, 'cpu', projection_sample_size)
+        index_cache = GlobalIndexCache(datastore, 'cpu', IndexManager(-1, num_threads), projection=projection,
+                                       **index_kwargs)
+        index = index_cache.get(-1)
+        conn.send(index.ntotal)
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            xq, k = request
+            if index.ntotal == 0:
+                conn.send((np.zeros((len(xq), 0), dtype='float32'), np.zeros((len(xq), 0), dtype='int64'), None))
+                continue
+            # the domain datastore holds no eval file, nothing is left out
+            no_exclusion = torch.zeros(len(xq), dtype=torch.long)
+            dists, targets, log_counts = index.search_neighbours(torch.from_numpy(xq), k, no_exclusion, no_exclusion)
+            conn.send((dists.numpy(), targets.numpy(), None if log_counts is None else log_counts.numpy()))
+    except Exception as e:
+        conn.send(e)
+        raise
+    finally:
+        conn.close()
+
+
+class ShardedIndex(object):
+    """
+    Coordinator of the shard workers, searched by search_batch like a ProjectIndex whose
+    search_neighbours fans the queries out to all shards and merges their top-k.
+    """
+
+    def __init__(self, paths, index_kwargs, projection_spec='', projection_sample_size=65536, num_threads=0):
+        self.proj_id = -1
+        self.query_device = torch.device('cpu')
+        # spawned workers do not inherit the cuda context or the faiss state of the coordinator
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.workers = []
+        for path in paths:
+            conn, worker_conn = context.Pipe()
+            worker = context.Process(target=serve_shard, daemon=True,
+                                     args=(path, worker_conn, index_kwargs, projection_spec, projection_sample_size,
+                                           num_threads))
+            worker.start()
+            worker_conn.close()
+            self.connections.append(conn)
+            self.workers.append(worker)
+        self.shard_sizes = [self._receive(conn) for conn in self.connections]
+        self.ntotal = sum(self.shard_sizes)
+        logger.info(f"{len(paths)} shard workers ready, {self.ntotal} entries")
+
+    def _receive(self, conn):
+        message = conn.recv()
+        if isinstance(message, Exception):
+            raise RuntimeError("shard worker failed") from message
+        return message
+
+    def search_neighbours(self, xq, k, exclude_starts, exclude_ends, with_ids=False):
+        """
+        Global top-k (dists, targets, log_counts) over all shards, nothing is excluded. The shards
+        have no local ids, with_ids adds None.
+        """
+        xq = np.ascontiguousarray(xq.detach().cpu().numpy(), dtype='float32')
+        for conn in self.connections:
+            conn.send((xq, k))
+        results = [self._receive(conn) for conn in self.connections]
+
+        dists = torch.from_numpy(np.concatenate([shard_dists for shard_dists, _, _ in results], axis=1))
+        targets = torch.from_numpy(np.concatenate([shard_targets for _, shard_targets, _ in results], axis=1))
+        dists, positions = dists.topk(min(k, dists.size(1)), dim=1, largest=False)
+        targets = targets.gather(1, positions)
+        log_counts = None
+        if any(shard_log_counts is not None for _, _, shard_log_counts in results):
+            log_counts = torch.from_numpy(np.concatenate(
+                [shard_log_counts if shard_log_counts is not None else np.zeros(shard_dists.shape, dtype='float32')
+                 for shard_dists, _, shard_log_counts in results], axis=1)).gather(1, positions)
+        if with_ids:
+            return dists, targets, log_counts, None
+        return dists, targets, log_counts
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class ShardedIndexCache(object):
+    """ Index cache of a sharded domain datastore for search_batch, nothing is left out of the search. """
+
+    def __init__(self, paths, projection_spec='', projection_sample_size=65536, num_threads=0, **index_kwargs):
+        self.index = ShardedIndex(paths, index_kwargs, projection_spec, projection_sample_size, num_threads)
+
+    def get(self, proj_id):
+        return self.index
+
+    def file_range(self, proj_index, file_id):
+        return 0, 0
+
+    def release(self, proj_id):
+        pass
+
+    def trim(self):
+        pass
+
+    def close(self):
+        self.index.close()
@@ -0,0 +1,268 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Offline hyperparameter sweep of the kNN-LM interpolation.
+
+run_lm.py --do_knn_cache searches the neighbours of every eval position once and stores them
+in a neighbour cache together with the LM top-k probabilities. This script then evaluates a
+whole grid of lambda / softmax temperature / k settings on that cache without a model, an
+index or a GPU:
+
+    python knn_sweep.py --knn_cache_dir save/knn_cache --lambdas 0.1,0.25,0.5 \
+        --temperatures 0.5,1,2 --ks 16,64,256,1024
+
+Token accuracy counts a token as correct when all of its sub-tokens are predicted exactly.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from datastore import ChunkedArrayWriter, MANIFEST_NAME, FORMAT_VERSION, _open_memmap
+
+logger = logging.getLogger(__name__)
+
+CACHE_ARRAYS = {
+    # name: (per row shape, dtype), 'k' and 'topk' are filled in from the manifest
+    'dists': (('k',), 'float32'),
+    'targets': (('k',), 'int32'),
+    'lm_ids': (('topk',), 'int32'),
+    'lm_probs': (('topk',), 'float16'),
+    'gts': ((), 'int32'),
+    'token_starts': ((), 'uint8'),
+    'counted': ((), 'uint8'),
+}
+# log entry counts of the neighbours, only cached for compacted datastores
+LOG_COUNTS_ARRAY = ('log_counts', (('k',), 'float32'))
+
+
+def token_boundary_tables(tokenizer):
+    """
+    Vocabulary lookup tables that reproduce how eval_acc groups sub-tokens into tokens:
+    starts[id] if id begins a new token, single[id] if id is a token on its own (and so the
+    next sub-token begins a new one), counted[id] if the token counts for accuracy.
+    """
+    specials = [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id]
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    single = np.array([token.startswith("<NUM_LIT") for token in tokens], dtype='bool')
+    single[specials] = True
+    starts = np.array([token[0] == '\u0120' for token in tokens], dtype='bool') | single
+    counted = np.ones(len(tokens), dtype='bool')
+    counted[specials] = False
+    return starts, single, counted
+
+
+class NeighbourCacheWriter(object):
+    """ Neighbours (squared l2 distances, target ids) and LM top-k of every eval position. """
+
+    def __init__(self, path, k, topk, vocab_size, chunk_size=4096, with_counts=False):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest_file = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        self.path = path
+        self.k = k
+        self.topk = topk
+        self.vocab_size = vocab_size
+        self.with_counts = with_counts
+        sizes = {'k': k, 'topk': topk}
+        self._writers = {}
+        arrays = list(CACHE_ARRAYS.items()) + ([LOG_COUNTS_ARRAY] if with_counts else [])
+        for name, (row_shape, dtype) in arrays:
+            self._writers[name] = ChunkedArrayWriter(os.path.join(path, name + '.bin'),
+                                                     [sizes[dim] for dim in row_shape], dtype, chunk_size)
+
+    def add(self, dists, targets, lm_ids, lm_probs, gts, token_starts, counted, log_counts=None):
+        """
+        Neighbours missing because the project is too small have distance inf and target -1.
+        token_starts must be set on the first position of every sample, log_counts is given
+        if and only if the writer was created with_counts.
+        """
+        for name, rows in (('dists', dists), ('targets', targets), ('lm_ids', lm_ids), ('lm_probs', lm_probs),
+                           ('gts', gts), ('token_starts', token_starts), ('counted', counted),
+                           ('log_counts', log_counts)):
+            if rows is not None:
+                self._writers[name].add(rows)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        manifest = {
+            'version': FORMAT_VERSION,
+            'size': self._writers['gts'].size,
+            'k': self.k,
+            'topk': self.topk,
+            'vocab_size': self.vocab_size,
+            'has_counts': self.with_counts,
+        }
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        logger.info("neighbour cache saved at %s, %d positions", self.path, manifest['size'])
+
+
+class NeighbourCache(object):
+    """ Read-only, memory-mapped view of a NeighbourCacheWriter directory. """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        self.size = self.manifest['size']
+        self.k = self.manifest['k']
+        self.topk = self.manifest['topk']
+        self.vocab_size = self.manifest['vocab_size']
+        sizes = {'k': self.k, 'topk': self.topk}
+        self.log_counts = None
+        arrays = list(CACHE_ARRAYS.items()) + ([LOG_COUNTS_ARRAY] if self.manifest.get('has_counts', False) else [])
+        for name, (row_shape, dtype) in arrays:
+            shape = (self.size,) + tuple(sizes[dim] for dim in row_shape)
+            setattr(self, name, _open_memmap(os.path.join(path, name + '.bin'), dtype, shape))
+
+
+def knn_weights(dists, targets, ks, temperatures, log_counts=None):
+    """
+    kNN softmax weights of every (k, temperature) setting, [num_settings, n, K].
+    Neighbours beyond k or missing ones get weight 0, as do rows without any neighbour.
+    The weights of compacted entries are multiplied by their counts.
+    """
+    logits = -np.sqrt(np.maximum(dists, 0))[None] / temperatures[:, None, None]
+    if log_counts is not None:
+        logits = logits + log_counts[None]
+    in_top_k = np.arange(dists.shape[1])[None, None, :] < ks[:, None, None]
+    logits = np.where(in_top_k & (targets >= 0)[None], logits, -np.inf)
+    row_max = logits.max(-1, keepdims=True)
+    weights = np.exp(logits - np.where(np.isfinite(row_max), row_max, 0))
+    return weights / np.maximum(weights.sum(-1, keepdims=True), np.finfo('float32').tiny)
+
+
+def sweep_chunk(dists, targets, lm_ids, lm_probs, ks, temperatures, lambdas, vocab_size, log_counts=None):
+    """
+    Interpolated argmax of every setting for one chunk of positions, [num_settings, num_lambdas, n].
+
+    Only the kNN targets and the LM top-k can win the argmax, so the scores are computed on the
+    unique (position, token) candidates instead of the full vocabulary.
+    """
+    n, k = targets.shape
+    rows = np.arange(n, dtype='int64')[:, None]
+    valid = targets >= 0
+    # missing neighbours point at the LM top-1 with weight 0, so every key is a real candidate
+    knn_keys = rows * vocab_size + np.where(valid, targets, lm_ids[:, :1])
+    lm_keys = rows * vocab_size + lm_ids
+    candidates, inverse = np.unique(np.concatenate([knn_keys.ravel(), lm_keys.ravel()]), return_inverse=True)
+    num_candidates = len(candidates)
+    knn_inverse, lm_inverse = inverse[:n * k], inverse[n * k:]
+
+    num_settings = len(ks)
+    weights = knn_weights(dists, targets, ks, temperatures, log_counts).reshape(num_settings, -1)
+    flat_index = (np.arange(num_settings)[:, None] * num_candidates + knn_inverse[None]).ravel()
+    p_knn = np.bincount(flat_index, weights=weights.ravel(),
+                        minlength=num_settings * num_candidates).reshape(num_settings, num_candidates)
+    p_lm = np.bincount(lm_inverse, weights=lm_probs.ravel(), minlength=num_candidates)
+
+    # [num_settings, num_lambdas, num_candidates]
+    scores = lambdas[None, :, None] * p_knn[:, None, :] + (1 - lambdas)[None, :, None] * p_lm[None, None, :]
+
+    candidate_rows = candidates // vocab_size
+    row_starts = np.flatnonzero(np.r_[True, candidate_rows[1:] != candidate_rows[:-1]])
+    row_sizes = np.diff(np.r_[row_starts, num_candidates])
+    row_max = np.maximum.reduceat(scores, row_starts, axis=-1)
+    is_max = scores >= np.repeat(row_max, row_sizes, axis=-1)
+    # ties go to the smallest token id, like argmax over the dense vocabulary
+    best = np.minimum.reduceat(np.where(is_max, np.arange(num_candidates), num_candidates), row_starts, axis=-1)
+    return candidates[best] % vocab_size
+
+
+def sweep(cache, lambdas, temperatures, ks, max_elements=1 << 26):
+    """ Token and sub-token accuracy of every (k, temperature, lambda) setting on a NeighbourCache. """
+    assert max(ks) <= cache.k, f"the neighbour cache only has {cache.k} neighbours per position"
+    settings = [(k, temperature) for k in ks for temperature in temperatures]
+    setting_ks = np.array([k for k, _ in settings], dtype='int64')
+    setting_temperatures = np.array([temperature for _, temperature in settings], dtype='float32')
+    lambdas = np.array(lambdas, dtype='float32')
+
+    token_correct = np.zeros((len(settings), len(lambdas)))
+    subtoken_correct = np.zeros((len(settings), len(lambdas)))
+    num_tokens = 0
+
+    token_starts = np.flatnonzero(np.asarray(cache.token_starts))
+    chunk_size = max(1, max_elements // (len(settings) * len(lambdas) * (cache.k + cache.topk)))
+    start = 0
+    while start < cache.size:
+        # chunks end on token boundaries, so no token is split between two of them
+        i = np.searchsorted(token_starts, start + chunk_size)
+        end = token_starts[i] if i < len(token_starts) else cache.size
+
+        pred = sweep_chunk(np.asarray(cache.dists[start: end]),
+                           np.asarray(cache.targets[start: end], dtype='int64'),
+                           np.asarray(cache.lm_ids[start: end], dtype='int64'),
+                           np.asarray(cache.lm_probs[start: end], dtype='float32'),
+                           setting_ks, setting_temperatures, lambdas, cache.vocab_size,
+                           None if cache.log_counts is None else np.asarray(cache.log_counts[start: end]))
+        correct = pred == np.asarray(cache.gts[start: end])[None, None, :]
+        subtoken_correct += correct.sum(-1)
+
+        local_starts = np.flatnonzero(np.asarray(cache.token_starts[start: end]))
+        counted = np.asarray(cache.counted[start: end])[local_starts].astype('bool')
+        token_ok = np.minimum.reduceat(correct, local_starts, axis=-1)
+        token_correct += token_ok[..., counted].sum(-1)
+        num_tokens += counted.sum()
+        start = end
+
+    results = []
+    for i, (k, temperature) in enumerate(settings):
+        for j, lmbda in enumerate(lambdas.tolist()):
+            results.append({
+                'k': k,
+                'temperature': temperature,
+                'lambda': lmbda,
+                'token_acc': token_correct[i, j] / max(num_tokens, 1),
+                'subtoken_acc': subtoken_correct[i, j] / max(cache.size, 1),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--knn_cache_dir", default=None, type=str, required=True,
+                        help="Neighbour cache written by run_lm.py --do_knn_cache")
+    parser.add_argument("--lambdas", default="0,0.1,0.25,0.4,0.5", type=str,
+                        help="Comma separated kNN interpolation weights")
+    parser.add_argument("--temperatures", default="0.5,1,2,4", type=str,
+                        help="Comma separated softmax temperatures of the kNN distances")
+    parser.add_argument("--ks", default="16,64,256,1024", type=str,
+                        help="Comma separated number of neighbours")
+    parser.add_argument("--max_elements", default=1 << 26, type=int,
+                        help="Upper bound of the score matrix size per chunk")
+    parser.add_argument("--output_file", default=None, type=str,
+                        help="Optional json file for the sweep results")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+
+    cache = NeighbourCache(args.knn_cache_dir)
+    start_time = time.time()
+    results = sweep(cache,
+                    lambdas=[float(x) for x in args.lambdas.split(',')],
+                    temperatures=[float(x) for x in args.temperatures.split(',')],
+                    ks=[int(x) for x in args.ks.split(',')],
+                    max_elements=args.max_elements)
+    logger.info(f"swept {len(results)} settings over {cache.size} positions in {time.time() - start_time:.1f}s")
+
+    for result in sorted(results, key=lambda x: -x['token_acc']):
+        logger.info("k: %5d  temperature: %5.2f  lambda: %.2f  token acc: %.4f  sub-token acc: %.4f",
+                    result['k'], result['temperature'], result['lambda'], result['token_acc'], result['subtoken_acc'])
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
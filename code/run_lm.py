@@ -20,7 +20,6 @@ Code completion (both token level and line level) pipeline in CodeXGLUE
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import copy
 import glob
 import logging
 import os
@@ -28,6 +27,7 @@ import pickle
 import random
 import re
 import shutil
+import time
 import json
 import faiss
 
@@ -40,6 +40,10 @@ from tqdm import tqdm
 
 from modeling_gpt import GPT2LMHeadModel
 from dataset import TextDataset, finetuneDataset, EvalDataset, lineDataset
+from datastore import LM_CACHE_DIR, Datastore, DatastoreWriter, LMCache, LMCacheWriter, datastore_exists, lm_cache_matches
+from knn import IndexManager, PointerRetrieval, ProjectIndexCache, RetrievalCache, RetrievalGate, SharedIndexCache, TypeAccuracy, TypeRouter, copy_stats, interpolate_argmax, knn_sparse, open_key_projection, search_batch, search_partitioned, search_queries, sparse_sum_argmax
+from knn_sweep import NeighbourCacheWriter, token_boundary_tables
+from eval_pipeline import Pipeline, count_correct, decode_batch
 from beam import Beam
 
 
@@ -319,7 +323,7 @@ def evaluate(args, model, tokenizer, prefix="", eval_when_training=False):
 
     return result
 
-def eval_acc(args, model, tokenizer, file_type='test'):
+def eval_acc(args, model, tokenizer, index_manager, file_type='test'):
     """
     Evaluate token level code completion on accuracy.
 
@@ -360,78 +364,31 @@ def eval_acc(args, model, tokenizer, file_type='test'):
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank%args.gpu_per_node],
                                                           output_device=args.local_rank%args.gpu_per_node)
 
-    def DecodeIds(idxs):
-        codes = ""
-        token_types = []
-        for idx in idxs:
-            to_add = tokenizer.convert_ids_to_tokens(idx)
-            if tokenizer.convert_ids_to_tokens(idx)[0] == '\u0120':
-                if not codes.endswith(" "):
-                    codes += " " + to_add[1:]
-                else:
-                    codes += to_add[1:]
-            elif (
-                idx in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id] or
-                tokenizer.convert_ids_to_tokens(idx).startswith("<NUM_LIT")
-            ):
-                codes += " " + to_add + " "
-            else:
-                codes += to_add
-        return codes.strip(" ")
-    
-
     model.eval()
 
     # 1. First Step. save the hidden_states in memory
-    saved_hidden_states = []  # (hidden_states)
-    saved_target_ids = []
-    saved_meta = {}  # {'proj_id': [file_id: [start_token, end_token]]}
-
-    cached_file = os.path.join(args.output_dir, 'cache_hidden')
-    if os.path.exists(cached_file) and not args.overwrite_cache:
-        logger.info("load project level hidden states.  ")
-        with open(cached_file, 'rb') as handle:
-            load_data = pickle.load(handle)
-            saved_hidden_states = load_data['saved_hidden_states']
-            saved_target_ids = load_data['saved_target_ids']
-            hidden_mask = load_data['hidden_mask']
-    else:
-        logger.info("save project level hidden states.  ")
-        for step, batch in tqdm(enumerate(eval_dataloader)):
-            inputs, inputs_type, proj_meta = batch
-            inputs = inputs.to(args.device)
-            with torch.no_grad():
-                outputs = model(inputs, return_dict=False)
-                hidden_states = outputs[1]
-                shifted_hidden_states = hidden_states[..., :-1, :]  # [batch_size, seq_len-1, hidden_dim]
-                targets = inputs[..., 1:]                           # [batch_size, seq_len-1]
-                target_types = inputs_type[..., 1:]
-                for batch_size in range(inputs.size(0)):
-                    start_token = len(saved_target_ids)
-                    for target, target_type, hidden_state in zip(targets[batch_size], target_types[batch_size], shifted_hidden_states[batch_size]):
-                        if target != tokenizer.pad_token_id:
-                            if args.only_id and target_type != 5:
-                                continue
-
-                            saved_hidden_states.append(hidden_state.data.cpu().tolist())
-                            saved_target_ids.append(target.data.cpu().tolist())
-                    end_token = len(saved_target_ids)
-                    # [start_token, end_token)
-                    proj_id, file_id = proj_meta[batch_size].data.cpu().tolist()
-                    if proj_id not in saved_meta:
-                        saved_meta[proj_id] = []
-                    saved_meta[proj_id].append((file_id, start_token, end_token))
-
-        hidden_mask = prepare_data(saved_meta, len(saved_hidden_states))
-        saved_hidden_states = np.array(saved_hidden_states).astype('float32')
-        saved_target_ids = np.array(saved_target_ids).astype('float32')
-
-        cache_hidden = {'saved_hidden_states': saved_hidden_states,
-                        'saved_target_ids': saved_target_ids,
-                        'hidden_mask': hidden_mask}
-
-        with open(cached_file, 'wb') as handle:
-            pickle.dump(cache_hidden, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    datastore, lm_cache = prepare_datastore(args, model, tokenizer, eval_dataloader)
+    index_cache_class = SharedIndexCache if args.shared_index else ProjectIndexCache
+    index_cache = index_cache_class(datastore, eval_dataset.sample2proj, args.device, index_manager,
+                                index_spec=args.index_spec, index_params=args.index_params,
+                                train_size=args.index_train_size,
+                                projection=open_key_projection(datastore, args.key_projection, args.device,
+                                                               args.projection_sample_size),
+                                rerank_k=args.rerank_k,
+                                max_bytes=int(args.index_cache_gb * 2 ** 30) or None)
+
+    gate = RetrievalGate(args.gate_entropy, args.gate_max_prob,
+                         [int(x) for x in args.gate_skip_types.split(',') if x], args.gate_audit)
+
+    retrieval_cache = None
+    if args.retrieval_cache_size > 0:
+        retrieval_cache = RetrievalCache(args.retrieval_cache_size, args.retrieval_cache_tolerance,
+                                         args.retrieval_cache_bits, args.retrieval_cache_audit,
+                                         margin=args.retrieval_cache_margin)
+
+    pointer_retrieval = PointerRetrieval(args.pointer_min) if args.pointer_retrieval else None
+    type_router = TypeRouter(datastore, args.type_route_coverage) if args.type_partitions else None
+    type_accuracy = TypeAccuracy()
 
     correct = 0.0
     total = 0
@@ -439,93 +396,100 @@ def eval_acc(args, model, tokenizer, file_type='test'):
     total_pred = []
     total_gt = []
 
-    for step, batch in tqdm(enumerate(eval_dataloader)):
-        inputs, input_types, proj_meta = batch
+    def forward(step_batch):
+        step, (inputs, input_types, proj_meta) = step_batch
         inputs = inputs.to(args.device)
-
+        if lm_cache is not None:
+            return step, inputs, input_types, proj_meta, None, None
+        # grad mode is thread local, the stages run in their own threads
         with torch.no_grad():
             outputs = model(inputs, return_dict=False)
-            pred_scores = outputs[0]
-            hidden_states = outputs[1]
             # pred_scores [batch_size, seq_len-1, vocab_size]
-            pred_scores = torch.softmax(pred_scores, dim=-1)
+            pred_scores = torch.softmax(outputs[0], dim=-1)
+        return step, inputs, input_types, proj_meta, pred_scores, outputs[1]
+
+    def search(forwarded):
+        step, inputs, input_types, proj_meta, pred_scores, hidden_states = forwarded
+        if lm_cache is not None:
+            sample_ids = range(step * args.eval_batch_size, step * args.eval_batch_size + inputs.size(0))
+            pred_ids, lm_pred_ids = knn_from_lm_cache(inputs, sample_ids, proj_meta, lm_cache, index_cache,
+                                                      tokenizer)
+            query_mask = torch.zeros_like(inputs, dtype=torch.bool)
+            query_mask[:, :-1] = inputs[:, 1:] != tokenizer.pad_token_id
+            type_accuracy.update(pred_ids, lm_pred_ids, inputs, input_types, query_mask)
+            return inputs.cpu(), pred_ids.cpu()
+        with torch.no_grad():
             batch_size, seq_len, vocab_size = pred_scores.size()
-            knn_scores = torch.zeros(pred_scores.size()).to(hidden_states.device)
+            # the last position and the padding have no target, they are not searched
+            query_mask = torch.zeros_like(inputs, dtype=torch.bool)
+            query_mask[:, :-1] = inputs[:, 1:] != tokenizer.pad_token_id
+            search_mask = gate(pred_scores, input_types, query_mask)
+            searched_mask = gate.searched(query_mask, search_mask)
+            search_start = time.time()
+            if pointer_retrieval is not None:
+                dists, neighbour_targets, log_counts, followed = pointer_retrieval.search_batch(
+                    index_cache, hidden_states, inputs, proj_meta, 1024, query_mask=searched_mask)
+            elif type_router is not None:
+                dists, neighbour_targets, log_counts = search_partitioned(index_cache, type_router, hidden_states,
+                                                                          input_types, proj_meta, 1024,
+                                                                          query_mask=searched_mask)
+            else:
+                dists, neighbour_targets, log_counts = search_batch(index_cache, hidden_states, proj_meta, 1024,
+                                                                    query_mask=searched_mask,
+                                                                    num_threads=args.knn_threads,
+                                                                    retrieval_cache=retrieval_cache,
+                                                                    omp_threads=args.faiss_threads or None)
+            gate.search_time += time.time() - search_start
+            knn_ids, knn_probs = knn_sparse(dists, neighbour_targets, log_counts=log_counts)
             for b in range(batch_size):
-                cur_hidden_state = hidden_states[b]
-                p_knn = knn_faiss(cur_hidden_state, proj_meta[b], saved_hidden_states, saved_target_ids, hidden_mask,
-                                  vocab_size)
-                knn_scores[b] = p_knn
-                # [seq_len, vocab_size]
-            total_scores = 0.25 * knn_scores + 0.75 * pred_scores
-            pred_ids = total_scores.argmax(-1)
-
-        all_pred = []
-        all_gt = []
-        prev_pred = None
-        for pred, gt in zip(pred_ids, inputs):
-            pred = pred.cpu().tolist()
-            gt = gt.cpu().tolist()
-
-            for i, y in enumerate(gt):
-                if i == 0:
-                    if y in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id]:
-                        now_gt = [y]
-                        now_pred = [0] if prev_pred is None else [prev_pred]
-                        all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                        all_gt.append(DecodeIds(now_gt).strip())
-                        now_gt = []
-                        now_pred = []
-                    else:
-                        now_gt = [y]
-                        now_pred = [0] if prev_pred is None else [prev_pred]
-                else:
-                    if tokenizer.convert_ids_to_tokens(y)[0] == '\u0120':
-                        if len(now_gt) > 0:
-                            try:
-                                all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                            except IndexError:
-                                all_pred.append("<SPACE>")
-                            all_gt.append(DecodeIds(now_gt).strip())
-                            now_gt = []
-                            now_pred = []
-                    if y in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id] or tokenizer.convert_ids_to_tokens(y).startswith("<NUM_LIT"):
-                        if len(now_gt) > 0:
-                            try:
-                                all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                            except IndexError:
-                                all_pred.append("<SPACE>")
-                            all_gt.append(DecodeIds(now_gt).strip())
-                        now_gt = [y]
-                        now_pred = [pred[i-1]]
-                        try:
-                            all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                        except IndexError:
-                            all_pred.append("<SPACE>")
-                        all_gt.append(DecodeIds(now_gt).strip())
-                        now_gt = []
-                        now_pred = []
-                        continue
-                    now_gt.append(y)
-                    now_pred.append(pred[i-1])
-        assert len(all_pred) == len(all_gt)
-
+                index_cache.release(proj_meta[b][0].item())
+            pred_ids = interpolate_argmax(pred_scores, knn_ids, knn_probs, lm_coef=0.75, knn_coef=0.25)
+            if pointer_retrieval is not None:
+                pointer_retrieval.update(pred_ids, inputs, searched_mask, followed)
+            lm_pred_ids = pred_scores.argmax(-1)
+            pred_ids, ungated_pred_ids = gate.apply(pred_ids, lm_pred_ids, search_mask)
+            gate.update(pred_ids, inputs, query_mask, search_mask, ungated_pred_ids)
+            type_accuracy.update(pred_ids, lm_pred_ids, inputs, input_types, query_mask)
+        return inputs.cpu(), pred_ids.cpu()
+
+    def detokenize(searched):
+        inputs, pred_ids = searched
+        return decode_batch(tokenizer, pred_ids, inputs)
+
+    # batch i is searched while batch i+1 goes through the model and batch i-1 is detokenized
+    pipeline = Pipeline([('forward', forward), ('search', search), ('detokenize', detokenize)],
+                        depth=args.pipeline_depth)
+    for step, (all_pred, all_gt) in tqdm(enumerate(pipeline.run(enumerate(eval_dataloader))),
+                                         total=len(eval_dataloader)):
         total_pred.extend(all_pred)
         total_gt.extend(all_gt)
 
-        for x, y in zip(all_pred, all_gt):
-            if y not in ["<s>", "</s>", "<EOL>", "<pad>"]:
-                total += 1
-                if x == y:
-                    correct += 1
-        
+        batch_total, batch_correct = count_correct(all_pred, all_gt)
+        total += batch_total
+        correct += batch_correct
+
         if step % args.logging_steps == 0:
             logger.info(f"{step} are done!")
             logger.info(f"{total}, {correct/total}")
 
+    pipeline.log(logger)
+    if retrieval_cache is not None:
+        retrieval_cache.log(logger)
+    if pointer_retrieval is not None:
+        pointer_retrieval.log(logger)
+    if type_router is not None:
+        type_router.log(logger)
+    type_accuracy.log(logger)
+    index_cache.log(logger)
+
     # pickle.dump(total_pred, open(os.path.join(args.output_dir, "preds.pkl"), "wb"))
     # pickle.dump(total_gt, open(os.path.join(args.output_dir, "gts.pkl"), "wb"))
 
+    if gate.enabled:
+        gate.log(logger)
+
+    copy_stats.log(logger)
+
     saved_file = os.path.join(args.output_dir, "predictions.txt")
     total_samples = post_process(args, total_pred, total_gt, read_true_gts(args.data_dir, file_type), saved_file)
     logger.info(f"Eval on {total_samples}, saved at {saved_file}")
@@ -533,6 +497,117 @@ def eval_acc(args, model, tokenizer, file_type='test'):
     return total, correct
 
 
+def prepare_datastore(args, model, tokenizer, eval_dataloader, single_pass=None):
+    """
+    Save the hidden states of eval_dataloader in the on-disk datastore, or open the one saved before.
+    single_pass overrides args.single_pass, args are not modified.
+    """
+    single_pass = args.single_pass if single_pass is None else single_pass
+    datastore_dir = args.datastore_dir or os.path.join(args.output_dir, 'datastore')
+    # single pass: the datastore pass also keeps the queries and LM top-k for the kNN phase, next
+    # to the datastore, and they are only reused with the datastore and eval set they were built with
+    lm_cache_dir = os.path.join(datastore_dir, LM_CACHE_DIR)
+    num_samples = len(eval_dataloader.dataset)
+    lm_cache_valid = not single_pass or datastore_exists(datastore_dir) and \
+        lm_cache_matches(lm_cache_dir, Datastore(datastore_dir), num_samples)
+    if datastore_exists(datastore_dir) and not args.overwrite_cache and lm_cache_valid:
+        logger.info("load project level hidden states.  ")
+    else:
+        if datastore_exists(datastore_dir) and not args.overwrite_cache:
+            logger.warning(f"no lm cache of the datastore at {datastore_dir} and of these {num_samples} eval "
+                           f"samples, the datastore pass is run again")
+        logger.info("save project level hidden states.  ")
+        writer = None
+        lm_cache_writer = None
+        for step, batch in tqdm(enumerate(eval_dataloader)):
+            inputs, inputs_type, proj_meta = batch
+            inputs = inputs.to(args.device)
+            with torch.no_grad():
+                outputs = model(inputs, return_dict=False)
+                hidden_states = outputs[1]
+                shifted_hidden_states = hidden_states[..., :-1, :]  # [batch_size, seq_len-1, hidden_dim]
+                targets = inputs[..., 1:]                           # [batch_size, seq_len-1]
+                target_types = inputs_type[..., 1:].to(args.device)
+                save_mask = targets != tokenizer.pad_token_id
+                if args.only_id:
+                    save_mask &= target_types == 5
+                if writer is None:
+                    writer = DatastoreWriter(datastore_dir, shifted_hidden_states.size(-1), args.datastore_dtype,
+                                             with_types=True)
+                # [start_token, end_token) of every sample is recorded per file
+                # (context, target) token types of every entry, for the type partitions
+                entry_types = torch.stack([inputs_type[..., :-1], inputs_type[..., 1:]], dim=-1)
+                writer.add_batch(shifted_hidden_states, targets, save_mask, proj_meta, types=entry_types)
+                if single_pass:
+                    if lm_cache_writer is None:
+                        # the sq8 codes of the keys are too lossy to stand in for the queries, the
+                        # queries of an sq8 datastore are kept apart in float16
+                        query_dtype = 'float16' if args.datastore_dtype == 'sq8' else args.datastore_dtype
+                        share_keys = not args.only_id and args.datastore_dtype != 'sq8'
+                        lm_cache_writer = LMCacheWriter(lm_cache_dir, shifted_hidden_states.size(-1), args.lm_topk,
+                                                        outputs[0].size(-1), share_keys=share_keys,
+                                                        key_dtype=query_dtype)
+                    lm_cache_writer.add_batch(shifted_hidden_states, outputs[0][..., :-1, :],
+                                              targets != tokenizer.pad_token_id)
+        writer.close()
+        if lm_cache_writer is not None:
+            lm_cache_writer.close(Datastore(datastore_dir))
+
+    datastore = Datastore(datastore_dir)
+    lm_cache = LMCache(lm_cache_dir, datastore) if single_pass else None
+    return datastore, lm_cache
+
+
+def cache_neighbours(args, model, tokenizer, index_manager, file_type='test'):
+    """
+    Search the neighbours of every eval position once and save them, with the LM top-k, in a
+    neighbour cache that knn_sweep.py can evaluate any interpolation setting on.
+    """
+    eval_dataset = EvalDataset(tokenizer, args, logger, file_type=file_type, block_size=args.block_size)
+    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+    eval_dataloader = DataLoader(eval_dataset, sampler=SequentialSampler(eval_dataset), batch_size=args.eval_batch_size)
+    model.to(args.device)
+    model.eval()
+
+    datastore, lm_cache = prepare_datastore(args, model, tokenizer, eval_dataloader, single_pass=True)
+    index_cache_class = SharedIndexCache if args.shared_index else ProjectIndexCache
+    index_cache = index_cache_class(datastore, eval_dataset.sample2proj, args.device, index_manager,
+                                index_spec=args.index_spec, index_params=args.index_params,
+                                train_size=args.index_train_size,
+                                projection=open_key_projection(datastore, args.key_projection, args.device,
+                                                               args.projection_sample_size),
+                                rerank_k=args.rerank_k,
+                                max_bytes=int(args.index_cache_gb * 2 ** 30) or None)
+    starts_table, single_table, counted_table = token_boundary_tables(tokenizer)
+
+    knn_cache_dir = os.path.join(args.output_dir, 'knn_cache')
+    writer = NeighbourCacheWriter(knn_cache_dir, args.knn_k, lm_cache.topk, lm_cache.vocab_size,
+                                  with_counts=datastore.counts is not None)
+    for step, batch in tqdm(enumerate(eval_dataloader)):
+        inputs, input_types, proj_meta = batch
+        for b in range(inputs.size(0)):
+            sample_id = step * args.eval_batch_size + b
+            q_start, q_end = lm_cache.samples[sample_id].tolist()
+            proj_id, file_id = proj_meta[b].tolist()
+            if q_end > q_start:
+                xq = np.asarray(lm_cache.queries[q_start: q_end], dtype='float32')
+                dists, targets, log_counts = search_queries(index_cache, xq, proj_id, file_id, args.knn_k,
+                                                            args.device)
+                dists, targets = dists.cpu().numpy(), targets.cpu().numpy().astype('int32')
+                if log_counts is not None:
+                    log_counts = log_counts.cpu().numpy()
+
+                gts = inputs[b, 1:][inputs[b, 1:] != tokenizer.pad_token_id].numpy()
+                token_starts = starts_table[gts]
+                token_starts[1:] |= single_table[gts[:-1]]
+                token_starts[0] = True
+                writer.add(dists, targets, lm_cache.lm_ids[q_start: q_end], lm_cache.lm_probs[q_start: q_end],
+                           gts, token_starts, counted_table[gts], log_counts)
+            index_cache.release(proj_id)
+    writer.close()
+    logger.info(f"Neighbours of {writer.k} per position cached at {knn_cache_dir}")
+
+
 def read_true_gts(data_dir, file_type):
     true_gts = []
     data = open(os.path.join(data_dir, f"{file_type}.txt")).readlines()
@@ -544,121 +619,35 @@ def read_true_gts(data_dir, file_type):
     return true_gts
 
 
-def prepare_data(saved_meta, data_store_len):
-    file_mask = {}
-    proj_mask = {}
-    i = 0
-    for proj_id in saved_meta.keys():
-        print(i, ' done.')
-        hidden_state_mask = np.zeros(data_store_len).astype('bool')
-        for cur_file in saved_meta[proj_id]:
-            cur_file_id, start_token, end_token = cur_file
-            hidden_state_mask[start_token: end_token] = 1
-        proj_mask[proj_id] = hidden_state_mask
-        i = i + 1
-
-    print('mask file...')
-    i = 0
-    for proj_id in saved_meta.keys():
-        print(i, ' done.')
-        hidden_state_mask = proj_mask[proj_id]
-        for cur_file in tqdm(saved_meta[proj_id]):
-            cur_file_id, start_token, end_token = cur_file
-            file_hidden_state_mask = copy.deepcopy(hidden_state_mask)
-            file_hidden_state_mask[start_token: end_token] = 0
-            file_mask[cur_file_id] = file_hidden_state_mask
-        i = i + 1
-    return file_mask
-
-
-
-
-
-def knn_faiss(hidden_state, cur_meta, saved_hidden_states, saved_target_ids, hidden_mask, vocab_size):
-    proj_id, file_id = cur_meta.data.cpu().tolist()
-
-    p_knn = torch.zeros((hidden_state.size(0), vocab_size)).to(hidden_state.device)
-    hidden_states = saved_hidden_states[hidden_mask[file_id]]
-    target_ids = saved_target_ids[hidden_mask[file_id]]
-
-    if len(hidden_states) == 0:
-        return p_knn
-    
-    hidden_states = np.array(hidden_states).astype('float32')  # [nb, d]
-    nq, d = hidden_state.size()
-    xq = hidden_state.data.cpu().numpy()
-    res = faiss.StandardGpuResources()  # use a single GPU
-
-    index_flat = faiss.IndexFlatL2(d)
-    gpu_index_flat = faiss.index_cpu_to_gpu(res, 1, index_flat)
-    gpu_index_flat.add(hidden_states)
-    
-    k = min(1024, hidden_states.shape[0])
-    l2_dis, neighbour_indexes = gpu_index_flat.search(xq, k)
-
-    l2_dis = torch.from_numpy(l2_dis).to(hidden_state.device)  # [seq_len, k]
-    neighbour_indexes = torch.from_numpy(neighbour_indexes).to(hidden_state.device)
-    logits = torch.softmax(-1 * l2_dis.sqrt(), dim=-1)
-
-    size = neighbour_indexes.size()
-    target_ids = torch.Tensor(target_ids).long().to(hidden_state.device)
-    neighbour_targets = torch.gather(target_ids, dim=0, index=neighbour_indexes.contiguous().view(-1))
-    neighbour_targets = neighbour_targets.view(size)
-
-    p_knn = torch.scatter_add(p_knn, 1, neighbour_targets, logits)
-    #logger.info("--[4/4] end collect target index...")
-    #del hidden_states
-    #del res
-    #gc.collect()
-    return p_knn
-
-
-
-
-def knn(hidden_state, cur_meta, saved_hidden_states, saved_target_ids, saved_meta, vocab_size):
-    """ 该方法目前不使用batch_size """
-    # Step 1. 根据cur_meta找到项目下其他文件
-    proj_id, file_id = cur_meta.data.cpu().tolist()
-    hidden_states = []
-    target_ids = []
-    p_knn = torch.zeros((hidden_state.size(0), vocab_size)).to(hidden_state.device)
-
-    for cur_file in saved_meta[proj_id]:
-        cur_file_id, start_token, end_token = cur_file
-        if cur_file_id != file_id:
-            hidden_states.extend(saved_hidden_states[start_token: end_token])
-            target_ids.extend(saved_target_ids[start_token: end_token])
-    if len(hidden_states) != 0:
-        # 放到gpu上计算
-        l2_dis = []
-        i = 0
-        while i < len(hidden_states):
-            sub_hidden_states = hidden_states[i:i+256]
-            i = i+256
-            # [1024, hidden_dim]
-            sub_hidden_states = torch.Tensor(sub_hidden_states).to(hidden_state.device)
-            # [seq_len, num_words, hidden_dim]
-            sub_dis = (hidden_state.unsqueeze(1) - sub_hidden_states).pow(2).sum(2).sqrt()  # [num_words]
-            del sub_hidden_states
-            l2_dis.append(sub_dis.cpu())
-
-        # 放到CPU上计算
-        l2_dis = torch.cat(l2_dis, dim=1)  # [seq_len, total_num_words]
-        target_ids = torch.Tensor(target_ids).long().to(hidden_state.device)
-        neighbour_dis, neighbours_ids = torch.sort(l2_dis, dim=1)
-
-        # 放到GPU上计算
-        k = 1024
-        neighbours_ids = neighbours_ids[:, :k].to(hidden_state.device)
-        neighbour_dis = neighbour_dis[:, :k].to(hidden_state.device)
-
-        size = neighbours_ids.size()
-        neighbour_targets = torch.gather(target_ids, dim=0, index=neighbours_ids.contiguous().view(-1))
-        neighbour_targets = neighbour_targets.view(size)
-
-        neighbour_logit = torch.softmax(-1 * neighbour_dis, dim=-1)
-        p_knn = torch.scatter_add(p_knn, 1, neighbour_targets, neighbour_logit)
-    return p_knn
+def knn_from_lm_cache(inputs, sample_ids, proj_meta, lm_cache, index_cache, tokenizer):
+    """
+    kNN-LM predictions rebuilt from the queries and LM top-k of the datastore pass, and the LM top-1
+    predictions. They approximate those of the model forward path: the LM probabilities outside of
+    the stored top-k are taken as 0, and the queries are the hidden states in the key dtype of the
+    datastore (float16 for float16 and sq8 datastores), so the kNN distances differ slightly.
+    """
+    pred_ids = torch.zeros_like(inputs)
+    lm_pred_ids = torch.zeros_like(inputs)
+    query_mask = inputs[..., 1:] != tokenizer.pad_token_id
+    with torch.no_grad():
+        for b, sample_id in enumerate(sample_ids):
+            q_start, q_end = lm_cache.samples[sample_id].tolist()
+            proj_id, file_id = proj_meta[b].tolist()
+            if q_end > q_start:
+                queries = np.asarray(lm_cache.queries[q_start: q_end], dtype='float32')
+                lm_ids = torch.from_numpy(lm_cache.lm_ids[q_start: q_end].astype('int64')).to(inputs.device)
+                lm_probs = torch.from_numpy(lm_cache.lm_probs[q_start: q_end].astype('float32')).to(inputs.device)
+
+                dists, neighbour_targets, log_counts = search_queries(index_cache, queries, proj_id, file_id, 1024,
+                                                                      inputs.device)
+                knn_ids, knn_probs = knn_sparse(dists, neighbour_targets, log_counts=log_counts)
+                # both distributions are sparse, probabilities outside of the LM top-k are taken as 0
+                pred_ids[b, :-1][query_mask[b]] = sparse_sum_argmax(torch.cat([knn_ids, lm_ids], dim=-1),
+                                                                    torch.cat([0.25 * knn_probs, 0.75 * lm_probs], dim=-1))
+                # the cached LM top-k is sorted by probability
+                lm_pred_ids[b, :-1][query_mask[b]] = lm_ids[:, 0]
+            index_cache.release(proj_id)
+    return pred_ids, lm_pred_ids
 
 
 def post_process(args, preds, gts, true_gts, saved_file):
@@ -787,6 +776,84 @@ def main():
     parser.add_argument('--tensorboard_dir', type=str)
 
     parser.add_argument('--only_id', action='store_true')
+    parser.add_argument('--datastore_dir', type=str, default=None,
+                        help="Datastore directory, <output_dir>/datastore by default, e.g. the output of compact_datastore.py")
+    parser.add_argument('--datastore_dtype', default='float32', choices=['float32', 'float16', 'sq8'],
+                        help="dtype of the keys in the on-disk datastore, sq8 stores per-dimension 8-bit codes")
+    parser.add_argument('--single_pass', action='store_true',
+                        help="Keep the queries and LM top-k of the datastore pass and run the kNN phase without a model "
+                             "forward. Approximate: LM probabilities outside the top-k count as 0 and the "
+                             "queries are stored in the datastore dtype (float16 for sq8)")
+    parser.add_argument('--lm_topk', type=int, default=32,
+                        help="Number of LM probabilities kept per position for --single_pass")
+    parser.add_argument('--do_knn_cache', action='store_true',
+                        help="Cache the neighbours of every eval position for knn_sweep.py")
+    parser.add_argument('--knn_k', type=int, default=1024,
+                        help="Number of neighbours kept per position by --do_knn_cache")
+    parser.add_argument('--faiss_device', type=int, default=-1,
+                        help="gpu the faiss indexes are searched on, -1 for the cpu")
+    parser.add_argument('--faiss_threads', type=int, default=0,
+                        help="Number of OpenMP threads of cpu faiss searches, 0 keeps the faiss default. With "
+                             "--knn_threads > 1 it is the count of every searching thread, and 0 divides the "
+                             "faiss default among them")
+    parser.add_argument('--index_spec', type=str, default='Flat',
+                        help="faiss index_factory spec of the project indexes, e.g. Flat, IVF1024,Flat, IVF1024,PQ64 or HNSW32, "
+                             "or TorchFlat for exact search without faiss")
+    parser.add_argument('--index_params', type=str, default='',
+                        help="Runtime search parameters of the index spec, e.g. nprobe=16 or efSearch=128")
+    parser.add_argument('--index_train_size', type=int, default=65536,
+                        help="Maximum number of keys a project index is trained on")
+    parser.add_argument('--knn_threads', type=int, default=4,
+                        help="Number of projects of a batch searched in parallel, each on its share of the "
+                             "faiss threads (see --faiss_threads)")
+    parser.add_argument('--shared_index', action='store_true',
+                        help="Search one index over all projects, restricted to the project and without the "
+                             "current file by faiss ID selectors, instead of one index per project (cpu only)")
+    parser.add_argument('--index_cache_gb', type=float, default=0,
+                        help="Memory budget of the cached indexes, the least recently used ones are evicted "
+                             "beyond it, 0 for no limit")
+    parser.add_argument('--pipeline_depth', type=int, default=1,
+                        help="Batches queued between the forward, search and detokenize stages of the eval, "
+                             "0 runs them one after another")
+    parser.add_argument('--retrieval_cache_size', type=int, default=0,
+                        help="Neighbour lists kept by the LRU retrieval cache, 0 disables it")
+    parser.add_argument('--retrieval_cache_tolerance', type=float, default=0.05,
+                        help="l2 distance to a cached query, relative to the query norm, up to which its "
+                             "neighbour list is reused")
+    parser.add_argument('--retrieval_cache_bits', type=int, default=32,
+                        help="Bits of the locality sensitive hash the retrieval cache is keyed on")
+    parser.add_argument('--retrieval_cache_audit', type=float, default=0.01,
+                        help="Fraction of the retrieval cache hits searched anyway to measure their agreement")
+    parser.add_argument('--retrieval_cache_margin', type=int, default=32,
+                        help="Neighbours cached beyond k, which stand in for those of the file of a query "
+                             "reading a list cached by another file of the project")
+    parser.add_argument('--pointer_retrieval', action='store_true',
+                        help="Follow the neighbours of the previous position (RetoMaton) and only search when "
+                             "fewer than --pointer_min of them survive, the retrieval cache is not used then")
+    parser.add_argument('--pointer_min', type=int, default=16,
+                        help="Surviving pointers below which pointer retrieval searches the index")
+    parser.add_argument('--type_partitions', action='store_true',
+                        help="Search one sub-index per target token type, only the ones routed to from the "
+                             "type of the current token")
+    parser.add_argument('--type_route_coverage', type=float, default=0.95,
+                        help="A context type is routed to the most frequent target types after it in the "
+                             "datastore until they cover this fraction of its entries")
+    parser.add_argument('--gate_entropy', type=float, default=None,
+                        help="Skip the kNN search of positions whose LM entropy is below this")
+    parser.add_argument('--gate_max_prob', type=float, default=None,
+                        help="Skip the kNN search of positions whose LM max probability is above this")
+    parser.add_argument('--gate_skip_types', type=str, default='',
+                        help="Comma separated token types of the current token whose next token is not searched, "
+                             "e.g. 3,6 for punctuation and keywords")
+    parser.add_argument('--gate_audit', action='store_true',
+                        help="Search the positions the gate skips anyway, to report the gated and the ungated "
+                             "accuracy on the same positions")
+    parser.add_argument('--key_projection', type=str, default='',
+                        help="faiss VectorTransform spec the keys are reduced with before indexing, e.g. PCA128 or OPQ16_128")
+    parser.add_argument('--projection_sample_size', type=int, default=65536,
+                        help="Number of keys the key projection is fitted on")
+    parser.add_argument('--rerank_k', type=int, default=0,
+                        help="Re-rank this many candidates of a projected index with the full keys, 0 to disable")
     parser.add_argument('--no_hype', action='store_true')
     
     pool = None
@@ -798,6 +865,16 @@ def main():
         raise ValueError("BERT and RoBERTa do not have LM heads but masked LM heads. They must be run using the --mlm "
                          "flag (masked language modeling).")
 
+    # the single pass eval rebuilds the predictions from the cached queries and LM top-k, it has no
+    # LM distribution to gate on and searches every query of a sequence at once
+    single_pass_conflicts = [flag for flag, used in (
+        ('--gate_entropy', args.gate_entropy is not None), ('--gate_max_prob', args.gate_max_prob is not None),
+        ('--gate_skip_types', bool(args.gate_skip_types)), ('--gate_audit', args.gate_audit),
+        ('--retrieval_cache_size', args.retrieval_cache_size > 0),
+        ('--pointer_retrieval', args.pointer_retrieval), ('--type_partitions', args.type_partitions)) if used]
+    if args.single_pass and single_pass_conflicts:
+        raise ValueError(f"--single_pass does not support {', '.join(single_pass_conflicts)}")
+
     if os.path.exists(args.output_dir) and os.listdir(
             args.output_dir) and args.do_train and not args.overwrite_output_dir:
         raise ValueError(
@@ -905,11 +982,17 @@ def main():
         global_step, tr_loss = train(args, train_dataset, model, tokenizer, fh, pool)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
+    # one set of faiss resources for the whole run
+    index_manager = IndexManager(args.faiss_device, args.faiss_threads) if args.do_eval or args.do_knn_cache else None
+
+    if args.do_knn_cache:
+        cache_neighbours(args, model, tokenizer, index_manager, 'test')
+
     # Only works on single GPU
     if args.do_eval:
-        # dev_total, dev_cr = eval_acc(args, model, tokenizer, 'dev')
+        # dev_total, dev_cr = eval_acc(args, model, tokenizer, index_manager, 'dev')
         # logger.info(f"Dev total tokens: {dev_total}, accuracy: {dev_cr/dev_total}")
-        test_total, test_cr = eval_acc(args, model, tokenizer, 'test')
+        test_total, test_cr = eval_acc(args, model, tokenizer, index_manager, 'test')
         logger.info(f"Test total tokens: {test_total}, accuracy: {test_cr/test_total}")
 
 
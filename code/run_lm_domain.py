@@ -20,7 +20,6 @@ Code completion (both token level and line level) pipeline in CodeXGLUE
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import copy
 import glob
 import logging
 import os
@@ -32,14 +31,20 @@ import json
 import faiss
 
 import gc
+import hashlib
+import time
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler, TensorDataset
+from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler, Subset, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 from modeling_gpt import GPT2LMHeadModel
 from dataset import TextDataset, finetuneDataset, EvalDataset, lineDataset
+from datastore import Datastore, DatastoreWriter, ShardedDatastoreWriter, datastore_exists, load_progress, shard_dirs
+from eval_pipeline import Pipeline, count_correct, decode_batch
+from knn import GlobalIndexCache, IndexManager, PointerRetrieval, RetrievalCache, RetrievalGate, TypeAccuracy, TypeRouter, copy_stats, interpolate_argmax, knn_sparse, open_key_projection, search_batch, search_partitioned
+from knn_shards import ShardedIndexCache
 from beam import Beam
 
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
@@ -65,6 +70,23 @@ MODEL_CLASSES = {
 }
 
 
+def datastore_build_settings(args, model, train_dataset):
+    """ What a resumed datastore build has to share with the build it resumes, as recorded in its progress. """
+    digest = hashlib.sha1()
+    for inputs, input_types in zip(train_dataset.inputs, train_dataset.input_types):
+        digest.update(np.asarray(inputs, dtype='int64').tobytes())
+        digest.update(np.asarray(input_types, dtype='int64').tobytes())
+    return {
+        'only_id': args.only_id,
+        'block_size': args.block_size,
+        'num_shards': args.num_shards,
+        'datastore_dtype': args.datastore_dtype,
+        'dim': getattr(model, 'module', model).config.hidden_size,
+        'train_samples': len(train_dataset),
+        'train_digest': digest.hexdigest(),
+    }
+
+
 def load_and_cache_examples(args, tokenizer, evaluate=False):
     if args.not_pretrain:
         dataset = finetuneDataset(tokenizer, args, logger, file_type='dev' if evaluate else 'train',
@@ -322,7 +344,7 @@ def evaluate(args, model, tokenizer, prefix="", eval_when_training=False):
     return result
 
 
-def eval_acc(args, model, tokenizer, file_type='test'):
+def eval_acc(args, model, tokenizer, index_manager, file_type='test'):
     """
     Evaluate token level code completion on accuracy.
 
@@ -366,71 +388,95 @@ def eval_acc(args, model, tokenizer, file_type='test'):
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank % args.gpu_per_node],
                                                           output_device=args.local_rank % args.gpu_per_node)
 
-    def DecodeIds(idxs):
-        codes = ""
-        token_types = []
-        for idx in idxs:
-            to_add = tokenizer.convert_ids_to_tokens(idx)
-            if tokenizer.convert_ids_to_tokens(idx)[0] == '\u0120':
-                if not codes.endswith(" "):
-                    codes += " " + to_add[1:]
-                else:
-                    codes += to_add[1:]
-            elif (
-                    idx in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id,
-                            tokenizer.pad_token_id] or
-                    tokenizer.convert_ids_to_tokens(idx).startswith("<NUM_LIT")
-            ):
-                codes += " " + to_add + " "
-            else:
-                codes += to_add
-        return codes.strip(" ")
-
     model.eval()
 
     # 1. First Step. save the hidden_states in memory
-    saved_hidden_states = []  # (hidden_states)
-    saved_target_ids = []
-
-    cached_file = os.path.join(args.output_dir, 'cache_hidden')
-    if os.path.exists(cached_file) and not args.overwrite_cache:
+    datastore_dir = args.datastore_dir or os.path.join(args.output_dir, 'datastore')
+    if datastore_exists(datastore_dir) and not args.overwrite_cache:
         logger.info("load project level hidden states.  ")
-        with open(cached_file, 'rb') as handle:
-            load_data = pickle.load(handle)
-            saved_hidden_states = load_data['saved_hidden_states']
-            saved_target_ids = load_data['saved_target_ids']
     else:
         logger.info("save project level hidden states.  ")
-        for step, batch in tqdm(enumerate(train_dataloader)):
-            inputs, inputs_type = batch
+        # entries are streamed to disk, a checkpoint every datastore_checkpoint_steps batches lets a
+        # killed build resume after the samples it made durable
+        settings = datastore_build_settings(args, model, train_dataset)
+        progress = load_progress(datastore_dir) if args.resume_datastore else None
+        if progress is not None:
+            mismatched = [key for key in settings if (progress.get('settings') or {}).get(key) != settings[key]]
+            assert not mismatched, f"the datastore build at {datastore_dir} was started with another " \
+                                   f"{', '.join(mismatched)}, rebuild it without --resume_datastore"
+        samples_done = 0 if progress is None else progress['samples_done']
+        if samples_done > 0:
+            assert args.local_rank == -1, "a datastore build can only be resumed on one process"
+            logger.info(f"resuming the datastore build after {samples_done} of {len(train_dataset)} samples")
+            train_dataloader = DataLoader(Subset(train_dataset, range(samples_done, len(train_dataset))),
+                                          batch_size=args.eval_batch_size)
+
+        def open_writer(dim):
+            if args.num_shards > 1:
+                return ShardedDatastoreWriter(datastore_dir, dim, args.num_shards, args.datastore_dtype,
+                                              with_types=True, progress=progress)
+            return DatastoreWriter(datastore_dir, dim, args.datastore_dtype, with_types=True, progress=progress)
+
+        writer = None
+        for step, batch in tqdm(enumerate(train_dataloader), total=len(train_dataloader)):
+            inputs, inputs_type, _ = batch
             inputs = inputs.to(args.device)
             with torch.no_grad():
                 outputs = model(inputs, return_dict=False)
                 hidden_states = outputs[1]
                 shifted_hidden_states = hidden_states[..., :-1, :]  # [batch_size, seq_len-1, hidden_dim]
                 targets = inputs[..., 1:]  # [batch_size, seq_len-1]
-                target_types = inputs_type[..., 1:]
-                for batch_size in range(inputs.size(0)):
-                    for target, target_type, hidden_state in zip(targets[batch_size], target_types[batch_size],
-                                                                 shifted_hidden_states[batch_size]):
-                        if target != tokenizer.pad_token_id:
-                            if args.only_id and target_type != 5:
-                                continue
-                            saved_hidden_states.append(hidden_state.data.cpu().tolist())
-                            saved_target_ids.append(target.data.cpu().tolist())
-
-        saved_hidden_states = np.array(saved_hidden_states).astype('float32')
-        saved_target_ids = np.array(saved_target_ids).astype('float32')
-
-        cache_hidden = {'saved_hidden_states': saved_hidden_states,
-                        'saved_target_ids': saved_target_ids}
-
-        with open(cached_file, 'wb') as handle:
-            pickle.dump(cache_hidden, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-
-    # build faiss
-
+                target_types = inputs_type[..., 1:].to(args.device)
+                save_mask = targets != tokenizer.pad_token_id
+                if args.only_id:
+                    save_mask &= target_types == 5
+                if writer is None:
+                    writer = open_writer(shifted_hidden_states.size(-1))
+                # (context, target) token types of every entry, for the type partitions
+                entry_types = torch.stack([inputs_type[..., :-1], inputs_type[..., 1:]], dim=-1)
+                writer.add_batch(shifted_hidden_states, targets, save_mask, types=entry_types)
+            samples_done += len(inputs)
+            if args.datastore_checkpoint_steps > 0 and (step + 1) % args.datastore_checkpoint_steps == 0:
+                writer.checkpoint(samples_done, settings)
+        if writer is None:
+            # no batch was left: an empty train set, or a build killed after its last checkpoint
+            # covered all samples, whose manifest is missing
+            writer = open_writer(settings['dim'])
+        writer.close()
+
+    # the datastore is built from the train set, so no eval file is in it and nothing is left out
+    shards = shard_dirs(datastore_dir)
+    if shards is not None:
+        # every shard is searched by a worker process, the coordinator merges their top-k
+        index_cache = ShardedIndexCache(shards, projection_spec=args.key_projection,
+                                        projection_sample_size=args.projection_sample_size,
+                                        num_threads=args.shard_threads, index_spec=args.index_spec,
+                                        index_params=args.index_params, train_size=args.index_train_size,
+                                        rerank_k=args.rerank_k)
+    else:
+        datastore = Datastore(datastore_dir)
+        index_cache = GlobalIndexCache(datastore, args.device, index_manager, index_spec=args.index_spec,
+                                       index_params=args.index_params, train_size=args.index_train_size,
+                                       projection=open_key_projection(datastore, args.key_projection, args.device,
+                                                                      args.projection_sample_size),
+                                       rerank_k=args.rerank_k,
+                                       max_bytes=int(args.index_cache_gb * 2 ** 30) or None)
+
+    gate = RetrievalGate(args.gate_entropy, args.gate_max_prob,
+                         [int(x) for x in args.gate_skip_types.split(',') if x], args.gate_audit)
+
+    retrieval_cache = None
+    if args.retrieval_cache_size > 0:
+        retrieval_cache = RetrievalCache(args.retrieval_cache_size, args.retrieval_cache_tolerance,
+                                         args.retrieval_cache_bits, args.retrieval_cache_audit,
+                                         margin=args.retrieval_cache_margin)
+
+    # the shard workers return no datastore positions to follow
+    assert shards is None or not args.pointer_retrieval, "--pointer_retrieval needs an unsharded datastore"
+    pointer_retrieval = PointerRetrieval(args.pointer_min) if args.pointer_retrieval else None
+    assert shards is None or not args.type_partitions, "--type_partitions needs an unsharded datastore"
+    type_router = TypeRouter(datastore, args.type_route_coverage) if args.type_partitions else None
+    type_accuracy = TypeAccuracy()
 
     correct = 0.0
     total = 0
@@ -438,95 +484,89 @@ def eval_acc(args, model, tokenizer, file_type='test'):
     total_pred = []
     total_gt = []
 
-    for step, batch in tqdm(enumerate(eval_dataloader)):
-        inputs, input_types = batch
+    def forward(step_batch):
+        step, (inputs, input_types, _) = step_batch
         inputs = inputs.to(args.device)
-
+        # grad mode is thread local, the stages run in their own threads
         with torch.no_grad():
             outputs = model(inputs, return_dict=False)
-            pred_scores = outputs[0]
-            hidden_states = outputs[1]
             # pred_scores [batch_size, seq_len-1, vocab_size]
-            pred_scores = torch.softmax(pred_scores, dim=-1)
-            batch_size, seq_len, vocab_size = pred_scores.size()
-            knn_scores = torch.zeros(pred_scores.size()).to(hidden_states.device)
-            for b in range(batch_size):
-                cur_hidden_state = hidden_states[b]
-                p_knn = knn_faiss(cur_hidden_state, proj_meta[b], saved_hidden_states, saved_target_ids, hidden_mask,
-                                  vocab_size)
-                knn_scores[b] = p_knn
-                # [seq_len, vocab_size]
-            total_scores = 0.25 * knn_scores + 0.75 * pred_scores
-            pred_ids = total_scores.argmax(-1)
-
-        all_pred = []
-        all_gt = []
-        prev_pred = None
-        for pred, gt in zip(pred_ids, inputs):
-            pred = pred.cpu().tolist()
-            gt = gt.cpu().tolist()
-
-            for i, y in enumerate(gt):
-                if i == 0:
-                    if y in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id,
-                             tokenizer.pad_token_id]:
-                        now_gt = [y]
-                        now_pred = [0] if prev_pred is None else [prev_pred]
-                        all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                        all_gt.append(DecodeIds(now_gt).strip())
-                        now_gt = []
-                        now_pred = []
-                    else:
-                        now_gt = [y]
-                        now_pred = [0] if prev_pred is None else [prev_pred]
-                else:
-                    if tokenizer.convert_ids_to_tokens(y)[0] == '\u0120':
-                        if len(now_gt) > 0:
-                            try:
-                                all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                            except IndexError:
-                                all_pred.append("<SPACE>")
-                            all_gt.append(DecodeIds(now_gt).strip())
-                            now_gt = []
-                            now_pred = []
-                    if y in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.sep_token_id,
-                             tokenizer.pad_token_id] or tokenizer.convert_ids_to_tokens(y).startswith("<NUM_LIT"):
-                        if len(now_gt) > 0:
-                            try:
-                                all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                            except IndexError:
-                                all_pred.append("<SPACE>")
-                            all_gt.append(DecodeIds(now_gt).strip())
-                        now_gt = [y]
-                        now_pred = [pred[i - 1]]
-                        try:
-                            all_pred.append(DecodeIds(now_pred).strip().split()[0])
-                        except IndexError:
-                            all_pred.append("<SPACE>")
-                        all_gt.append(DecodeIds(now_gt).strip())
-                        now_gt = []
-                        now_pred = []
-                        continue
-                    now_gt.append(y)
-                    now_pred.append(pred[i - 1])
-        assert len(all_pred) == len(all_gt)
+            pred_scores = torch.softmax(outputs[0], dim=-1)
+        return inputs, input_types, pred_scores, outputs[1]
 
+    def search(forwarded):
+        inputs, input_types, pred_scores, hidden_states = forwarded
+        with torch.no_grad():
+            batch_size, seq_len, vocab_size = pred_scores.size()
+            # the last position and the padding have no target, they are not searched
+            query_mask = torch.zeros_like(inputs, dtype=torch.bool)
+            query_mask[:, :-1] = inputs[:, 1:] != tokenizer.pad_token_id
+            proj_meta = torch.zeros((batch_size, 2), dtype=torch.long)
+            search_mask = gate(pred_scores, input_types, query_mask)
+            searched_mask = gate.searched(query_mask, search_mask)
+            search_start = time.time()
+            if pointer_retrieval is not None:
+                dists, neighbour_targets, log_counts, followed = pointer_retrieval.search_batch(
+                    index_cache, hidden_states, inputs, proj_meta, 1024, query_mask=searched_mask)
+            elif type_router is not None:
+                dists, neighbour_targets, log_counts = search_partitioned(index_cache, type_router, hidden_states,
+                                                                          input_types, proj_meta, 1024,
+                                                                          query_mask=searched_mask)
+            else:
+                dists, neighbour_targets, log_counts = search_batch(index_cache, hidden_states, proj_meta, 1024,
+                                                                    query_mask=searched_mask,
+                                                                    retrieval_cache=retrieval_cache)
+            gate.search_time += time.time() - search_start
+            knn_ids, knn_probs = knn_sparse(dists, neighbour_targets, log_counts=log_counts)
+            pred_ids = interpolate_argmax(pred_scores, knn_ids, knn_probs, lm_coef=0.75, knn_coef=0.25)
+            if pointer_retrieval is not None:
+                pointer_retrieval.update(pred_ids, inputs, searched_mask, followed)
+            lm_pred_ids = pred_scores.argmax(-1)
+            pred_ids, ungated_pred_ids = gate.apply(pred_ids, lm_pred_ids, search_mask)
+            gate.update(pred_ids, inputs, query_mask, search_mask, ungated_pred_ids)
+            type_accuracy.update(pred_ids, lm_pred_ids, inputs, input_types, query_mask)
+        return inputs.cpu(), pred_ids.cpu()
+
+    def detokenize(searched):
+        inputs, pred_ids = searched
+        return decode_batch(tokenizer, pred_ids, inputs)
+
+    # batch i is searched while batch i+1 goes through the model and batch i-1 is detokenized
+    pipeline = Pipeline([('forward', forward), ('search', search), ('detokenize', detokenize)],
+                        depth=args.pipeline_depth)
+    for step, (all_pred, all_gt) in tqdm(enumerate(pipeline.run(enumerate(eval_dataloader))),
+                                         total=len(eval_dataloader)):
         total_pred.extend(all_pred)
         total_gt.extend(all_gt)
 
-        for x, y in zip(all_pred, all_gt):
-            if y not in ["<s>", "</s>", "<EOL>", "<pad>"]:
-                total += 1
-                if x == y:
-                    correct += 1
+        batch_total, batch_correct = count_correct(all_pred, all_gt)
+        total += batch_total
+        correct += batch_correct
 
         if step % args.logging_steps == 0:
             logger.info(f"{step} are done!")
             logger.info(f"{total}, {correct / total}")
 
+    pipeline.log(logger)
+    if retrieval_cache is not None:
+        retrieval_cache.log(logger)
+    if pointer_retrieval is not None:
+        pointer_retrieval.log(logger)
+    if type_router is not None:
+        type_router.log(logger)
+    type_accuracy.log(logger)
+    if gate.enabled:
+        gate.log(logger)
+    if shards is None:
+        index_cache.log(logger)
+
     # pickle.dump(total_pred, open(os.path.join(args.output_dir, "preds.pkl"), "wb"))
     # pickle.dump(total_gt, open(os.path.join(args.output_dir, "gts.pkl"), "wb"))
 
+    if shards is not None:
+        index_cache.close()
+    copy_stats.log(logger)
+
     saved_file = os.path.join(args.output_dir, "predictions.txt")
     total_samples = post_process(args, total_pred, total_gt, read_true_gts(args.data_dir, file_type), saved_file)
     logger.info(f"Eval on {total_samples}, saved at {saved_file}")
@@ -545,128 +585,6 @@ def read_true_gts(data_dir, file_type):
     return true_gts
 
 
-def prepare_data(saved_meta, data_store_len):
-    file_mask = {}
-    proj_mask = {}
-    i = 0
-    for proj_id in saved_meta.keys():
-        print(i, ' done.')
-        hidden_state_mask = np.zeros(data_store_len).astype('bool')
-        for cur_file in saved_meta[proj_id]:
-            cur_file_id, start_token, end_token = cur_file
-            hidden_state_mask[start_token: end_token] = 1
-        proj_mask[proj_id] = hidden_state_mask
-        i = i + 1
-
-    print('mask file...')
-    i = 0
-    for proj_id in saved_meta.keys():
-        print(i, ' done.')
-        hidden_state_mask = proj_mask[proj_id]
-        for cur_file in tqdm(saved_meta[proj_id]):
-            cur_file_id, start_token, end_token = cur_file
-            file_hidden_state_mask = copy.deepcopy(hidden_state_mask)
-            file_hidden_state_mask[start_token: end_token] = 0
-            file_mask[cur_file_id] = file_hidden_state_mask
-        i = i + 1
-    return file_mask
-
-
-def build_faiss(hidden_states):
-    hidden_states = np.array(hidden_states).astype('float32')  # [nb, d]
-    d = hidden_states.shape[-1]
-    res = faiss.StandardGpuResources()  # use a single GPU
-
-    index_flat = faiss.IndexFlatL2(d)
-    gpu_index_flat = faiss.index_cpu_to_gpu(res, 1, index_flat)
-    gpu_index_flat.add(hidden_states)
-
-
-def knn_faiss(hidden_state, cur_meta, saved_hidden_states, saved_target_ids, hidden_mask, vocab_size):
-    proj_id, file_id = cur_meta.data.cpu().tolist()
-
-    p_knn = torch.zeros((hidden_state.size(0), vocab_size)).to(hidden_state.device)
-    hidden_states = saved_hidden_states[hidden_mask[file_id]]
-    target_ids = saved_target_ids[hidden_mask[file_id]]
-
-    if len(hidden_states) == 0:
-        return p_knn
-
-    hidden_states = np.array(hidden_states).astype('float32')  # [nb, d]
-    nq, d = hidden_state.size()
-    xq = hidden_state.data.cpu().numpy()
-    res = faiss.StandardGpuResources()  # use a single GPU
-
-    index_flat = faiss.IndexFlatL2(d)
-    gpu_index_flat = faiss.index_cpu_to_gpu(res, 1, index_flat)
-    gpu_index_flat.add(hidden_states)
-
-    k = min(1024, hidden_states.shape[0])
-    l2_dis, neighbour_indexes = gpu_index_flat.search(xq, k)
-
-    l2_dis = torch.from_numpy(l2_dis).to(hidden_state.device)  # [seq_len, k]
-    neighbour_indexes = torch.from_numpy(neighbour_indexes).to(hidden_state.device)
-    logits = torch.softmax(-1 * l2_dis.sqrt(), dim=-1)
-
-    size = neighbour_indexes.size()
-    target_ids = torch.Tensor(target_ids).long().to(hidden_state.device)
-    neighbour_targets = torch.gather(target_ids, dim=0, index=neighbour_indexes.contiguous().view(-1))
-    neighbour_targets = neighbour_targets.view(size)
-
-    p_knn = torch.scatter_add(p_knn, 1, neighbour_targets, logits)
-    # logger.info("--[4/4] end collect target index...")
-    # del hidden_states
-    # del res
-    # gc.collect()
-    return p_knn
-
-
-def knn(hidden_state, cur_meta, saved_hidden_states, saved_target_ids, saved_meta, vocab_size):
-    """ 该方法目前不使用batch_size """
-    # Step 1. 根据cur_meta找到项目下其他文件
-    proj_id, file_id = cur_meta.data.cpu().tolist()
-    hidden_states = []
-    target_ids = []
-    p_knn = torch.zeros((hidden_state.size(0), vocab_size)).to(hidden_state.device)
-
-    for cur_file in saved_meta[proj_id]:
-        cur_file_id, start_token, end_token = cur_file
-        if cur_file_id != file_id:
-            hidden_states.extend(saved_hidden_states[start_token: end_token])
-            target_ids.extend(saved_target_ids[start_token: end_token])
-    if len(hidden_states) != 0:
-        # 放到gpu上计算
-        l2_dis = []
-        i = 0
-        while i < len(hidden_states):
-            sub_hidden_states = hidden_states[i:i + 256]
-            i = i + 256
-            # [1024, hidden_dim]
-            sub_hidden_states = torch.Tensor(sub_hidden_states).to(hidden_state.device)
-            # [seq_len, num_words, hidden_dim]
-            sub_dis = (hidden_state.unsqueeze(1) - sub_hidden_states).pow(2).sum(2).sqrt()  # [num_words]
-            del sub_hidden_states
-            l2_dis.append(sub_dis.cpu())
-
-        # 放到CPU上计算
-        l2_dis = torch.cat(l2_dis, dim=1)  # [seq_len, total_num_words]
-        target_ids = torch.Tensor(target_ids).long().to(hidden_state.device)
-        neighbour_dis, neighbours_ids = torch.sort(l2_dis, dim=1)
-
-        # 放到GPU上计算
-        k = 1024
-        neighbours_ids = neighbours_ids[:, :k].to(hidden_state.device)
-        neighbour_dis = neighbour_dis[:, :k].to(hidden_state.device)
-
-        size = neighbours_ids.size()
-        neighbour_targets = torch.gather(target_ids, dim=0, index=neighbours_ids.contiguous().view(-1))
-        neighbour_targets = neighbour_targets.view(size)
-
-        neighbour_logit = torch.softmax(-1 * neighbour_dis, dim=-1)
-        p_knn = torch.scatter_add(p_knn, 1, neighbour_targets, neighbour_logit)
-    return p_knn
-
-
 def post_process(args, preds, gts, true_gts, saved_file):
     wf = open(saved_file, "w")
 
@@ -793,6 +711,74 @@ def main():
     parser.add_argument('--tensorboard_dir', type=str)
 
     parser.add_argument('--only_id', action='store_true')
+    parser.add_argument('--datastore_dir', type=str, default=None,
+                        help="Datastore directory, <output_dir>/datastore by default, e.g. the output of compact_datastore.py")
+    parser.add_argument('--datastore_dtype', default='float32', choices=['float32', 'float16', 'sq8'],
+                        help="dtype of the keys in the on-disk datastore, sq8 stores per-dimension 8-bit codes")
+    parser.add_argument('--faiss_device', type=int, default=-1,
+                        help="gpu the faiss indexes are searched on, -1 for the cpu")
+    parser.add_argument('--faiss_threads', type=int, default=0,
+                        help="Number of OpenMP threads of cpu faiss searches, 0 keeps the faiss default")
+    parser.add_argument('--index_spec', type=str, default='Flat',
+                        help="faiss index_factory spec of the datastore index, e.g. Flat, IVF1024,Flat, IVF1024,PQ64 or HNSW32, "
+                             "or TorchFlat for exact search without faiss")
+    parser.add_argument('--index_params', type=str, default='',
+                        help="Runtime search parameters of the index spec, e.g. nprobe=16 or efSearch=128")
+    parser.add_argument('--index_train_size', type=int, default=65536,
+                        help="Maximum number of keys the index is trained on")
+    parser.add_argument('--key_projection', type=str, default='',
+                        help="faiss VectorTransform spec the keys are reduced with before indexing, e.g. PCA128 or OPQ16_128")
+    parser.add_argument('--projection_sample_size', type=int, default=65536,
+                        help="Number of keys the key projection is fitted on")
+    parser.add_argument('--rerank_k', type=int, default=0,
+                        help="Re-rank this many candidates of a projected index with the full keys, 0 to disable")
+    parser.add_argument('--num_shards', type=int, default=0,
+                        help="Split the datastore into this many shards, each searched by its own worker process")
+    parser.add_argument('--shard_threads', type=int, default=0,
+                        help="faiss threads of every shard worker, all cores by default")
+    parser.add_argument('--datastore_checkpoint_steps', type=int, default=1000,
+                        help="Make the datastore durable every this many batches of its build, 0 never")
+    parser.add_argument('--resume_datastore', action='store_true',
+                        help="Resume a killed datastore build after its last checkpoint instead of starting over")
+    parser.add_argument('--index_cache_gb', type=float, default=0,
+                        help="Memory budget of the cached indexes, the least recently used ones are evicted "
+                             "beyond it, 0 for no limit")
+    parser.add_argument('--gate_entropy', type=float, default=None,
+                        help="Skip the kNN search of positions whose LM entropy is below this")
+    parser.add_argument('--gate_max_prob', type=float, default=None,
+                        help="Skip the kNN search of positions whose LM max probability is above this")
+    parser.add_argument('--gate_skip_types', type=str, default='',
+                        help="Comma separated token types of the current token whose next token is not searched, "
+                             "e.g. 3,6 for punctuation and keywords")
+    parser.add_argument('--gate_audit', action='store_true',
+                        help="Search the positions the gate skips anyway, to report the gated and the ungated "
+                             "accuracy on the same positions")
+    parser.add_argument('--pipeline_depth', type=int, default=1,
+                        help="Batches queued between the forward, search and detokenize stages of the eval, "
+                             "0 runs them one after another")
+    parser.add_argument('--retrieval_cache_size', type=int, default=0,
+                        help="Neighbour lists kept by the LRU retrieval cache, 0 disables it")
+    parser.add_argument('--retrieval_cache_tolerance', type=float, default=0.05,
+                        help="l2 distance to a cached query, relative to the query norm, up to which its "
+                             "neighbour list is reused")
+    parser.add_argument('--retrieval_cache_bits', type=int, default=32,
+                        help="Bits of the locality sensitive hash the retrieval cache is keyed on")
+    parser.add_argument('--retrieval_cache_audit', type=float, default=0.01,
+                        help="Fraction of the retrieval cache hits searched anyway to measure their agreement")
+    parser.add_argument('--retrieval_cache_margin', type=int, default=32,
+                        help="Neighbours cached beyond k, which stand in for those of the file of a query "
+                             "reading a list cached by another file of the project")
+    parser.add_argument('--pointer_retrieval', action='store_true',
+                        help="Follow the neighbours of the previous position (RetoMaton) and only search when "
+                             "fewer than --pointer_min of them survive, the retrieval cache is not used then")
+    parser.add_argument('--pointer_min', type=int, default=16,
+                        help="Surviving pointers below which pointer retrieval searches the index")
+    parser.add_argument('--type_partitions', action='store_true',
+                        help="Search one sub-index per target token type, only the ones routed to from the "
+                             "type of the current token")
+    parser.add_argument('--type_route_coverage', type=float, default=0.95,
+                        help="A context type is routed to the most frequent target types after it in the "
+                             "datastore until they cover this fraction of its entries")
     parser.add_argument('--no_hype', action='store_true')
 
     pool = None
@@ -917,11 +903,14 @@ def main():
         global_step, tr_loss = train(args, train_dataset, model, tokenizer, fh, pool)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
+    # one set of faiss resources for the whole run
+    index_manager = IndexManager(args.faiss_device, args.faiss_threads) if args.do_eval else None
+
     # Only works on single GPU
     if args.do_eval:
-        # dev_total, dev_cr = eval_acc(args, model, tokenizer, 'dev')
+        # dev_total, dev_cr = eval_acc(args, model, tokenizer, index_manager, 'dev')
         # logger.info(f"Dev total tokens: {dev_total}, accuracy: {dev_cr/dev_total}")
-        test_total, test_cr = eval_acc(args, model, tokenizer, 'test')
+        test_total, test_cr = eval_acc(args, model, tokenizer, index_manager, 'test')
         logger.info(f"Test total tokens: {test_total}, accuracy: {test_cr / test_total}")
 
 
@@ -0,0 +1,163 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Incremental updates of a project datastore: add, replace or remove one file without a rebuild.
+
+Only the blocks of the changed file go through the model. Its new entries are appended to the
+datastore, its old range becomes dead space, and the persisted indexes of its project are updated
+in place with remove_ids / add_with_ids (they hold datastore positions as ids). The file is given
+as one json record in the format of the data files ({"code": [...], "token_type": [...]}):
+
+    python update_datastore.py --datastore_dir save/javaCorpus/datastore --pretrain_dir save/model \
+        --lit_file literals.json --action replace --proj_id 3 --file_id 17 --file changed.json
+
+--action remove needs no model, --action compact rewrites the datastore without its dead space.
+Compaction writes a new directory and swaps it in, eval processes that opened the datastore
+before keep reading the old files, so it can run next to them. Updates trigger it once the dead
+entries exceed --compact_dead_fraction of the datastore.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from dataset import encode_code_tokens, split_eval_blocks
+from datastore import Datastore, DatastoreUpdater, compact_dead_entries, swap_datastore
+from knn import append_projected_keys, remap_persisted, update_persisted_indexes
+
+logger = logging.getLogger(__name__)
+
+
+def load_model(args):
+    """ Tokenizer and model of --pretrain_dir, loaded like run_lm.py does. """
+    from run_lm import MODEL_CLASSES, get_special_tokens
+
+    _, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    tokenizer = tokenizer_class.from_pretrained(args.pretrain_dir, do_lower_case=args.do_lower_case, sep_token='<EOL>',
+                                                bos_token='<s>', eos_token='</s>', pad_token='<pad>',
+                                                unk_token='<|UNKNOWN|>',
+                                                additional_special_tokens=get_special_tokens(args.lit_file))
+    if args.model_type == "rnn":
+        model = model_class(len(tokenizer), 768, 768, 1)
+        model.load_state_dict(torch.load(os.path.join(args.pretrain_dir, 'model.pt'), map_location="cpu"))
+    else:
+        model = model_class.from_pretrained(args.pretrain_dir)
+        model.resize_token_embeddings(len(tokenizer))
+    model.to(args.device)
+    model.eval()
+    return tokenizer, model
+
+
+def encode_file(model, tokenizer, code, code_type, block_size, dim, device, batch_size=8, only_id=False):
+    """
+    Datastore entries of one file, the keys [n, dim] float32, target ids [n] and (context, target)
+    token types [n, 2] of its blocks, computed like the datastore pass of run_lm.py.
+    """
+    code_token_ids, code_type_ids = encode_code_tokens(tokenizer, code, code_type)
+    blocks = split_eval_blocks(tokenizer, code_token_ids, code_type_ids, block_size)
+    keys, vals, types = [], [], []
+    for start in range(0, len(blocks), batch_size):
+        inputs = torch.tensor([sample for sample, _ in blocks[start: start + batch_size]], device=device)
+        inputs_type = torch.tensor([sample_type for _, sample_type in blocks[start: start + batch_size]],
+                                   device=device)
+        with torch.no_grad():
+            hidden_states = model(inputs, return_dict=False)[1]
+        targets = inputs[..., 1:]
+        save_mask = targets != tokenizer.pad_token_id
+        if only_id:
+            save_mask &= inputs_type[..., 1:] == 5
+        keys.append(hidden_states[..., :-1, :][save_mask].float().cpu().numpy())
+        vals.append(targets[save_mask].cpu().numpy())
+        types.append(torch.stack([inputs_type[..., :-1], inputs_type[..., 1:]], dim=-1)[save_mask].cpu().numpy())
+    return np.concatenate(keys + [np.zeros((0, dim), dtype='float32')]), \
+        np.concatenate(vals + [np.zeros((0,), dtype='int64')]), \
+        np.concatenate(types + [np.zeros((0, 2), dtype='int64')])
+
+
+def compact(datastore_dir):
+    """ Rewrite the datastore without its dead entries, the persisted indexes are remapped. """
+    output_path = datastore_dir.rstrip('/') + '.compacting'
+    shutil.rmtree(output_path, ignore_errors=True)
+    old_positions = compact_dead_entries(datastore_dir, output_path)
+    remap_persisted(datastore_dir, output_path, old_positions)
+    swap_datastore(output_path, datastore_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datastore_dir", default=None, type=str, required=True,
+                        help="Project datastore saved by run_lm.py")
+    parser.add_argument("--action", default="replace", type=str, choices=['add', 'replace', 'remove', 'compact'],
+                        help="add and replace are the same update, a file that is not in the datastore is added")
+    parser.add_argument("--proj_id", default=None, type=int,
+                        help="Project of the file")
+    parser.add_argument("--file_id", default=None, type=int,
+                        help="Id of the file, its line number in the data file")
+    parser.add_argument("--file", default=None, type=str,
+                        help="json record of the new version of the file, with its code and token_type lists")
+    parser.add_argument("--compact_dead_fraction", default=0.25, type=float,
+                        help="Compact the datastore after the update once this fraction of it is dead")
+
+    parser.add_argument("--model_type", default="gpt2", type=str,
+                        help="The model architecture to be fine-tuned.")
+    parser.add_argument("--pretrain_dir", default="", type=str,
+                        help="The model the datastore was built with")
+    parser.add_argument("--lit_file", type=str,
+                        help="literals json file")
+    parser.add_argument("--do_lower_case", action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--block_size", default=1024, type=int,
+                        help="Block size the datastore was built with")
+    parser.add_argument("--batch_size", default=8, type=int,
+                        help="Blocks per model forward")
+    parser.add_argument('--only_id', action='store_true',
+                        help="The datastore only holds identifier targets")
+    parser.add_argument("--no_cuda", action='store_true',
+                        help="Avoid using CUDA when available")
+    args = parser.parse_args()
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+
+    if args.action == 'compact':
+        compact(args.datastore_dir)
+        return
+
+    assert args.file_id is not None, "--file_id is required"
+    updater = DatastoreUpdater(args.datastore_dir)
+    if args.action == 'remove':
+        old = updater.file_range(args.file_id)
+        proj_id = old[0] if old is not None else args.proj_id
+        removed_range, added_range = updater.remove_file(args.file_id), (updater.size, updater.size)
+    else:
+        assert args.proj_id is not None and args.file is not None, "--proj_id and --file are required"
+        with open(args.file) as f:
+            record = json.load(f)
+        tokenizer, model = load_model(args)
+        keys, vals, types = encode_file(model, tokenizer, record['code'], record['token_type'], args.block_size,
+                                 updater.dim, args.device, args.batch_size, args.only_id)
+        proj_id = args.proj_id
+        removed_range, added_range = updater.replace_file(proj_id, args.file_id, keys, vals,
+                                                          types if updater.has_types else None)
+
+    datastore = Datastore(args.datastore_dir)
+    append_projected_keys(datastore, *added_range)
+    if proj_id is not None:
+        update_persisted_indexes(datastore, proj_id, removed_range, added_range)
+    logger.info(f"file {args.file_id}: removed entries [{removed_range[0]}, {removed_range[1]}), "
+                f"added [{added_range[0]}, {added_range[1]}), {updater.num_dead} of {updater.size} entries dead")
+
+    if updater.num_dead > args.compact_dead_fraction * updater.size:
+        compact(args.datastore_dir)
+
+
+if __name__ == "__main__":
+    main()